@@ -0,0 +1,114 @@
+"""Microbenchmark of the per-request overhead of the WSGI application.
+
+Calls the application directly with a WSGI environ, without any server or
+network, so that the time measured is the time firefly takes to route the
+request, check the auth token, decode the arguments, call the function and
+encode the result. The overhead is the time over calling the function.
+
+Usage:
+
+    $ PYTHONPATH=. python benchmarks/bench_dispatch.py
+
+With ``--compare REV``, the benchmark is also run against the firefly package
+of the given git revision, as a baseline. The numbers before the leaner
+dispatch path are those of the parent of the commit that added the path
+parameter routing:
+
+    $ PYTHONPATH=. python benchmarks/bench_dispatch.py \
+        --compare $(git log --format=%h --diff-filter=A -1 -- firefly/routing.py)^
+
+The revisions without path parameter routing skip that benchmark.
+"""
+import argparse
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import timeit
+from firefly.app import Firefly
+
+try:
+    import firefly.routing
+    HAS_ROUTING = True
+except ImportError:
+    HAS_ROUTING = False
+
+def square(a):
+    return a * a
+
+def get_user(id, fields=None):
+    return {"id": id, "fields": fields}
+
+def make_environ(path, body, **extra):
+    environ = {
+        "REQUEST_METHOD": "POST",
+        "PATH_INFO": path,
+        "SCRIPT_NAME": "",
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "8000",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "wsgi.url_scheme": "http",
+        "CONTENT_TYPE": "application/json",
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.input": io.BytesIO(body)
+    }
+    environ.update(extra)
+    return environ
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+def run(label, func, number, baseline=None):
+    t = min(timeit.repeat(func, number=number, repeat=5)) / number
+    if baseline is None:
+        print("{:<40} {:8.2f} us/call".format(label, t * 1e6))
+    else:
+        print("{:<40} {:8.2f} us/call {:8.2f} us overhead".format(label, t * 1e6, (t - baseline) * 1e6))
+    return t
+
+def main(number=20000):
+    app = Firefly(auth_token="secret", allowed_origins="*")
+    app.add_route("/square", square)
+    if HAS_ROUTING:
+        app.add_route("/users/{id:int}", get_user)
+        for i in range(20):
+            app.add_route("/items/{{id}}/v{}".format(i), get_user)
+
+    def call(path, body):
+        environ = make_environ(path, body, HTTP_AUTHORIZATION="Token secret")
+        return b"".join(app(environ, start_response))
+
+    baseline = run("function call", lambda: square(a=3), number)
+    run("POST /square", lambda: call("/square", b'{"a": 3}'), number, baseline)
+    if HAS_ROUTING:
+        run("POST /users/{id:int}", lambda: call("/users/42", b'{"fields": ["name"]}'), number, baseline)
+    run("POST /nothing (404)", lambda: call("/nothing", b'{}'), number, baseline)
+
+def run_revision(revision, number):
+    """Runs this benchmark in a new process against the firefly package of
+    the given git revision.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    archive = subprocess.check_output(["git", "archive", revision, "firefly"], cwd=root)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tarfile.open(fileobj=io.BytesIO(archive)).extractall(tmpdir)
+        env = dict(os.environ, PYTHONPATH=tmpdir)
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), "--number", str(number)], env=env)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=20000, help="number of calls in each run")
+    parser.add_argument("--compare", metavar="REV", help="git revision to run the benchmark against as well")
+    args = parser.parse_args()
+    if args.compare:
+        print("revision {}:".format(args.compare))
+        sys.stdout.flush()
+        run_revision(args.compare, args.number)
+        print("\ncurrent tree:")
+    main(args.number)
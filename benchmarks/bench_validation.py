@@ -0,0 +1,37 @@
+"""Microbenchmark comparing the per-request argument validation.
+
+Compares the old path, which introspects the function signature on every
+call, with the call plan that FireflyFunction compiles at registration.
+
+Usage:
+
+    $ PYTHONPATH=. python benchmarks/bench_validation.py
+"""
+import timeit
+from firefly.validator import validate_args, CallPlan, ValidationError
+
+def score(features, model="default", threshold=0.5, **options):
+    pass
+
+def run(label, func, number):
+    t = min(timeit.repeat(func, number=number, repeat=5))
+    print("{:<40} {:8.3f} us/call".format(label, t * 1e6 / number))
+
+def main(number=100000):
+    plan = CallPlan.from_function(score)
+    good = {"features": [1, 2, 3], "threshold": 0.7}
+    bad = {"model": "x"}
+
+    def invalid(validate):
+        try:
+            validate()
+        except ValidationError:
+            pass
+
+    run("validate_args (valid)", lambda: validate_args(score, good), number)
+    run("CallPlan.validate (valid)", lambda: plan.validate(good), number)
+    run("validate_args (invalid)", lambda: invalid(lambda: validate_args(score, bad)), number)
+    run("CallPlan.validate (invalid)", lambda: invalid(lambda: plan.validate(bad)), number)
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,26 @@
-import cgi
 from webob import Request, Response
 from webob.exc import HTTPNotFound
-import json
 import functools
+import hashlib
+import io
 import logging
-from .validator import validate_args, ValidationError
-from .utils import json_encode, is_file, FileIter
+import math
+import sys
+from .validator import CallPlan, ValidationError
+from .utils import json_encode, is_file, is_stream, iter_lines, FileIter, NDJSONIter, get_file_size, is_os_file, parse_range, iscoroutinefunction, run_coroutine
+from .batching import MicroBatcher
+from .cache import ResultCache, make_key
+from .codecs import get_json_codec, get_binary_codecs, parse_accept
+from .multipart import parse_multipart, parse_header, PayloadTooLarge
+from .compression import get_encodings, choose_encoding, compress, compress_iter, DecompressedFile, MAX_DECOMPRESSED_SIZE
+from .metrics import Metrics, format_metrics, clock
+from .profiling import Profiler
+from .limits import ConcurrencyLimiter, run_limited
+from .routing import Router, get_path_params
+from .loader import LazyFunction, log_import_times
 from .version import __version__
 import threading
-from wsgiref.simple_server import make_server
+from .server import run_server
 
 try:
     from inspect import signature, _empty
@@ -24,8 +36,32 @@ logger = logging.getLogger("firefly")
 ctx = threading.local()
 ctx.request = None
 
+# the header with the number of seconds the client is willing to wait
+TIMEOUT_HEADER = 'X-Firefly-Timeout'
+TIMEOUT_ENVIRON_KEY = 'HTTP_X_FIREFLY_TIMEOUT'
+# the max timeout in seconds, the larger timeouts asked by the clients are
+# lowered to it
+MAX_TIMEOUT = 86400
+
+def get_remaining_time():
+    """Returns the number of seconds left before the deadline of the
+    current request, or None when the request has no deadline.
+    """
+    deadline = getattr(ctx, "deadline", None)
+    if deadline is not None:
+        return deadline - clock()
+
+class DeadlineExceeded(Exception):
+    pass
+
+class LengthRequired(ValueError):
+    """Raised when the length of a streamed request body is unknown and
+    the server doesn't mark the end of the input.
+    """
+    pass
+
 class Firefly(object):
-    def __init__(self, auth_token=None, allowed_origins=""):
+    def __init__(self, auth_token=None, allowed_origins="", codec=None):
         """Creates a firefly application.
 
         If the optional parameter auth_token is specified, the
@@ -36,34 +72,130 @@ class Firefly(object):
         pass the allowed origins as allowed_origins. To allow all origins, set it
         to ``*``.
 
+        The request and response bodies are encoded using the fastest JSON
+        library available, unless a codec is specified explicitly.
+
         :param auth_token: the auto_token for the application
         :param allowed_origins: allowed origins for cross-origin requests
+        :param codec: the JSON codec or the name of it (json or orjson)
         """
+        self.codec = self._get_codec(codec)
         self.mapping = {}
-        self.add_route('/', self.generate_index,internal=True)
-        self.auth_token = auth_token
-        self.allowed_origins = allowed_origins
+        self.router = Router()
+        self.limiter = None
+        self.add_route('/', self.get_index, internal=True)
+        self.add_route('/_batch', self.run_batch, internal=True)
+        self.add_route('/_cache', self.get_cache_stats, internal=True)
+        self.add_route('/_metrics', self.get_metrics, internal=True)
+        self.add_route('/_profiles', self.get_profiles, internal=True)
+        self.add_route('/_limits', self.get_limits_stats, internal=True)
+        self.profiler = Profiler()
+        self.set_auth_token(auth_token)
+        self.set_allowed_origins(allowed_origins)
 
 
+    def _get_codec(self, codec):
+        if codec is None or isinstance(codec, str):
+            return get_json_codec(codec)
+        return codec
+
+    def set_codec(self, codec):
+        self.codec = self._get_codec(codec)
+        for func in self.mapping.values():
+            func.codec = self.codec
+        self._index = None
+
     def set_auth_token(self, token):
         self.auth_token = token
+        # the usual value of the Authorization header, which is checked
+        # without parsing the header
+        self._auth_header = token and "Token " + token
+
+    def set_profiling(self, sample_rate=None, slow_ms=None, max_profiles=None):
+        """Enables profiling the requests.
+
+        A fraction of the requests, given by sample_rate, is profiled. When
+        slow_ms is specified, all the requests are profiled and the profiles
+        of the ones that take longer than slow_ms milliseconds are kept.
+        When the auth token is set, the requests with the ``X-Firefly-Profile``
+        header are always profiled. See :class:`firefly.profiling.Profiler`.
+        """
+        self.profiler.configure(sample_rate=sample_rate, slow_ms=slow_ms, max_profiles=max_profiles)
+
+    def set_limits(self, max_concurrency=None, max_queue=0, queue_timeout=None, retry_after=1):
+        """Limits the number of concurrent requests to all the functions
+        together. The requests that can't be queued are rejected with
+        ``503 Service Unavailable``.
+
+        See :class:`firefly.limits.ConcurrencyLimiter`.
+        """
+        if max_concurrency:
+            self.limiter = ConcurrencyLimiter(max_concurrency, max_queue, queue_timeout, retry_after)
+        else:
+            self.limiter = None
+        for func in self.mapping.values():
+            self._set_global_limiter(func)
+
+    def _set_global_limiter(self, func):
+        # the functions take a slot of the global limit after their own,
+        # and a batch request takes a single one for all its calls
+        if not func.options.get("internal") or func.function == self.run_batch:
+            func.global_limiter = self.limiter
 
     def set_allowed_origins(self, allowed_origins):
         # Also support mutliple origins as a list.
         if isinstance(allowed_origins, list):
             allowed_origins = ", ".join(allowed_origins)
         self.allowed_origins = allowed_origins or ""
+        if self.allowed_origins:
+            self._cors_headers = [
+                ('Access-Control-Allow-Origin', self.allowed_origins),
+                ('Access-Control-Allow-Methods', 'GET,POST'),
+                ('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+            ]
+        else:
+            self._cors_headers = []
 
-    def function(self, func=None, name=None, path=None):
+    def function(self, func=None, name=None, path=None, **options):
+        """Decorator to expose a function.
+
+        The options are passed on to :class:`FireflyFunction`.
+        """
         if func is None:
-            return functools.partial(self.function, name=name, path=path)
+            return functools.partial(self.function, name=name, path=path, **options)
         name = name or func.__name__
         path = path or "/" + name
-        self.add_route(path=path, function=func, function_name=name)
+        self.add_route(path=path, function=func, function_name=name, **options)
         return func
 
     def add_route(self, path, function, function_name=None, **kwargs):
-        self.mapping[path] = FireflyFunction(function, function_name, **kwargs)
+        """Exposes the function at the path.
+
+        The path can have parameters, like ``/users/{id:int}``, which are
+        passed to the function as arguments. See :mod:`firefly.routing`.
+        """
+        kwargs.setdefault("codec", self.codec)
+        func = FireflyFunction(function, function_name, **kwargs)
+        self._set_global_limiter(func)
+        for name in get_path_params(path):
+            if name not in func.plan.keywords and not func.plan.var_keyword:
+                raise ValueError("Function {} has no argument for the path parameter {}".format(func.name, name))
+        self.router.add(path, func)
+        self.mapping[path] = func
+        # the index lists the functions
+        self._index = None
+
+    def match_route(self, request):
+        """Returns the FireflyFunction to handle the request, or None when
+        there is no route for the path.
+
+        The parameters in the path are stored in the ``urlvars`` of the
+        request.
+        """
+        func, params = self.router.match(request.path_info)
+        if params:
+            request.urlvars = params
+        return func
 
     def generate_function_list(self):
         return {f.name: {"path": path, "doc": f.doc, "parameters": f.sig}
@@ -74,17 +206,146 @@ class Firefly(object):
         help_dict = {
             "app": "firefly",
             "version": __version__,
+            "content_types": [self.codec.content_type] + sorted(get_binary_codecs()),
+            "content_encodings": get_encodings(),
             "functions": self.generate_function_list()
             }
         return help_dict
 
+    def get_index(self):
+        """Returns the index as a response with an ETag.
+
+        The index is encoded once and reused until the functions change.
+        The clients that have the current version of it, as indicated by
+        the ``If-None-Match`` header, get ``304 Not Modified`` instead.
+        """
+        index = self._index
+        if index is None:
+            body = self.codec.encode(self.generate_index())
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            index = self._index = (body, etag)
+        body, etag = index
+
+        if_none_match = ctx.request.environ.get('HTTP_IF_NONE_MATCH') if ctx.request is not None else None
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return Response(status=304, headerlist=[('ETag', etag)])
+        return Response(body=body, headerlist=[
+            ('Content-Type', 'application/json; charset=utf-8'),
+            ('ETag', etag),
+            # the clients must check that the index hasn't changed
+            ('Cache-Control', 'no-cache')
+        ])
+
+    def find_function(self, name):
+        """Returns the FireflyFunction with the given name or path.
+
+        Internal functions are never returned.
+        """
+        if name in self.mapping:
+            func = self.mapping[name]
+        else:
+            func = next((f for f in self.mapping.values() if f.name == name), None)
+        if func is not None and not func.options.get("internal"):
+            return func
+
+    def get_limits_stats(self):
+        """Returns the statistics of the concurrency limits.
+        """
+        stats = {f.name: f.limiter.stats() for f in self.mapping.values() if f.limiter is not None}
+        if self.limiter is not None:
+            stats["_global"] = self.limiter.stats()
+        return stats
+
+    def get_cache_stats(self):
+        """Returns the statistics of the caches of the functions.
+        """
+        return {f.name: f.cache.stats() for f in self.mapping.values() if f.cache is not None}
+
+    def get_metrics(self):
+        """Returns the metrics of the functions in the Prometheus text format.
+        """
+        metrics = [((("function", f.name),), f.metrics) for f in self.mapping.values()]
+        response = Response(body=format_metrics(metrics).encode("utf-8"))
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return response
+
+    def get_profiles(self):
+        """Returns the list of the recent profiles, or the profile with
+        the id given in the query string in the specified format.
+
+        The supported formats are ``text`` (the pstats report), ``pstats``
+        (the binary stats file) and ``collapsed`` (collapsed stacks).
+        """
+        params = ctx.request.GET if ctx.request is not None else {}
+        if "id" not in params:
+            return self.profiler.list()
+
+        try:
+            profile = self.profiler.get(int(params["id"]))
+        except ValueError:
+            profile = None
+        if profile is None:
+            return self.http_error('404 Not Found', error="Profile not found: " + params["id"])
+
+        format = params.get("format", "text")
+        if format == "pstats":
+            return Response(body=profile.get_pstats(), content_type='application/octet-stream')
+        elif format == "collapsed":
+            return Response(text=profile.get_collapsed(), content_type='text/plain', charset='utf-8')
+        elif format == "text":
+            return Response(text=profile.get_text(), content_type='text/plain', charset='utf-8')
+        else:
+            return self.http_error('400 Bad Request', error="Unknown profile format: " + format)
+
+    def run_batch(self, calls):
+        """Calls multiple functions in a single request.
+
+        Each call is a dict with the name of the function and the kwargs to
+        call it with. The calls are independent of each other, the result of
+        each one is returned with its http status code.
+        """
+        if not isinstance(calls, list):
+            raise HTTPError('400 Bad Request', json_encode({"error": "calls must be a list"}),
+                            {"Content-Type": "application/json"})
+        request = ctx.request
+        deadline = getattr(ctx, "deadline", None)
+        results = []
+        for call in calls:
+            # each call gets a fresh context, just like a separate request
+            ctx.__dict__.clear()
+            ctx.request = request
+            if deadline is not None:
+                ctx.deadline = deadline
+            results.append(self._run_batch_item(call))
+        return results
+
+    def _run_batch_item(self, call):
+        if not isinstance(call, dict) or not isinstance(call.get("kwargs", {}), dict):
+            return {"status": 400, "error": "Invalid call: {}".format(json_encode(call))}
+
+        name = call.get("function")
+        func = self.find_function(name)
+        if func is None:
+            return {"status": 404, "error": "Not found: {}".format(name)}
+
+        return func.call_in_batch(call.get("kwargs", {}))
+
     def __call__(self, environ, start_response):
         request = Request(environ)
         response = self.process_request(request)
-        return response(environ, start_response)
+        if environ['REQUEST_METHOD'] == 'HEAD' or _has_location(response.headerlist):
+            # webob drops the body of HEAD requests and makes the location
+            # absolute
+            return response(environ, start_response)
+        start_response(response.status, response.headerlist)
+        return response.app_iter
 
     def verify_auth_token(self, request):
-        return not self.auth_token or self.auth_token == self._get_auth_token(request)
+        if not self.auth_token:
+            return True
+        # most clients send the header exactly as expected
+        auth = request.environ.get('HTTP_AUTHORIZATION')
+        return auth == self._auth_header or self.auth_token == self._get_auth_token(request)
 
     def _get_auth_token(self, request):
         auth = request.headers.get("Authorization")
@@ -98,115 +359,826 @@ class Firefly(object):
         return response
 
     def _prepare_cors_headers(self):
-        if self.allowed_origins:
-            headers = {
-                'Access-Control-Allow-Origin': self.allowed_origins,
-                'Access-Control-Allow-Methods': 'GET,POST',
-                'Access-Control-Allow-Headers': 'Content-Type, Authorization'
-            }
-            return list(headers.items())
-        else:
-            return []
+        # the headers are computed when the allowed origins are set
+        return list(self._cors_headers)
 
-    def process_request(self, request):
-        if request.method == 'OPTIONS':
+    def check_request(self, request):
+        """Returns the response for the requests that must not reach any
+        function, i.e. the CORS preflight requests and the requests that
+        fail authentication. Returns None for all other requests.
+        """
+        if request.environ['REQUEST_METHOD'] == 'OPTIONS':
             response = Response(status='200 OK', body=b'')
-            response.headerlist += self._prepare_cors_headers()
+            response.headerlist.extend(self._cors_headers)
             return response
 
         if not self.verify_auth_token(request):
             return self.http_error('403 Forbidden', error='Invalid auth token')
 
+    def process_request(self, request):
+        response = self.check_request(request)
+        if response is not None:
+            return response
+
         # Clear all the existing state, if any
         ctx.__dict__.clear()
 
         ctx.request = request
 
-        path = request.path_info
-        if path in self.mapping:
-            func = self.mapping[path]
-            response = func(request)
-            response.headerlist += self._prepare_cors_headers()
+        func = self.match_route(request)
+        if func is not None:
+            response = self.call_function(func, request)
+            if self._cors_headers:
+                response.headerlist.extend(self._cors_headers)
         else:
-            response = self.http_error('404 Not Found', error="Not found: " + path)
+            response = self.http_error('404 Not Found', error="Not found: " + request.path_info)
 
         ctx.request = None
         return response
 
-    def run(self, host=None, port=None):
+    def call_function(self, func, request):
+        if func.options.get("internal"):
+            return func(request)
+
+        # the profile header is trusted only from authenticated clients
+        reason = self.profiler.get_reason(request, allow_header=bool(self.auth_token))
+        if reason:
+            return self.profiler.call(func, request, reason=reason)
+        return func(request)
+
+    def start_executors(self):
+        """Starts the process pools of the functions that use them, so
+        that the first calls don't wait for them to start.
+        """
+        for func in self.mapping.values():
+            if func.executor is not None:
+                func.executor.get_pool()
+
+    def warmup(self):
+        """Imports the functions that are loaded lazily, so that the first
+        calls to them don't wait for the import. See :mod:`firefly.loader`.
+        """
+        lazy = [f for f in self.mapping.values() if isinstance(f.function, LazyFunction) and not f.function.is_loaded]
+        for func in lazy:
+            try:
+                func.function.load()
+            except Exception:
+                logger.error("Failed to load function %s", func.name, exc_info=True)
+        if lazy:
+            logger.info("loaded %d lazily loaded functions", len(lazy))
+            log_import_times()
+
+    def run(self, host=None, port=None, **options):
+        """Runs the application.
+
+        The options are passed on to :func:`firefly.server.run_server`.
+        """
         host = host or "localhost"
         port = port or 8000
         print("http://{}:{}/".format(host, port))
-        server = make_server(host, port, self)
-        server.serve_forever()
+        run_server(self, host, port, **options)
+
+    def asgi(self, max_threads=32):
+        """Returns an ASGI application serving the same functions.
+
+        See :class:`firefly.asgi.ASGIApp`.
+        """
+        from .asgi import ASGIApp
+        return ASGIApp(self, max_threads=max_threads)
+
+def read_body(request):
+    """Returns the body of the request.
+
+    The body is read directly from the input when its length is known,
+    instead of making a seekable copy of the input first as webob does.
+    """
+    environ = request.environ
+    try:
+        length = int(environ.get('CONTENT_LENGTH') or '')
+    except ValueError:
+        return request.body
+    if environ.get('webob.is_body_seekable'):
+        return request.body
+
+    chunks = []
+    remaining = length
+    while remaining > 0:
+        chunk = environ['wsgi.input'].read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    body = b"".join(chunks)
+    if len(body) < length:
+        raise ValueError("The request body is incomplete")
+    # the body can still be read again by others
+    environ['wsgi.input'] = io.BytesIO(body)
+    environ['webob.is_body_seekable'] = True
+    return body
+
+def iter_until(items, deadline):
+    """Yields the items until the deadline and raises DeadlineExceeded
+    when the next item is produced after it.
+
+    The status of a streamed response is sent before its items, so the
+    response is aborted when the deadline is exceeded.
+    """
+    try:
+        for item in items:
+            if clock() > deadline:
+                raise DeadlineExceeded("Deadline exceeded while streaming the results")
+            yield item
+    finally:
+        if hasattr(items, "close"):
+            items.close()
+
+def _etag_matches(if_none_match, etag):
+    if if_none_match.strip() == '*':
+        return True
+    # weak comparison, as required for If-None-Match
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return etag in tags or 'W/' + etag in tags
+
+def _has_location(headerlist):
+    for name, value in headerlist:
+        if name.lower() == 'location':
+            return True
+    return False
+
+# the content types of the responses that are compressed
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'application/msgpack')
 
 class FireflyFunction(object):
-    def __init__(self, function, function_name=None, **options):
+    def __init__(self, function, function_name=None, codec=None, **options):
+        """Wraps a function to be called over HTTP.
+
+        Supported options:
+
+        * ``internal``: the function is not listed in the index and is
+          called without any arguments when it doesn't take any.
+        * ``batch``: the function is vectorized and the concurrent calls
+          to it are batched together. The value is a dict with the
+          optional ``max_size`` and ``max_wait_ms`` of the batches.
+          See :class:`firefly.batching.MicroBatcher`.
+        * ``chunk_size``: the min size of the chunks in which the results
+          of the generator functions are streamed, and the size of the chunks
+          in which the streamed inputs are read.
+        * ``input_stream``: the name of the argument that takes the records
+          of a streamed ``application/x-ndjson`` request as a generator.
+        * ``upload``: the limits of the multipart/form-data uploads. The
+          value is a dict with the optional ``spool_size``, ``max_part_size``
+          and ``max_size``. See :func:`firefly.multipart.parse_multipart`.
+        * ``compression``: the compression of the responses, which is enabled
+          by default. The value is a dict with the optional ``min_size`` of
+          the responses to compress (1024 bytes) and the compression ``level``
+          (6), or False to disable the compression. The compressed request
+          bodies are rejected with 413 when they are larger than
+          ``max_decompressed_size`` (100MB) after decompressing them.
+        * ``max_concurrency``: the max number of concurrent calls to the
+          function. The other calls wait in a queue of ``max_queue`` calls
+          (0 by default) for at most ``queue_timeout`` seconds, and the calls
+          beyond that are rejected with 503 and a ``Retry-After`` of
+          ``retry_after`` seconds (1 by default).
+          See :class:`firefly.limits.ConcurrencyLimiter`.
+        * ``timeout``: the max number of seconds to wait for the function to
+          finish. The calls that take longer fail with 504. The clients can
+          ask for a lower timeout using the ``X-Firefly-Timeout`` header.
+        * ``executor``: ``process`` to run the function in a pool of
+          ``max_workers`` processes, for the CPU-bound functions that don't
+          release the GIL. See :class:`firefly.executors.ProcessExecutor`.
+        * ``cache``: the function is pure and its responses are cached. The
+          value is a dict with the optional ``max_entries``, ``ttl`` and
+          ``max_bytes`` of the cache. See :class:`firefly.cache.ResultCache`.
+
+        The dict valued options can also be given as ``True`` to use the
+        defaults.
+        """
         self.function = function
+        self.codec = codec or get_json_codec()
         self.options = options
         self.name = function_name or function.__name__
         self.doc = function.__doc__ or ""
         self.sig = self.generate_signature(function)
+        self.plan = CallPlan.from_function(function)
+        self.is_coroutine = iscoroutinefunction(function)
+        self.executor = self._create_executor()
+        self.batcher = self._create_batcher()
+        self.cache = self._create(ResultCache, "cache")
+        self.metrics = Metrics()
+        self.limiter = self._create_limiter()
+        # the limit across all the functions, set by the app
+        self.global_limiter = None
+
+    def _create(self, cls, option, *args):
+        # creates the helper object for an option, when it is enabled
+        value = self.options.get(option)
+        if not value:
+            return None
+        kwargs = {} if value is True else value
+        return cls(*args, **kwargs)
+
+    def _create_executor(self):
+        executor = self.options.get("executor", "thread")
+        if executor == "thread":
+            return None
+        elif executor != "process":
+            raise ValueError("Unknown executor for function {}: {}".format(self.name, executor))
+        elif self.is_coroutine:
+            raise ValueError("The async function {} can't be run in a process pool".format(self.name))
+        elif sys.version_info < (3, 8):
+            raise ValueError("The process executor of function {} requires Python 3.8 or above".format(self.name))
+        from .executors import ProcessExecutor
+        return ProcessExecutor(self.function, max_workers=self.options.get("max_workers"))
+
+    def _create_batcher(self):
+        if self.options.get("batch") and self.is_coroutine:
+            raise ValueError("The async function {} can't be batched".format(self.name))
+        return self._create(MicroBatcher, "batch", self.executor or self.function)
+
+    def _create_limiter(self):
+        max_concurrency = self.options.get("max_concurrency")
+        if not max_concurrency:
+            return None
+        return ConcurrencyLimiter(max_concurrency,
+                                  max_queue=self.options.get("max_queue", 0),
+                                  queue_timeout=self.options.get("queue_timeout"),
+                                  retry_after=self.options.get("retry_after", 1))
 
     def __repr__(self):
         return "<FireflyFunction %r>" % self.function
 
     def __call__(self, request):
-        if self.options.get("internal", False):
+        if self.options.get("internal", False) and not self.plan.parameters:
             return self.make_response(self.function())
 
         logger.info("calling function %s", self.name)
         try:
-            kwargs = self.get_inputs(request)
+            deadline = self.get_deadline(request)
         except ValueError as err:
-            logger.warn("Function %s failed with ValueError: %s.", self.name, err)
-            return self.make_response({"error": str(err)}, status=400)
+            return self.make_response(*self.input_error(err))
+        if deadline is not None:
+            ctx.deadline = deadline
 
+        self.metrics.inc("firefly_requests_in_flight")
+        start = clock()
+        response = None
         try:
-            validate_args(self.function, kwargs)
-        except ValidationError as err:
-            logger.warn("Function %s failed with ValidationError: %s.", self.name, err)
-            return self.make_response({"error": str(err)}, status=422)
+            response = self.call_limited(request)
+            return response
+        finally:
+            self.metrics.inc("firefly_requests_in_flight", value=-1)
+            self.record_request(request, response, clock() - start)
+
+    def call_in_batch(self, kwargs):
+        """Calls the function for a call in a batch request and returns
+        a dict with the http status code and the result or the error.
 
+        The call is limited, cached and recorded in the metrics just like
+        a separate request. Its deadline is that of the batch request or the
+        ``timeout`` option, whichever is earlier.
+        """
+        logger.info("calling function %s in batch", self.name)
+        timeout = self.options.get("timeout")
+        if timeout is not None:
+            deadline = getattr(ctx, "deadline", None)
+            ctx.deadline = clock() + timeout if deadline is None else min(deadline, clock() + timeout)
+
+        # the call is recorded in the metrics of the function, but its size
+        # is part of the batch request
+        self.metrics.inc("firefly_requests_in_flight")
+        start = clock()
+        item = None
         try:
-            result = self.function(**kwargs)
+            item = self._call_in_batch(kwargs)
+            return item
+        finally:
+            self.metrics.inc("firefly_requests_in_flight", value=-1)
+            self.record_call(item["status"] if item is not None else 500, clock() - start)
+
+    def _call_in_batch(self, kwargs):
+        # the calls in a batch are limited like the separate requests
+        if self.limiter is not None and not self.limiter.acquire():
+            result, status = self.overloaded_error(self.limiter)
+            return {"status": status, "error": result["error"]}
+        try:
+            result, status = self.invoke_cached(kwargs)
+        except HTTPError as e:
+            return {"status": int(str(e.status_code).split()[0]), "error": e.body}
+        except Exception as e:
+            result, status = self.execution_error(e)
+        finally:
+            if self.limiter is not None:
+                self.limiter.release()
+
+        if is_file(result):
+            return {"status": 500, "error": "Files can not be returned from a batch call"}
+        elif status != 200:
+            return {"status": status, "error": result["error"]}
+        else:
+            return {"status": status, "result": result}
+
+    def invoke_cached(self, kwargs):
+        """Same as invoke, but the result is taken from the cache when it
+        is there. The results are cached as the responses to the requests
+        without the Accept and Accept-Encoding headers.
+        """
+        cache_key = self.get_cache_key(None, kwargs)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return self.codec.decode(cached[2]), 200
+
+        result, status = self.invoke(kwargs)
+        if is_stream(result):
+            result = list(result)
+        if cache_key is not None:
+            self.cache_response(cache_key, result, status, self.make_response(result, status))
+        return result, status
+
+    def get_deadline(self, request):
+        """Returns the deadline of the request, based on the timeout
+        specified by the client and the ``timeout`` option, whichever is
+        lower.
+        """
+        timeout = self.options.get("timeout")
+        header = request.environ.get(TIMEOUT_ENVIRON_KEY)
+        if header:
+            try:
+                value = float(header)
+            except ValueError:
+                raise ValueError("Invalid {} header: {}".format(TIMEOUT_HEADER, header))
+            # inf and nan can't be used as timeouts
+            if math.isinf(value) or math.isnan(value):
+                raise ValueError("Invalid {} header: {}".format(TIMEOUT_HEADER, header))
+            value = min(value, MAX_TIMEOUT)
+            timeout = value if timeout is None else min(timeout, value)
+        if timeout is not None:
+            return clock() + timeout
+
+    def handle_request(self, request):
+        t0 = clock()
+        try:
+            kwargs = self.get_inputs(request)
+        except ValueError as err:
+            return self.make_response(*self.input_error(err))
+        self.metrics.observe("firefly_phase_duration_seconds", (("phase", "decode"),), clock() - t0)
+
+        cache_key = self.get_cache_key(request, kwargs)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return self.compress_response(request, self.make_cached_response(cached))
+
+        try:
+            result, status = self.invoke(kwargs)
         except HTTPError as e:
             return e.get_response()
+
+        # the streamed results are encoded while they are sent, which is
+        # not included in the encode phase
+        t0 = clock()
+        codec = self.get_response_codec(request, result)
+        response = self.make_response(result, status=status, codec=codec, request=request)
+        response = self.compress_response(request, response)
+        if cache_key is not None:
+            self.cache_response(cache_key, result, status, response)
+        self.metrics.observe("firefly_phase_duration_seconds", (("phase", "encode"),), clock() - t0)
+        return response
+
+    def call_limited(self, request):
+        """Handles the request within the concurrency limits of the function
+        and of the app.
+
+        The slot of the function is taken before the global one, so that
+        the requests waiting for a busy function don't hold the global slots
+        that the other functions could use.
+        """
+        return self._call_limited(request, self.get_limiters())
+
+    def get_limiters(self):
+        """Returns the limiters of the request, in the order in which they
+        are acquired.
+        """
+        return [limiter for limiter in (self.limiter, self.global_limiter) if limiter is not None]
+
+    def _call_limited(self, request, limiters):
+        if not limiters:
+            return self.handle_request(request)
+        limiter = limiters[0]
+        handler = lambda request: self._call_limited(request, limiters[1:])
+        return run_limited(limiter, handler, request) or self.overloaded_response(limiter)
+
+    def overloaded_response(self, limiter):
+        response = self.make_response(*self.overloaded_error(limiter))
+        response.headers['Retry-After'] = str(limiter.retry_after)
+        return response
+
+    def overloaded_error(self, limiter):
+        if limiter is self.limiter:
+            logger.warn("Function %s rejected a request as it is overloaded.", self.name)
+        else:
+            logger.warn("Function %s rejected a request as the server is overloaded.", self.name)
+        return {"error": "Server is overloaded, please try again later."}, 503
+
+    def record_request(self, request, response, duration):
+        """Records the status, size and duration of a request in the metrics.
+        """
+        status = response.status_code if response is not None else 500
+        response_bytes = response.content_length if response is not None else 0
+        self.record_call(status, duration, request.content_length or 0, response_bytes or 0)
+
+    def record_call(self, status, duration, request_bytes=0, response_bytes=0):
+        """Records the status, size and duration of a call in the metrics.
+        """
+        labels = (("status", str(status)),)
+        self.metrics.inc("firefly_requests_total", labels)
+        self.metrics.observe("firefly_request_duration_seconds", labels, duration)
+        self.metrics.inc("firefly_request_bytes_total", value=request_bytes)
+        if response_bytes:
+            self.metrics.inc("firefly_response_bytes_total", value=response_bytes)
+
+    def compress_response(self, request, response):
+        """Compresses the response using the best encoding accepted by
+        the client.
+
+        Only the JSON, msgpack and streamed responses are compressed. The
+        files and the other binary data are sent as they are.
+        """
+        options = self.options.get("compression", True)
+        if not options:
+            return response
+        content_type = response.content_type
+        if content_type not in COMPRESSIBLE_TYPES:
+            return response
+        options = {} if options is True else options
+
+        response.headerlist.append(('Vary', 'Accept-Encoding'))
+        encoding = self.get_encoding(request)
+        # the cached responses are already compressed
+        if encoding is None or response.content_encoding:
+            return response
+
+        level = options.get("level", 6)
+        if content_type == 'application/x-ndjson':
+            response.app_iter = compress_iter(response.app_iter, encoding, level)
+        elif response.content_length >= options.get("min_size", 1024):
+            response.body = compress(response.body, encoding, level)
+        else:
+            return response
+        response.content_encoding = encoding
+        return response
+
+    def get_encoding(self, request):
+        """Returns the encoding to compress the response to the request
+        with, or None when the response should not be compressed.
+        """
+        if not self.options.get("compression", True):
+            return None
+        return choose_encoding(request.environ.get('HTTP_ACCEPT_ENCODING'))
+
+    def get_cache_key(self, request, kwargs):
+        """Returns the key to cache the response to the request with, or
+        None if the response can't be cached.
+
+        When the request is None, the key is that of a request without the
+        Accept and Accept-Encoding headers.
+        """
+        if self.cache is None:
+            return None
+        # the defaults are filled in so that the same call has the same key
+        # with and without the optional arguments
+        key = make_key(dict(self.plan.defaults, **kwargs)) if isinstance(kwargs, dict) else None
+        if key is not None:
+            # the encoding of the response depends on the Accept header and
+            # the compressed responses are cached for each encoding
+            if request is None:
+                return (key, None, None)
+            return (key, request.environ.get('HTTP_ACCEPT'), self.get_encoding(request))
+
+    def cache_response(self, cache_key, result, status, response):
+        """Stores the encoded and compressed response in the cache, unless
+        the call failed or the result is a file or a stream.
+        """
+        if status == 200 and not is_file(result) and not is_stream(result):
+            body = response.body
+            cached = (response.headers['Content-Type'], response.content_encoding, body)
+            self.cache.set(cache_key, cached, size=len(body))
+            response.headers['X-Firefly-Cache'] = 'miss'
+
+    def make_cached_response(self, cached):
+        content_type, content_encoding, body = cached
+        response = Response(body=body)
+        response.headers['Content-Type'] = content_type
+        if content_encoding:
+            response.content_encoding = content_encoding
+        response.headers['X-Firefly-Cache'] = 'hit'
+        return response
+
+    def invoke(self, kwargs):
+        """Validates the arguments and calls the function with them.
+
+        Returns a tuple of the result and the http status code. When the
+        call fails, the result is a dict with the error message. The
+        HTTPError raised by the function is passed on to the caller.
+        """
+        t0 = clock()
+        try:
+            self.plan.validate(kwargs)
+        except ValidationError as err:
+            return self.validation_error(err)
+        t1 = clock()
+        self.metrics.observe("firefly_phase_duration_seconds", (("phase", "validate"),), t1 - t0)
+
+        remaining = get_remaining_time()
+        if remaining is not None and remaining <= 0:
+            return self.deadline_error()
+
+        try:
+            if remaining is None:
+                result = self.call_function(kwargs)
+            else:
+                result = self.call_with_timeout(kwargs, remaining)
+        except HTTPError:
+            raise
+        except DeadlineExceeded:
+            return self.deadline_error()
         except Exception as err:
-            logger.error("Function %s failed with exception.", self.name, exc_info=True)
-            return self.make_response(
-                    {"error": "{}: {}".format(err.__class__.__name__, str(err))}, status=500
-                )
-        return self.make_response(result)
+            return self.execution_error(err)
+        finally:
+            self.metrics.observe("firefly_phase_duration_seconds", (("phase", "execute"),), clock() - t1)
+        return result, 200
+
+    def input_error(self, err):
+        logger.warn("Function %s failed with ValueError: %s.", self.name, err)
+        if isinstance(err, PayloadTooLarge):
+            status = 413
+        elif isinstance(err, LengthRequired):
+            status = 411
+        else:
+            status = 400
+        return {"error": str(err)}, status
+
+    def validation_error(self, err):
+        logger.warn("Function %s failed with ValidationError: %s.", self.name, err)
+        return {"error": str(err)}, 422
+
+    def deadline_error(self):
+        logger.warn("Function %s failed as the deadline of the request was exceeded.", self.name)
+        return {"error": "Deadline exceeded"}, 504
+
+    def execution_error(self, err):
+        logger.error("Function %s failed with exception.", self.name, exc_info=True)
+        return {"error": "{}: {}".format(err.__class__.__name__, str(err))}, 500
+
+    def call_function(self, kwargs):
+        if self.batcher:
+            # all the calls in a batch must have the same arguments
+            kwargs = dict(self.plan.defaults, **kwargs)
+            return self.batcher.submit(kwargs)
+        elif self.executor:
+            return self.executor.call(kwargs)
+        elif self.is_coroutine:
+            return run_coroutine(self.function(**kwargs))
+        else:
+            return self.function(**kwargs)
+
+    def call_with_timeout(self, kwargs, timeout):
+        """Calls the function in a new thread and waits for it to finish for
+        at most timeout seconds.
+
+        Raises DeadlineExceeded when the function doesn't finish in time.
+        The function can't be stopped, so the thread is left to finish in
+        the background and its result is discarded. The thread keeps the
+        slots of the concurrency limits until it finishes, so that the
+        limits still bound the number of running calls.
+        """
+        state = dict(ctx.__dict__)
+        outcome = {}
+        lock = threading.Lock()
+        def target():
+            # the request context is available in the new thread as well
+            ctx.__dict__.update(state)
+            try:
+                outcome["result"] = self.call_function(kwargs)
+            except Exception as e:
+                outcome["error"] = e
+            finally:
+                with lock:
+                    outcome["done"] = True
+                    held = outcome.get("held", [])
+                for limiter in held:
+                    limiter.release()
+
+        thread = threading.Thread(target=target, name="firefly-" + self.name)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        with lock:
+            if not outcome.get("done"):
+                # the request releases its slots, these are for the thread
+                outcome["held"] = self.get_limiters()
+                for limiter in outcome["held"]:
+                    limiter.hold()
+                raise DeadlineExceeded()
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["result"]
 
     def get_inputs(self, request):
+        """Returns the arguments of the function from the request body and
+        the parameters in the path. The parameters in the path take
+        precedence over the arguments in the body.
+        """
+        routing_args = request.environ.get('wsgiorg.routing_args')
+        path_params = routing_args and routing_args[1]
+        if path_params and not request.content_length and 'HTTP_TRANSFER_ENCODING' not in request.environ:
+            # all the arguments are in the path
+            return dict(path_params)
+
+        kwargs = self.decode_inputs(request)
+        if path_params:
+            if not isinstance(kwargs, dict):
+                raise ValueError("The request body must be an object when the path has parameters")
+            kwargs.update(path_params)
+        return kwargs
+
+    def decode_inputs(self, request):
+        encoding = request.environ.get('HTTP_CONTENT_ENCODING', 'identity').strip().lower()
+        if encoding != 'identity':
+            request.body_file = DecompressedFile(request.body_file, encoding, max_size=self.get_max_decompressed_size())
+            del request.headers['Content-Encoding']
+
         content_type = self.get_content_type(request)
         if content_type == 'multipart/form-data':
             return self.get_multipart_formdata_inputs(request)
+        elif content_type == 'application/x-ndjson':
+            return self.get_streamed_inputs(request)
         else:
-            return json.loads(request.body.decode('utf-8'))
+            codec = get_binary_codecs().get(content_type, self.codec)
+            return codec.decode(read_body(request))
+
+    def get_max_decompressed_size(self):
+        """Returns the max size of the compressed request bodies after
+        decompressing them.
+        """
+        options = self.options.get("compression")
+        max_size = MAX_DECOMPRESSED_SIZE
+        if isinstance(options, dict):
+            max_size = options.get("max_decompressed_size", max_size)
+        upload_max_size = (self.options.get("upload") or {}).get("max_size")
+        if upload_max_size is not None:
+            max_size = min(max_size, upload_max_size)
+        return max_size
+
+    def get_streamed_inputs(self, request):
+        """Returns the inputs of a request with a newline-delimited JSON body.
+
+        The records in the body are passed to the function as a generator
+        in the argument named by the ``input_stream`` option, and they are
+        read from the request only as the function consumes them. The other
+        arguments are taken from the query string, as JSON values or strings.
+        """
+        param = self.options.get("input_stream")
+        if not param:
+            raise ValueError("Function {} does not accept streamed input".format(self.name))
+        # Without the Content-Length, the body can be read to the end only
+        # when the server de-chunks it and marks the end of the input, like
+        # gunicorn and the threaded server do. Other servers, like plain
+        # wsgiref, give an empty body.
+        environ = request.environ
+        if not environ.get('CONTENT_LENGTH') and not environ.get('wsgi.input_terminated'):
+            raise LengthRequired("The server doesn't support chunked requests, "
+                                 "the Content-Length of the request is required")
+
+        kwargs = {}
+        for name, value in request.GET.items():
+            try:
+                kwargs[name] = self.codec.decode(value.encode("utf-8"))
+            except ValueError:
+                kwargs[name] = value
+
+        decode = self.codec.decode
+        lines = iter_lines(request.body_file, self.options.get("chunk_size", 65536))
+        kwargs[param] = (decode(line) for line in lines if line.strip())
+        return kwargs
+
+    def get_response_codec(self, request, result):
+        """Returns the codec to encode the result with, based on the
+        Accept header of the request.
+        """
+        accept = request.environ.get('HTTP_ACCEPT')
+        if accept:
+            codecs = get_binary_codecs()
+            for content_type in parse_accept(accept):
+                if content_type in codecs and codecs[content_type].accepts(result):
+                    return codecs[content_type]
+                elif content_type in (self.codec.content_type, "*/*", "application/*"):
+                    break
+        return self.codec
 
     def get_content_type(self, request):
-        content_type = request.headers.get('Content-Type', 'application/octet-stream')
+        content_type = request.environ.get('CONTENT_TYPE') or 'application/octet-stream'
         return content_type.split(';')[0]
 
     def get_multipart_formdata_inputs(self, request):
-        d = {}
-        for name, value in request.POST.items():
-            if isinstance(value, cgi.FieldStorage):
-                value = value.file
-            d[name] = value
-        return d
-
-    def make_response(self, result, status=200):
-        if is_file(result):
-            response = Response(content_type='application/octet-stream')
-            response.app_iter = FileIter(result)
+        """Returns the inputs of a multipart/form-data request.
+
+        The uploaded files are passed to the function as file objects, which
+        are spooled to disk when they are larger than the ``spool_size`` of
+        the ``upload`` option.
+        """
+        content_type, params = parse_header(request.headers.get('Content-Type', ''))
+        if content_type != 'multipart/form-data':
+            # the url-encoded forms have no files
+            return dict(request.POST.items())
+        if not params.get('boundary'):
+            raise ValueError("Missing boundary in multipart/form-data request")
+
+        limits = self.options.get("upload") or {}
+        max_size = limits.get("max_size")
+        if max_size is not None and (request.content_length or 0) > max_size:
+            raise PayloadTooLarge("Request body is larger than {} bytes".format(max_size))
+
+        fields = parse_multipart(request.body_file, params['boundary'],
+                                 chunk_size=self.options.get("chunk_size", 65536), **limits)
+        return dict(fields)
+
+    def make_response(self, result, status=200, codec=None, request=None):
+        if isinstance(result, Response):
+            return result
+        elif is_file(result):
+            return self.make_file_response(result, request)
+        elif is_stream(result):
+            # generators are streamed as newline-delimited JSON
+            deadline = getattr(ctx, "deadline", None)
+            if deadline is not None:
+                result = iter_until(result, deadline)
+            response = Response(content_type='application/x-ndjson', charset=None)
+            response.app_iter = NDJSONIter(result, self.codec, self.options.get("chunk_size", 65536))
+            response.status = status
+            return response
+
+        # errors are always sent as JSON
+        if codec is not None and codec is not self.codec and status == 200:
+            try:
+                return Response(body=codec.encode(result), status=status,
+                                headerlist=[('Content-Type', codec.content_type)])
+            except OverflowError:
+                # the values that the binary codecs can't encode, like big
+                # integers, are sent as JSON
+                pass
+        # the headers are given directly, which is a lot faster than
+        # setting the content type
+        return Response(body=self.codec.encode(result), status=status,
+                        headerlist=[('Content-Type', 'application/json; charset=utf-8')])
+
+    def make_file_response(self, fileobj, request=None):
+        """Returns the response to send the contents of the file.
+
+        Regular files on disk are handed over to the ``wsgi.file_wrapper``
+        of the server, which may send them using sendfile. Other files are
+        read in chunks of ``chunk_size`` bytes. When the size of the file is
+        known, the Content-Length is set and a single byte range can be
+        requested using the Range header.
+        """
+        response = Response(content_type='application/octet-stream')
+        chunk_size = self.options.get("chunk_size", 1048576)
+        size = get_file_size(fileobj)
+        length = size
+        to_end = True
+
+        if size is not None:
+            response.headers['Accept-Ranges'] = 'bytes'
+            range_header = request and request.headers.get('Range')
+            if range_header:
+                try:
+                    byte_range = parse_range(range_header, size)
+                except ValueError:
+                    response.status = 416
+                    response.headers['Content-Range'] = 'bytes */{}'.format(size)
+                    response.body = b''
+                    fileobj.close()
+                    return response
+                if byte_range is not None:
+                    start, end = byte_range
+                    fileobj.seek(fileobj.tell() + start)
+                    length = end - start + 1
+                    to_end = end == size - 1
+                    response.status = 206
+                    response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+
+        file_wrapper = request and request.environ.get('wsgi.file_wrapper')
+        # The file wrapper sends everything to the end of the file, so it
+        # can be used only when the response extends to the end.
+        if file_wrapper and to_end and is_os_file(fileobj):
+            # sync the position of the file descriptor with the file object
+            fileobj.seek(fileobj.tell())
+            response.app_iter = file_wrapper(fileobj, chunk_size)
         else:
-            response = Response(content_type='application/json',
-                                charset='utf-8')
-            response.text = json_encode(result)
-        response.status = status
+            response.app_iter = FileIter(fileobj, chunk_size, limit=length)
+        # setting the app_iter resets the content length
+        if length is not None:
+            response.content_length = length
         return response
 
     def generate_signature(self, f):
@@ -0,0 +1,235 @@
+"""ASGI interface to the firefly applications.
+
+The ASGI application serves the same functions as the WSGI application.
+The ``async def`` functions are awaited on the event loop, so that many
+I/O-bound calls can be in flight at the same time. All other requests,
+including the calls to regular functions, are handled exactly as in the
+WSGI application, in a bounded thread pool. The concurrency limits apply to
+both, the requests waiting for a slot wait in the thread pool.
+
+This module requires Python 3.5 or above.
+
+    app = Firefly()
+    ...
+    asgi_app = app.asgi()
+
+Note that the request-local ``ctx`` is thread-local and is not available
+to the ``async def`` functions.
+"""
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from webob import Request
+from .app import HTTPError
+from .limits import release_after
+from .metrics import clock
+from .validator import ValidationError
+
+class ASGIApp:
+    """ASGI application wrapping a Firefly app.
+
+    :param app: the :class:`firefly.app.Firefly` app
+    :param max_threads: the max number of threads to run the regular
+        functions in
+    """
+    def __init__(self, app, max_threads=32):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=max_threads)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            await self.handle_http(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self.handle_lifespan(scope, receive, send)
+
+    async def handle_lifespan(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def handle_http(self, scope, receive, send):
+        body = await self.read_body(receive)
+        request = Request(make_environ(scope, body))
+        response = await self.process_request(request)
+        await self.send_response(send, response)
+
+    async def process_request(self, request):
+        func = self.app.match_route(request)
+        if func is not None and func.is_coroutine:
+            response = self.app.check_request(request)
+            if response is None:
+                func.metrics.inc("firefly_requests_in_flight")
+                start = clock()
+                try:
+                    response = await self.call_limited(func, request, func.get_limiters())
+                finally:
+                    func.metrics.inc("firefly_requests_in_flight", value=-1)
+                    func.record_request(request, response, clock() - start)
+                response.headerlist += self.app._prepare_cors_headers()
+            return response
+        else:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.executor, self.app.process_request, request)
+
+    async def call_limited(self, func, request, limiters):
+        # same as FireflyFunction.call_limited, but awaits the function
+        if not limiters:
+            return await self.call_async_function(func, request)
+        limiter = limiters[0]
+        if not await self.acquire(limiter):
+            return func.overloaded_response(limiter)
+        try:
+            response = await self.call_limited(func, request, limiters[1:])
+        except BaseException:
+            limiter.release()
+            raise
+        return release_after(response, limiter.release)
+
+    async def acquire(self, limiter):
+        """Takes a slot of the limiter without blocking the event loop.
+
+        The requests that have to wait for a slot wait in the thread pool,
+        of which the queue of the limiter takes at most max_queue threads.
+        """
+        if limiter.try_acquire():
+            return True
+        future = asyncio.get_event_loop().run_in_executor(self.executor, limiter.acquire)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            # the slot is released when the request is gone before getting it
+            future.add_done_callback(lambda f: not f.cancelled() and f.result() and limiter.release())
+            raise
+
+    async def call_async_function(self, func, request):
+        # same as FireflyFunction.__call__, but awaits the function
+        try:
+            deadline = func.get_deadline(request)
+            kwargs = func.get_inputs(request)
+        except ValueError as err:
+            return func.make_response(*func.input_error(err))
+
+        cache_key = func.get_cache_key(request, kwargs)
+        if cache_key is not None:
+            cached = func.cache.get(cache_key)
+            if cached is not None:
+                return func.compress_response(request, func.make_cached_response(cached))
+
+        try:
+            result, status = await self.invoke(func, kwargs, deadline)
+        except HTTPError as e:
+            return e.get_response()
+        response = func.make_response(result, status=status, codec=func.get_response_codec(request, result))
+        response = func.compress_response(request, response)
+        if cache_key is not None:
+            func.cache_response(cache_key, result, status, response)
+        return response
+
+    async def invoke(self, func, kwargs, deadline=None):
+        # same as FireflyFunction.invoke, but awaits the function
+        t0 = clock()
+        try:
+            func.plan.validate(kwargs)
+        except ValidationError as err:
+            return func.validation_error(err)
+        t1 = clock()
+        func.metrics.observe("firefly_phase_duration_seconds", (("phase", "validate"),), t1 - t0)
+
+        remaining = None if deadline is None else deadline - clock()
+        if remaining is not None and remaining <= 0:
+            return func.deadline_error()
+
+        try:
+            result = await asyncio.wait_for(func.function(**kwargs), remaining)
+        except HTTPError:
+            raise
+        except asyncio.TimeoutError:
+            return func.deadline_error()
+        except Exception as err:
+            return func.execution_error(err)
+        finally:
+            func.metrics.observe("firefly_phase_duration_seconds", (("phase", "execute"),), clock() - t1)
+        return result, 200
+
+    async def read_body(self, receive):
+        chunks = []
+        more_body = True
+        while more_body:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            more_body = message.get("more_body", False)
+        return b"".join(chunks)
+
+    async def send_response(self, send, response):
+        headers = [(name.encode("latin-1"), value.encode("latin-1"))
+                   for name, value in response.headerlist]
+        await send({
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": headers
+        })
+
+        app_iter = response.app_iter
+        if isinstance(app_iter, (list, tuple)):
+            await send({"type": "http.response.body", "body": b"".join(app_iter)})
+            return
+
+        # streaming responses are iterated in the thread pool as reading
+        # the chunks may block
+        loop = asyncio.get_event_loop()
+        iterator = iter(app_iter)
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self.executor, next, iterator, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+        await send({"type": "http.response.body", "body": b""})
+
+def make_environ(scope, body):
+    """Creates a WSGI environ from the ASGI scope and the request body.
+    """
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client")
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0] if client else "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1")
+        value = value.decode("latin-1")
+        if name == "content-type":
+            environ["CONTENT_TYPE"] = value
+        elif name == "content-length":
+            continue
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+            if key in environ:
+                value = environ[key] + "," + value
+            environ[key] = value
+    # the body is already read in full, even when it was sent chunked
+    environ["CONTENT_LENGTH"] = str(len(body))
+    return environ
@@ -0,0 +1,303 @@
+"""Client to call the firefly functions from asyncio code.
+
+The :class:`AsyncClient` works just like :class:`firefly.client.Client`, but
+the calls to the remote functions are coroutines:
+
+    >>> async with AsyncClient("http://127.0.0.1:8000/") as client:
+    ...     results = await asyncio.gather(*[client.square(n=i) for i in range(1000)])
+
+The requests are sent using aiohttp, which must be installed separately.
+This module requires Python 3.6 or above.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import time
+from .client import Client, FireflyError, NotFoundError, RETRY_STATUS_CODES, TIMEOUT_HEADER, TIMEOUT_GRACE
+from .compression import get_encodings
+from .utils import is_stream, NDJSONIter
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger(__name__)
+
+class AsyncClient(Client):
+    """Client to a firefly server for asyncio code.
+
+    Takes the same arguments as :class:`firefly.client.Client`. At most
+    pool_size requests are sent at a time, the other calls wait for a
+    connection to be available, so any number of calls can be gathered.
+
+    The client must be closed using ``await client.close()`` or used as an
+    async context manager.
+    """
+    def __init__(self, server_url, *args, **kwargs):
+        if aiohttp is None:
+            raise ImportError("aiohttp is required to use the AsyncClient. Please install it using: pip install aiohttp")
+        Client.__init__(self, server_url, *args, **kwargs)
+        self._metadata_lock = None
+
+    def _create_session(self, pool_size, retries, backoff_factor):
+        # the aiohttp session is created in the event loop, on first use
+        self.pool_size = pool_size
+        return None
+
+    def _get_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                # the responses are decoded by aiohttp
+                headers={'Accept-Encoding': ", ".join(get_encodings())},
+                timeout=aiohttp.ClientTimeout(total=None))
+        return self.session
+
+    def _create_remote_function(self, func_name):
+        return AsyncRemoteFunction(self, func_name)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        """Closes all the connections kept open by the client.
+        """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _get_metadata(self):
+        # the metadata is fetched by the coroutines before it is used
+        return self._metadata or {}
+
+    async def _fetch_metadata(self):
+        if self._metadata_lock is None:
+            self._metadata_lock = asyncio.Lock()
+        # the concurrent calls wait for the first one to fetch the metadata
+        async with self._metadata_lock:
+            metadata, cached = self._check_metadata()
+            if metadata is not None:
+                return metadata
+            url = self.server_url + "/"
+            headers = self._get_metadata_headers(cached)
+            try:
+                async with self._get_session().get(url, headers=headers, timeout=self._get_timeout(self.timeout)) as response:
+                    content = await response.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                raise FireflyError('Unable to connect to the server, please try again later.')
+            return self._update_metadata(response.status, response.headers, content, cached)
+
+    def _get_timeout(self, timeout):
+        return aiohttp.ClientTimeout(total=timeout)
+
+    async def call_func(self, func_name, **kwargs):
+        await self._fetch_metadata()
+        # finds the path and returns the coroutine of self.request
+        return await Client.call_func(self, func_name, **kwargs)
+
+    async def request(self, _path, _timeout=None, **kwargs):
+        await self._fetch_metadata()
+        url = self.server_url + _path
+        headers = self.prepare_headers()
+        data, files = self.decouple_files(kwargs)
+        streams = [arg for arg, value in data.items() if is_stream(value)]
+        body = None
+        params = None
+        if files:
+            payload = self.make_form(data, files)
+        elif streams:
+            params, payload = self.make_stream(data, streams, headers)
+        else:
+            codec, body = self.encode_request(data)
+            headers['Content-Type'] = codec.content_type
+            headers['Accept'] = self.get_accept_header()
+            body = payload = self.compress_body(body, headers)
+
+        timeout = _timeout if _timeout is not None else self.timeout
+        deadline = timeout and time.time() + timeout
+        session = self._get_session()
+
+        for attempt in itertools.count():
+            t0 = time.time()
+            if deadline:
+                remaining = deadline - t0
+                if remaining <= 0:
+                    raise FireflyError("Deadline exceeded")
+                headers[TIMEOUT_HEADER] = "{:.3f}".format(remaining)
+                timeout = remaining + TIMEOUT_GRACE
+            try:
+                response = await session.post(url, data=payload, params=params,
+                                              headers=headers, timeout=self._get_timeout(timeout))
+            except asyncio.TimeoutError:
+                raise FireflyError("Deadline exceeded")
+            except aiohttp.ClientConnectionError:
+                raise FireflyError('Unable to connect to the server, please try again later.')
+            finally:
+                t1 = time.time()
+                logger.info("%0.3f: POST %s", t1-t0, url)
+
+            # the files and the streams are consumed by the first attempt
+            if (response.status in RETRY_STATUS_CODES and attempt < self.retries
+                    and body is not None):
+                delay = self.get_retry_delay(response, attempt)
+                if deadline and t1 + delay >= deadline:
+                    return await self.handle_response(response)
+                logger.info("server is overloaded, retrying in %0.3f seconds", delay)
+                response.release()
+                await asyncio.sleep(delay)
+                continue
+            return await self.handle_response(response)
+
+    def make_form(self, data, files):
+        """Returns the multipart/form-data body with the files.
+        """
+        form = aiohttp.FormData()
+        for name, value in data.items():
+            form.add_field(name, str(value))
+        for name, fileobj in files.items():
+            form.add_field(name, fileobj, filename=os.path.basename(getattr(fileobj, "name", name)))
+        return form
+
+    def make_stream(self, data, streams, headers):
+        """Returns the query string parameters and the newline-delimited
+        JSON body to send the items of the iterator argument.
+        """
+        if len(streams) > 1:
+            raise FireflyError("Only one argument can be streamed, found: {}".format(", ".join(streams)))
+        items = data.pop(streams[0])
+        params = {arg: self.codec.encode(value).decode("utf-8") for arg, value in data.items()}
+        headers['Content-Type'] = 'application/x-ndjson'
+        headers['Accept'] = self.get_accept_header()
+
+        async def body():
+            for chunk in NDJSONIter(items, self.codec):
+                yield chunk
+        return params, body()
+
+    async def batch(self, calls, return_exceptions=False):
+        """Calls multiple functions in a single request.
+
+        See :meth:`firefly.client.Client.batch`.
+        """
+        items = [{"function": func_name, "kwargs": kwargs} for func_name, kwargs in calls]
+        results = await self.request("/_batch", calls=items)
+        return [self._get_batch_result(item, return_exceptions) for item in results]
+
+    async def map(self, func_name, kwargs_list, return_exceptions=False, workers=None, chunk_size=100):
+        """Calls the function with each of the kwargs and returns the results
+        in the same order.
+
+        See :meth:`firefly.client.Client.map`.
+        """
+        chunks = self._split_chunks(kwargs_list, chunk_size)
+        if not chunks:
+            return []
+        await self._fetch_metadata()
+        semaphore = asyncio.Semaphore(workers or self.pool_size)
+
+        async def call_chunk(chunk):
+            async with semaphore:
+                return await self._map_chunk(func_name, chunk)
+        results = await asyncio.gather(*[call_chunk(chunk) for chunk in chunks])
+        return self._get_map_results(results, return_exceptions)
+
+    async def _map_chunk(self, func_name, chunk):
+        # same as Client._map_chunk, but awaits the calls
+        if self._batch_supported is not False:
+            try:
+                results = await self.batch([(func_name, kwargs) for kwargs in chunk], return_exceptions=True)
+                self._batch_supported = True
+                return results
+            except NotFoundError as e:
+                if self._batch_supported:
+                    return [e] * len(chunk)
+                logger.info("the server has no batch endpoint, sending the calls one by one")
+                self._batch_supported = False
+            except Exception as e:
+                return [e] * len(chunk)
+
+        results = []
+        for kwargs in chunk:
+            try:
+                results.append(await self.call_func(func_name, **kwargs))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    async def handle_response(self, response):
+        # 206 is the response to a request for a range of a file
+        if response.status in (200, 206):
+            return await self.decode_response(response)
+        try:
+            content = await response.read()
+        finally:
+            response.release()
+        content_type = response.headers.get("Content-Type", "").split(";")[0]
+        if content_type == "application/json":
+            error = self.decode_error(content)
+        else:
+            error = content.decode("utf-8", "replace")
+        raise self.make_error(response.status, error)
+
+    async def decode_response(self, response):
+        """Returns the result in the response.
+
+        The files are returned as the aiohttp stream of the response body
+        and the streamed results as an async iterator.
+        """
+        content_type = response.headers.get("Content-Type", "").split(";")[0]
+        if content_type == "application/octet-stream":
+            return response.content
+        elif content_type == "application/x-ndjson":
+            return self.iter_ndjson(response)
+        try:
+            content = await response.read()
+        finally:
+            response.release()
+        codec = self.get_binary_codecs().get(content_type, self.codec)
+        return codec.decode(content)
+
+    async def iter_ndjson(self, response):
+        """Returns an async iterator over the items of a streamed response.
+        """
+        buffer = b""
+        try:
+            async for chunk in response.content.iter_any():
+                lines = (buffer + chunk).split(b"\n")
+                buffer = lines.pop()
+                for line in lines:
+                    if line.strip():
+                        yield self.codec.decode(line)
+            if buffer.strip():
+                yield self.codec.decode(buffer)
+        except aiohttp.ClientError as e:
+            raise FireflyError("The response stream was interrupted: {}".format(e))
+        finally:
+            response.release()
+
+class AsyncRemoteFunction(object):
+    """Remote function of an AsyncClient, which is called as a coroutine.
+    """
+    def __init__(self, client, func_name):
+        self.client = client
+        self.__name__ = func_name
+        self.__qualname__ = func_name
+
+    async def __call__(self, *args, **kwargs):
+        if args:
+            raise FireflyError('Firefly functions only accept named arguments')
+        return await self.client.call_func(self.__name__, **kwargs)
+
+    async def map(self, kwargs_list, return_exceptions=False, workers=None, chunk_size=100):
+        return await self.client.map(self.__name__, kwargs_list, return_exceptions=return_exceptions,
+                                     workers=workers, chunk_size=chunk_size)
+
+    @property
+    def __doc__(self):
+        # the function may be created before the metadata is fetched
+        return self.client.get_doc(self.__name__)
@@ -0,0 +1,89 @@
+"""Dynamic micro-batching of concurrent calls to vectorized functions.
+"""
+import threading
+
+class MicroBatcher(object):
+    """Coalesces concurrent calls to a vectorized function into a single call.
+
+    A vectorized function takes a list of values for each argument and
+    returns a sequence with one result for each position. The calls
+    submitted from different threads are buffered for at most ``max_wait_ms``
+    milliseconds or until ``max_size`` calls are collected, and then the
+    function is called once with all of them.
+
+    Only the calls with the same set of arguments are batched together.
+
+    :param function: the vectorized function
+    :param max_size: the max number of calls in a batch
+    :param max_wait_ms: the max time to wait for a batch to fill up
+    """
+    def __init__(self, function, max_size=64, max_wait_ms=5):
+        self.function = function
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def submit(self, kwargs):
+        """Calls the function with kwargs as part of a batch and returns
+        the result for this call.
+
+        The exception raised by the function is raised in every call of
+        the batch.
+        """
+        key = tuple(sorted(kwargs))
+        with self.lock:
+            batch = self.pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = self.pending[key] = Batch(key)
+            index = batch.add(kwargs)
+            if len(batch) >= self.max_size:
+                del self.pending[key]
+                batch.full.set()
+
+        if leader:
+            # The first call of the batch waits for more calls to come in
+            # and then runs the function for everyone.
+            batch.full.wait(self.max_wait)
+            with self.lock:
+                if self.pending.get(key) is batch:
+                    del self.pending[key]
+            batch.run(self.function)
+        else:
+            batch.done.wait()
+        return batch.get_result(index)
+
+class Batch(object):
+    def __init__(self, keys):
+        self.keys = keys
+        self.calls = []
+        self.results = None
+        self.error = None
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+    def __len__(self):
+        return len(self.calls)
+
+    def add(self, kwargs):
+        self.calls.append(kwargs)
+        return len(self.calls) - 1
+
+    def run(self, function):
+        try:
+            kwargs = {k: [call[k] for call in self.calls] for k in self.keys}
+            results = function(**kwargs)
+            if len(results) != len(self.calls):
+                raise ValueError("Expected {} results from the batched call, got {}".format(
+                    len(self.calls), len(results)))
+            self.results = results
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    def get_result(self, index):
+        if self.error is not None:
+            raise self.error
+        return self.results[index]
@@ -0,0 +1,102 @@
+"""Cache of the encoded responses of the pure functions.
+"""
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+class ResultCache(object):
+    """Thread-safe LRU cache with an optional time-to-live for the entries.
+
+    The cache is bounded by the number of entries and optionally by the
+    total size of the values, as given when they are added.
+
+    :param max_entries: the max number of entries in the cache
+    :param ttl: the number of seconds after which an entry expires
+    :param max_bytes: the max total size of the values
+    """
+    def __init__(self, max_entries=1024, ttl=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Returns the value of the key or None when it is not in the cache
+        or has expired.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires_at, size = entry
+            if expires_at is not None and expires_at < time.time():
+                self.size -= size
+                self.misses += 1
+                return None
+
+            # move to the end as the most recently used entry
+            self.entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=0):
+        """Adds the value to the cache, evicting the least recently used
+        entries if required.
+
+        :param size: the size of the value in bytes
+        """
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires_at = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            self.entries[key] = (value, expires_at, size)
+            self.size += size
+            while (len(self.entries) > self.max_entries
+                    or (self.max_bytes is not None and self.size > self.max_bytes)):
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= evicted[2]
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+def _default(obj):
+    # numpy arrays are identified by their type, shape and data
+    if hasattr(obj, "dtype") and hasattr(obj, "tobytes"):
+        return {"__ndarray__": [str(obj.dtype), list(obj.shape), hashlib.sha1(obj.tobytes()).hexdigest()]}
+    if isinstance(obj, bytes):
+        return {"__bytes__": hashlib.sha1(obj).hexdigest()}
+    raise TypeError("Object of type {} can not be used as a cache key".format(type(obj).__name__))
+
+def make_key(kwargs):
+    """Returns a canonical hash of the kwargs, or None when the kwargs
+    can't be used as a cache key, for example when they have files.
+    """
+    try:
+        data = json.dumps(kwargs, sort_keys=True, separators=(",", ":"), default=_default)
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
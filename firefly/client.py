@@ -1,41 +1,275 @@
 import requests
 from requests import ConnectionError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from .validator import ValidationError
+from .codecs import get_json_codec, get_binary_codecs, MsgpackCodec
+from .utils import is_stream, NDJSONIter
+from .compression import get_encodings, compress
+from .routing import build_path
+import hashlib
+import itertools
+from multiprocessing.pool import ThreadPool
+import json
 import logging
+import os
+import random
 import time
 
 logger = logging.getLogger(__name__)
 
+# the status codes of the requests rejected by an overloaded server
+RETRY_STATUS_CODES = (429, 503)
+MAX_RETRY_DELAY = 60
+
+# the header to send the timeout of the call to the server
+TIMEOUT_HEADER = "X-Firefly-Timeout"
+TIMEOUT_GRACE = 0.5
+
+def get_default_cache_dir():
+    """Returns the directory to keep the metadata of the servers in, which
+    is ``$FIREFLY_CACHE_DIR`` or ``~/.cache/firefly``.
+    """
+    cache_dir = os.getenv("FIREFLY_CACHE_DIR")
+    if not cache_dir:
+        base = os.getenv("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        cache_dir = os.path.join(base, "firefly")
+    return cache_dir
+
 class Client:
-    def __init__(self, server_url, auth_token=None):
+    def __init__(self, server_url, auth_token=None, pool_size=10, retries=0, backoff_factor=0.1,
+                 metadata_ttl=None, codec=None, binary=True, compress_min_size=1024, timeout=None,
+                 metadata_cache=None):
+        """Creates a client to a firefly server.
+
+        The client keeps a pool of persistent connections to the server, which
+        is reused across calls. Call :meth:`close` or use the client as a
+        context manager to release the connections.
+
+        :param server_url: the url of the firefly server
+        :param auth_token: the auth token, if the server requires one
+        :param pool_size: the max number of connections to keep open
+        :param retries: the number of times to retry when connecting to the server
+            fails or the server rejects the request as it is overloaded
+        :param backoff_factor: the backoff factor between the retries, in seconds
+        :param metadata_ttl: the number of seconds after which the function
+            metadata is fetched again from the server. It is fetched only once
+            by default. See :meth:`refresh`.
+        :param compress_min_size: the min size of the request bodies that are
+            sent compressed, when the server supports it. None to never
+            compress the requests.
+        :param timeout: the default number of seconds to wait for a call to
+            finish. It is sent to the server, which gives up on the call once
+            the time is up. The timeout of a single call can be given using
+            the ``_timeout`` argument.
+        :param metadata_cache: the directory to keep the function metadata in
+            between the runs of the process, or True to use the default
+            directory. The metadata on disk is used without contacting the
+            server while it is within the ``metadata_ttl`` and is revalidated
+            with the server after that. See :func:`get_default_cache_dir`.
+        """
         # strip trailing / to avoid double / chars in the URL
         self.server_url = server_url.rstrip("/")
         self.auth_token = auth_token
+        self.metadata_ttl = metadata_ttl
+        self.codec = get_json_codec(codec) if codec is None or isinstance(codec, str) else codec
+        self.binary = binary
+        self.compress_min_size = compress_min_size
+        self.timeout = timeout
+        self.metadata_cache = get_default_cache_dir() if metadata_cache is True else metadata_cache
         self._metadata = None
+        self._metadata_time = None
+        self._metadata_etag = None
+        # the metadata on disk is used without revalidating it only the
+        # first time, not after a refresh
+        self._metadata_fetched = False
+        # None until a batch is sent, False if the server has no batch endpoint
+        self._batch_supported = None
+        self._functions = {}
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.session = self._create_session(pool_size, retries, backoff_factor)
 
     def __getattr__(self, func_name):
+        # private and special attributes are never remote functions
+        if func_name.startswith("_"):
+            raise AttributeError(func_name)
+        func = self._functions.get(func_name)
+        if func is None:
+            func = self._functions[func_name] = self._create_remote_function(func_name)
+        return func
+
+    def _create_remote_function(self, func_name):
         return RemoteFunction(self, func_name)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _create_session(self, pool_size, retries, backoff_factor):
+        self.pool_size = pool_size
+        # Only the failures to establish a connection are retried as the
+        # request would not have reached the server in that case.
+        retry = Retry(total=retries, connect=retries, read=False, status=False,
+                      redirect=False, backoff_factor=backoff_factor)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        # the responses are decoded by requests
+        session.headers['Accept-Encoding'] = ", ".join(get_encodings())
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def refresh(self):
+        """Discards the function metadata and the remote functions resolved
+        so far, so that they are fetched again from the server on next use.
+        """
+        self._metadata = None
+        self._metadata_time = None
+        self._functions.clear()
+
+    def close(self):
+        """Closes all the connections kept open by the client.
+        """
+        self.session.close()
+
     def call_func(self, func_name, **kwargs):
         path = self._get_path(func_name)
+        if "{" in path:
+            # the arguments in the path are sent as part of the url
+            try:
+                path, kwargs = build_path(path, kwargs)
+            except KeyError as e:
+                raise ValidationError("missing a required argument: '{}'".format(e.args[0]))
         return self.request(path, **kwargs)
 
-    def request(self, _path, **kwargs):
+    def request(self, _path, _timeout=None, **kwargs):
         url = self.server_url + _path
-        t0 = time.time()
+        headers = self.prepare_headers()
+        data, files = self.decouple_files(kwargs)
+        streams = [arg for arg, value in data.items() if is_stream(value)]
+        body = None
+        if not files and not streams:
+            codec, body = self.encode_request(data)
+            headers['Content-Type'] = codec.content_type
+            headers['Accept'] = self.get_accept_header()
+            body = self.compress_body(body, headers)
+
+        timeout = _timeout if _timeout is not None else self.timeout
+        deadline = timeout and time.time() + timeout
+
+        for attempt in itertools.count():
+            t0 = time.time()
+            if deadline:
+                # the retries get only the time left
+                remaining = deadline - t0
+                if remaining <= 0:
+                    raise FireflyError("Deadline exceeded")
+                headers[TIMEOUT_HEADER] = "{:.3f}".format(remaining)
+                # the server responds with 504 once the time is up, the grace
+                # period gives that response time to arrive
+                timeout = remaining + TIMEOUT_GRACE
+            try:
+                if files:
+                    response = self.session.post(url, data=data, files=files, headers=headers,
+                                                 stream=True, timeout=timeout)
+                elif streams:
+                    response = self.post_stream(url, data, streams, headers, timeout=timeout)
+                else:
+                    response = self.session.post(url, data=body, headers=headers, stream=True, timeout=timeout)
+            except requests.Timeout:
+                raise FireflyError("Deadline exceeded")
+            except ConnectionError:
+                raise FireflyError('Unable to connect to the server, please try again later.')
+            finally:
+                t1 = time.time()
+                logger.info("%0.3f: POST %s", t1-t0, url)
+
+            # the files and the streams are consumed by the first attempt
+            if (response.status_code in RETRY_STATUS_CODES and attempt < self.retries
+                    and body is not None):
+                delay = self.get_retry_delay(response, attempt)
+                if deadline and t1 + delay >= deadline:
+                    return self.handle_response(response)
+                logger.info("server is overloaded, retrying in %0.3f seconds", delay)
+                response.close()
+                time.sleep(delay)
+                continue
+            return self.handle_response(response)
+
+    def get_retry_delay(self, response, attempt):
+        """Returns the number of seconds to wait before retrying a request
+        rejected by an overloaded server.
+
+        The Retry-After header of the response is used when present, and
+        an exponential backoff otherwise. A random jitter is added, so that
+        the clients rejected together don't retry together.
+        """
         try:
-            headers = self.prepare_headers()
-            data, files = self.decouple_files(kwargs)
-            if files:
-                response = requests.post(url, data=data, files=files, headers=headers, stream=True)
-            else:
-                response = requests.post(url, json=data, headers=headers, stream=True)
-        except ConnectionError:
-            raise FireflyError('Unable to connect to the server, please try again later.')
-        finally:
-            t1 = time.time()
-            logger.info("%0.3f: POST %s", t1-t0, url)
-        return self.handle_response(response)
+            delay = float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            delay = self.backoff_factor * (2 ** attempt)
+        return min(delay, MAX_RETRY_DELAY) * random.uniform(1, 1.5)
+
+    def post_stream(self, url, data, streams, headers, timeout=None):
+        """Sends the items of the iterator argument as a newline-delimited
+        JSON body, using chunked transfer encoding. The other arguments are
+        sent in the query string.
+        """
+        if len(streams) > 1:
+            raise FireflyError("Only one argument can be streamed, found: {}".format(", ".join(streams)))
+        items = data.pop(streams[0])
+        params = {arg: self.codec.encode(value) for arg, value in data.items()}
+        headers['Content-Type'] = 'application/x-ndjson'
+        headers['Accept'] = self.get_accept_header()
+        body = NDJSONIter(items, self.codec)
+        return self.session.post(url, params=params, data=iter(body), headers=headers, stream=True, timeout=timeout)
+
+    def compress_body(self, body, headers):
+        """Compresses the request body using gzip, when it is large enough
+        and the server accepts compressed requests.
+        """
+        if self.compress_min_size is None or len(body) < self.compress_min_size:
+            return body
+        if "gzip" not in self._get_metadata().get("content_encodings", []):
+            return body
+        headers['Content-Encoding'] = 'gzip'
+        return compress(body, "gzip")
+
+    def get_binary_codecs(self):
+        """Returns the binary codecs supported by both the client and the
+        server, as a dict with the content type as key.
+        """
+        if not self.binary:
+            return {}
+        server_types = self._get_metadata().get("content_types", [])
+        return {content_type: codec for content_type, codec in get_binary_codecs().items()
+                if content_type in server_types}
+
+    def get_request_codec(self, data):
+        codecs = self.get_binary_codecs()
+        for codec in codecs.values():
+            if codec.content_type != MsgpackCodec.content_type and codec.accepts(data):
+                return codec
+        return codecs.get(MsgpackCodec.content_type, self.codec)
+
+    def encode_request(self, data):
+        """Returns the codec for the request body and the data encoded
+        with it.
+        """
+        codec = self.get_request_codec(data)
+        try:
+            return codec, codec.encode(data)
+        except OverflowError:
+            # the values that the binary codecs can't encode, like big
+            # integers, are sent as JSON
+            return self.codec, self.codec.encode(data)
+
+    def get_accept_header(self):
+        content_types = [codec.content_type for codec in self.get_binary_codecs().values()]
+        return ", ".join(content_types + [self.codec.content_type])
 
     def prepare_headers(self):
         """Prepares headers for sending a request to the firefly server.
@@ -47,26 +281,110 @@ class Client:
 
 
     def _get_path(self, func_name):
-        functions = self._metadata.get('functions', {})
+        functions = self._get_metadata().get('functions', {})
         func_info = functions.get(func_name) or {"path": "/" + func_name}
         return func_info["path"]
 
     def _get_metadata(self):
+        metadata, cached = self._check_metadata()
+        if metadata is not None:
+            return metadata
         try:
-            if self._metadata is None:
-                url = self.server_url + "/"
-                headers = self.prepare_headers()
-                response = requests.get(url, headers=headers)
-
-                if response.status_code == 200:
-                    self._metadata = response.json()
-                else:
-                    raise FireflyError(
-                        "Failed to contact the server (http status code {}).".format(
-                            response.status_code))
-            return self._metadata
-        except ConnectionError as err:
+            url = self.server_url + "/"
+            headers = self._get_metadata_headers(cached)
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+        except (ConnectionError, requests.Timeout) as err:
             raise FireflyError('Unable to connect to the server, please try again later.')
+        return self._update_metadata(response.status_code, response.headers, response.content, cached)
+
+    def _check_metadata(self):
+        """Returns the metadata when it can be used without contacting the
+        server, and the metadata and the etag to revalidate otherwise.
+        """
+        if self._metadata is not None and not self._is_metadata_expired():
+            return self._metadata, None
+
+        if self._metadata is not None:
+            # the expired metadata is revalidated, along with its etag
+            cached = (self._metadata, self._metadata_etag)
+            self.refresh()
+        else:
+            entry = self._load_cached_metadata()
+            cached = entry and (entry["metadata"], entry.get("etag"))
+            if (entry and not self._metadata_fetched and self.metadata_ttl is not None
+                    and time.time() - entry["time"] <= self.metadata_ttl):
+                self._metadata, self._metadata_etag = cached
+                self._metadata_time = entry["time"]
+                self._metadata_fetched = True
+                return self._metadata, None
+        return None, cached
+
+    def _get_metadata_headers(self, cached):
+        headers = self.prepare_headers()
+        if cached and cached[1]:
+            headers['If-None-Match'] = cached[1]
+        return headers
+
+    def _update_metadata(self, status_code, headers, content, cached):
+        if status_code == 304 and cached:
+            metadata, etag = cached
+        elif status_code == 200:
+            metadata = self.codec.decode(content)
+            etag = headers.get("ETag")
+        else:
+            raise FireflyError(
+                "Failed to contact the server (http status code {}).".format(
+                    status_code))
+        self._metadata = metadata
+        self._metadata_etag = etag
+        self._metadata_time = time.time()
+        self._metadata_fetched = True
+        self._save_cached_metadata()
+        return self._metadata
+
+    def _is_metadata_expired(self):
+        return self.metadata_ttl is not None and time.time() - self._metadata_time > self.metadata_ttl
+
+    def _get_metadata_cache_path(self):
+        key = hashlib.sha1(self.server_url.encode("utf-8")).hexdigest()
+        return os.path.join(self.metadata_cache, key + ".json")
+
+    def _load_cached_metadata(self):
+        """Returns the metadata of the server kept on disk, as a dict with
+        the metadata, the etag and the time it was fetched, or None.
+        """
+        if not self.metadata_cache:
+            return None
+        try:
+            with open(self._get_metadata_cache_path()) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(entry, dict) or entry.get("server_url") != self.server_url:
+            return None
+        return entry
+
+    def _save_cached_metadata(self):
+        if not self.metadata_cache:
+            return
+        entry = {
+            "server_url": self.server_url,
+            "metadata": self._metadata,
+            "etag": self._metadata_etag,
+            "time": self._metadata_time
+        }
+        path = self._get_metadata_cache_path()
+        try:
+            if not os.path.isdir(self.metadata_cache):
+                os.makedirs(self.metadata_cache)
+            # written to a temporary file first, so that the other processes
+            # never read a partial file
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, "w") as f:
+                json.dump(entry, f)
+            getattr(os, "replace", os.rename)(tmp_path, path)
+        except (IOError, OSError, TypeError, ValueError) as err:
+            logger.warning("Failed to save the metadata of %s to %s: %s", self.server_url, path, err)
 
     def get_doc(self, func_name):
         metadata = self._get_metadata().get("functions", {})
@@ -81,39 +399,174 @@ class Client:
         return hasattr(value, 'read') or hasattr(value, 'readlines')
 
     def handle_response(self, response):
-        if response.status_code == 200:
+        # 206 is the response to a request for a range of a file
+        if response.status_code in (200, 206):
             return self.decode_response(response)
-        elif response.status_code == 400:
-            try:
-                error = response.json()["error"]
-            except (KeyError, ValueError):
-                error = "Bad Request"
-            raise ValueError(error)
-        elif response.status_code == 403:
-            raise FireflyError("Authorization token mismatch.")
-        elif response.status_code == 404:
-            raise FireflyError("Requested function not found")
-        elif response.status_code == 422:
-            raise ValidationError(response.json()["error"])
-        elif response.status_code == 500:
-            if response.headers["Content-Type"] == "application/json":
-                raise FireflyError(response.json()["error"])
-            else:
-                raise FireflyError(response.text)
         else:
-            raise FireflyError("Oops! Something really bad happened")
+            raise self.make_error(response.status_code, self.get_error_message(response))
+
+    def get_error_message(self, response):
+        content_type = response.headers.get("Content-Type", "").split(";")[0]
+        if content_type == "application/json":
+            return self.decode_error(response.content)
+        else:
+            return response.text
+
+    def decode_error(self, content):
+        """Returns the error message in a JSON error response.
+        """
+        try:
+            return self.codec.decode(content)["error"]
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def make_error(self, status_code, error):
+        """Returns the exception to be raised for a failed call.
+        """
+        if status_code == 400:
+            return ValueError(error or "Bad Request")
+        elif status_code == 403:
+            return FireflyError("Authorization token mismatch.")
+        elif status_code == 404:
+            return NotFoundError("Requested function not found")
+        elif status_code == 411:
+            return FireflyError(error or "Length Required")
+        elif status_code == 413:
+            return ValueError(error or "Request Entity Too Large")
+        elif status_code == 416:
+            return FireflyError("Requested range not satisfiable")
+        elif status_code == 422:
+            return ValidationError(error)
+        elif status_code == 500:
+            return FireflyError(error)
+        elif status_code == 504:
+            return FireflyError(error or "Deadline exceeded")
+        elif status_code in RETRY_STATUS_CODES:
+            return FireflyError(error or "Server is overloaded, please try again later.")
+        else:
+            return FireflyError("Oops! Something really bad happened")
+
+    def batch(self, calls, return_exceptions=False):
+        """Calls multiple functions in a single request.
+
+        The calls are specified as a list of ``(func_name, kwargs)`` tuples
+        and the results are returned in the same order. The first failed
+        call raises its error, unless ``return_exceptions`` is set, in which
+        case the exception is returned in place of the result.
+
+            >>> client.batch([("square", {"n": 2}), ("cube", {"n": 2})])
+            [4, 8]
+        """
+        items = [{"function": func_name, "kwargs": kwargs} for func_name, kwargs in calls]
+        results = self.request("/_batch", calls=items)
+        return [self._get_batch_result(item, return_exceptions) for item in results]
+
+    def map(self, func_name, kwargs_list, return_exceptions=False, workers=None, chunk_size=100):
+        """Calls the function with each of the kwargs and returns the results
+        in the same order.
+
+        The calls are sent in batches of chunk_size calls, using at most
+        workers concurrent requests, which is the pool size by default. When
+        the server has no batch endpoint, the calls are sent one by one.
+
+        The first failed call raises its error, unless return_exceptions is
+        set, in which case the exception is returned in place of the result.
+        """
+        chunks = self._split_chunks(kwargs_list, chunk_size)
+        if not chunks:
+            return []
+
+        # the metadata is fetched before the requests are sent in parallel
+        self._get_metadata()
+        workers = min(workers or self.pool_size, len(chunks))
+        call_chunk = lambda chunk: self._map_chunk(func_name, chunk)
+        if workers == 1:
+            results = [call_chunk(chunk) for chunk in chunks]
+        else:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(call_chunk, chunks)
+            finally:
+                pool.close()
+
+        return self._get_map_results(results, return_exceptions)
+
+    def _split_chunks(self, kwargs_list, chunk_size):
+        kwargs_list = list(kwargs_list)
+        return [kwargs_list[i:i+chunk_size] for i in range(0, len(kwargs_list), chunk_size)]
+
+    def _get_map_results(self, chunk_results, return_exceptions):
+        results = [result for results in chunk_results for result in results]
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+    def _map_chunk(self, func_name, chunk):
+        # returns the results of the calls, with the exceptions in place of
+        # the results of the failed calls
+        if self._batch_supported is not False:
+            try:
+                results = self.batch([(func_name, kwargs) for kwargs in chunk], return_exceptions=True)
+                self._batch_supported = True
+                return results
+            except NotFoundError as e:
+                if self._batch_supported:
+                    return [e] * len(chunk)
+                logger.info("the server has no batch endpoint, sending the calls one by one")
+                self._batch_supported = False
+            except Exception as e:
+                return [e] * len(chunk)
+
+        results = []
+        for kwargs in chunk:
+            try:
+                results.append(self.call_func(func_name, **kwargs))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def _get_batch_result(self, item, return_exceptions):
+        if item["status"] == 200:
+            return item["result"]
+        error = self.make_error(item["status"], item.get("error"))
+        if return_exceptions:
+            return error
+        raise error
 
     def decode_response(self, response):
-        if response.headers["Content-Type"] == "application/octet-stream":
+        content_type = response.headers["Content-Type"].split(";")[0]
+        if content_type == "application/octet-stream":
             return response.raw
+        elif content_type == "application/x-ndjson":
+            return self.iter_ndjson(response)
         else:
-            return response.json()
+            codec = get_binary_codecs().get(content_type, self.codec)
+            return codec.decode(response.content)
+
+    def iter_ndjson(self, response, chunk_size=65536):
+        """Returns an iterator over the items of a streamed response.
+        """
+        try:
+            for line in response.iter_lines(chunk_size=chunk_size, delimiter=b"\n"):
+                if line:
+                    yield self.codec.decode(line)
+        except requests.RequestException as e:
+            raise FireflyError("The response stream was interrupted: {}".format(e))
+        finally:
+            response.close()
 
 def RemoteFunction(client, func_name):
     def wrapped(*args, **kwargs):
         if args:
             raise FireflyError('Firefly functions only accept named arguments')
         return client.call_func(func_name, **kwargs)
+    def map(kwargs_list, return_exceptions=False, workers=None, chunk_size=100):
+        return client.map(func_name, kwargs_list, return_exceptions=return_exceptions,
+                          workers=workers, chunk_size=chunk_size)
+
+    wrapped.map = map
     wrapped.__name__ = func_name
     wrapped.__qualname__ = func_name
     wrapped.__doc__ = client.get_doc(func_name)
@@ -121,3 +574,8 @@ def RemoteFunction(client, func_name):
 
 class FireflyError(Exception):
     pass
+
+class NotFoundError(FireflyError):
+    """Raised when the function or the endpoint is not found on the server.
+    """
+    pass
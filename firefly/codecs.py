@@ -0,0 +1,276 @@
+"""Codecs to encode and decode the request and response bodies.
+
+The JSON codec uses the fastest JSON library available, falling back to
+the json module from the standard library.
+
+The binary codecs are used when the client asks for them using the
+Content-Type and Accept headers and the required libraries are installed.
+"""
+import re
+import sys
+import json
+import numbers
+import struct
+import datetime
+from .utils import PY2
+
+def default(obj):
+    """Converts the objects that are not supported by JSON natively.
+    """
+    # numpy arrays and scalars
+    if hasattr(obj, "tolist"):
+        return obj.tolist()
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+class JSONCodec(object):
+    """JSON codec using the json module from the standard library.
+    """
+    name = "json"
+    content_type = "application/json"
+
+    def accepts(self, obj):
+        """Tells whether this codec is suitable to encode the object.
+        """
+        return True
+
+    def encode(self, obj):
+        """Encodes the object as JSON and returns bytes.
+        """
+        result = json.dumps(obj, default=default)
+        if not PY2:
+            result = result.encode("utf-8")
+        return result
+
+    def decode(self, data):
+        """Decodes the JSON data given as bytes.
+
+        Raises ValueError when the data is not valid JSON.
+        """
+        # json.loads accepts bytes only from python 3.6
+        if not PY2 and isinstance(data, bytes) and sys.version_info < (3, 6):
+            data = data.decode("utf-8")
+        return json.loads(data)
+
+class OrjsonCodec(JSONCodec):
+    """JSON codec using the orjson library.
+
+    The objects that orjson can't encode, like integers larger than 64 bits,
+    are encoded using the standard library. Such integers are also decoded
+    using the standard library, as orjson decodes them as floats.
+    """
+    name = "orjson"
+
+    # a number with 19 digits or more may not fit in 64 bits
+    _long_number_re = re.compile(br"\d{19}")
+    _long_number_str_re = re.compile(r"\d{19}")
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+        self.options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+
+    def encode(self, obj):
+        try:
+            return self.orjson.dumps(obj, default=default, option=self.options)
+        except TypeError:
+            return JSONCodec.encode(self, obj)
+
+    def decode(self, data):
+        regex = self._long_number_str_re if isinstance(data, str) else self._long_number_re
+        if regex.search(data):
+            return JSONCodec.decode(self, data)
+        return self.orjson.loads(data)
+
+JSON_CODECS = {
+    "json": JSONCodec,
+    "orjson": OrjsonCodec
+}
+
+# in the order of preference
+FAST_JSON_CODECS = ["orjson"]
+
+def get_json_codec(name=None):
+    """Returns the JSON codec with the given name.
+
+    When the name is not specified, the fastest codec available is returned.
+    """
+    if name is not None:
+        if name not in JSON_CODECS:
+            raise ValueError("Unknown JSON codec: {}".format(name))
+        return JSON_CODECS[name]()
+
+    for name in FAST_JSON_CODECS:
+        try:
+            return JSON_CODECS[name]()
+        except ImportError:
+            pass
+    return JSONCodec()
+
+class MsgpackCodec(object):
+    """MessagePack codec, requires the msgpack library.
+
+    Encoding the integers that don't fit in 64 bits raises OverflowError,
+    as msgpack can't represent them. Such values are sent as JSON instead.
+    """
+    name = "msgpack"
+    content_type = "application/msgpack"
+
+    def accepts(self, obj):
+        return True
+
+    def __init__(self):
+        import msgpack
+        self.msgpack = msgpack
+
+    def encode(self, obj):
+        return self.msgpack.packb(obj, default=self._default, use_bin_type=True)
+
+    def _default(self, obj):
+        # msgpack gives the integers that it can't pack to default, but not
+        # the numpy integers, which are converted by default
+        if isinstance(obj, numbers.Integral) and not hasattr(obj, "tolist"):
+            raise OverflowError("Integer out of the range of msgpack: {}".format(obj))
+        return default(obj)
+
+    def decode(self, data):
+        try:
+            return self.msgpack.unpackb(data, raw=False)
+        except Exception as e:
+            raise ValueError("Invalid msgpack data: {}".format(e))
+
+class NDArrayCodec(object):
+    """Codec to send numpy arrays as raw buffers, requires numpy.
+
+    The encoded data is a frame with the following parts:
+
+    * the length of the header as a 4-byte big-endian integer
+    * the header, a JSON object with the ``value`` and the ``arrays``
+    * the raw data of the arrays, each one aligned to 64 bytes
+
+    The arrays in the value, either the value itself or the values of
+    the (nested) dicts, are replaced by ``{"__ndarray__": index}`` in the
+    header and the arrays list has the dtype, shape and position of their
+    data. The arrays are decoded as read-only views on the data, without
+    making a copy.
+    """
+    name = "ndarray"
+    content_type = "application/x-firefly-ndarray"
+    ALIGNMENT = 64
+
+    def __init__(self):
+        import numpy
+        self.numpy = numpy
+
+    def encode(self, obj):
+        arrays = []
+        value = self._extract_arrays(obj, arrays)
+
+        specs = []
+        offset = 0
+        for a in arrays:
+            offset = self._align(offset)
+            specs.append({"dtype": a.dtype.str, "shape": list(a.shape), "offset": offset})
+            offset += a.nbytes
+
+        header = json.dumps({"value": value, "arrays": specs}, default=default).encode("utf-8")
+        # pad the header with spaces so that the data starts at an aligned offset
+        header += b" " * (self._align(4 + len(header)) - 4 - len(header))
+
+        parts = [struct.pack(">I", len(header)), header]
+        position = 0
+        for a, spec in zip(arrays, specs):
+            parts.append(b"\0" * (spec["offset"] - position))
+            parts.append(memoryview(a.reshape(-1).view(self.numpy.uint8)))
+            position = spec["offset"] + a.nbytes
+        return b"".join(parts)
+
+    def decode(self, data):
+        try:
+            (header_length,) = struct.unpack_from(">I", data, 0)
+            header = json.loads(bytes(data[4:4+header_length]).decode("utf-8"))
+            start = 4 + header_length
+            arrays = [self._decode_array(data, start, spec) for spec in header["arrays"]]
+            return self._insert_arrays(header["value"], arrays)
+        except (struct.error, KeyError, IndexError, TypeError) as e:
+            raise ValueError("Invalid ndarray data: {}".format(e))
+
+    def _decode_array(self, data, start, spec):
+        dtype = self.numpy.dtype(spec["dtype"])
+        count = 1
+        for n in spec["shape"]:
+            count *= n
+        a = self.numpy.frombuffer(data, dtype=dtype, count=count, offset=start + spec["offset"])
+        return a.reshape(spec["shape"])
+
+    def accepts(self, obj):
+        """Returns True only when the object has arrays in it, the other
+        objects are better sent using the other codecs.
+        """
+        if self._is_array(obj):
+            return True
+        elif isinstance(obj, dict):
+            return any(self.accepts(v) for v in obj.values())
+        return False
+
+    def _align(self, n):
+        return -(-n // self.ALIGNMENT) * self.ALIGNMENT
+
+    def _is_array(self, obj):
+        return isinstance(obj, self.numpy.ndarray) and obj.dtype.kind in "biufc"
+
+    def _extract_arrays(self, obj, arrays):
+        if self._is_array(obj):
+            arrays.append(self.numpy.ascontiguousarray(obj))
+            return {"__ndarray__": len(arrays) - 1}
+        elif isinstance(obj, dict):
+            return {k: self._extract_arrays(v, arrays) for k, v in obj.items()}
+        else:
+            return obj
+
+    def _insert_arrays(self, obj, arrays):
+        if isinstance(obj, dict):
+            if len(obj) == 1 and "__ndarray__" in obj:
+                return arrays[obj["__ndarray__"]]
+            return {k: self._insert_arrays(v, arrays) for k, v in obj.items()}
+        else:
+            return obj
+
+BINARY_CODECS = [NDArrayCodec, MsgpackCodec]
+
+_binary_codecs = None
+
+def get_binary_codecs():
+    """Returns the binary codecs that are available, as a dict with the
+    content type as key.
+    """
+    global _binary_codecs
+    if _binary_codecs is None:
+        codecs = {}
+        for cls in BINARY_CODECS:
+            try:
+                codecs[cls.content_type] = cls()
+            except ImportError:
+                pass
+        _binary_codecs = codecs
+    return _binary_codecs
+
+def parse_accept(accept):
+    """Returns the content types in the Accept header, in the order of
+    preference.
+    """
+    types = []
+    for i, item in enumerate(accept.split(",")):
+        parts = item.split(";")
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            types.append((-q, i, parts[0].strip()))
+    return [content_type for _, _, content_type in sorted(types)]
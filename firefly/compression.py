@@ -0,0 +1,171 @@
+"""Compression of the request and response bodies.
+
+The responses are compressed using the best encoding accepted by the client,
+as given in the Accept-Encoding header, and the request bodies are
+decompressed based on their Content-Encoding header.
+
+The gzip and deflate encodings are always available and the br encoding is
+available when the brotli library is installed.
+"""
+import zlib
+from .codecs import parse_accept
+from .multipart import PayloadTooLarge
+
+# the window bits for zlib, the deflate encoding of http is the zlib format
+WBITS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS
+}
+
+def _import_brotli():
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+brotli = _import_brotli()
+
+# the max size of the decompressed request bodies by default
+MAX_DECOMPRESSED_SIZE = 100 * 1048576
+
+def get_encodings():
+    """Returns the encodings that are available, in the order of preference.
+    """
+    encodings = ["gzip", "deflate"]
+    if brotli is not None:
+        encodings.insert(0, "br")
+    return encodings
+
+def choose_encoding(accept_encoding):
+    """Returns the encoding to use for the Accept-Encoding header of the
+    request, or None when the response should not be compressed.
+    """
+    if not accept_encoding:
+        return None
+    available = get_encodings()
+    accepted = parse_accept(accept_encoding.lower())
+    if "*" in accepted:
+        return available[0]
+    # the preference of the server is used between the accepted encodings
+    for encoding in available:
+        if encoding in accepted:
+            return encoding
+
+def compress(data, encoding, level=6):
+    """Compresses the data using the given encoding.
+    """
+    if encoding == "br":
+        return brotli.compress(data, quality=min(level, 11))
+    c = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+    return c.compress(data) + c.flush()
+
+def compress_iter(chunks, encoding, level=6):
+    """Compresses a stream of chunks.
+
+    The compressed data is flushed after every chunk, so that the client
+    can decode each chunk as soon as it is received.
+    """
+    if encoding == "br":
+        c = brotli.Compressor(quality=min(level, 11))
+        process, flush, finish = c.process, c.flush, c.finish
+    else:
+        c = zlib.compressobj(level, zlib.DEFLATED, WBITS[encoding])
+        process = c.compress
+        flush = lambda: c.flush(zlib.Z_SYNC_FLUSH)
+        finish = c.flush
+
+    try:
+        for chunk in chunks:
+            data = process(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+class DecompressedFile(object):
+    """File-like object to read the decompressed data of a compressed file.
+
+    The data is decompressed in steps of at most chunk_size bytes, so that
+    a small compressed body can't expand to a huge one all at once.
+
+    :param fileobj: the file with the compressed data
+    :param encoding: the encoding of the data, one of gzip, deflate or br
+    :param max_size: the max size of the decompressed data
+    :param chunk_size: the size of the chunks to read and decompress
+    """
+    def __init__(self, fileobj, encoding, max_size=MAX_DECOMPRESSED_SIZE, chunk_size=65536):
+        if encoding == "br":
+            if brotli is None:
+                raise ValueError("Unsupported Content-Encoding: br")
+            self.decompressor = brotli.Decompressor()
+        elif encoding in WBITS:
+            self.decompressor = zlib.decompressobj(WBITS[encoding])
+        else:
+            raise ValueError("Unsupported Content-Encoding: {}".format(encoding))
+        self.fileobj = fileobj
+        self.encoding = encoding
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.size = 0
+        self.eof = False
+
+    def _fill(self):
+        try:
+            if self.encoding == "br":
+                data = self._decompress_brotli()
+            else:
+                data = self._decompress_zlib()
+        except Exception as e:
+            raise ValueError("Invalid {} data: {}".format(self.encoding, e))
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise PayloadTooLarge("Decompressed request body is larger than {} bytes".format(self.max_size))
+        self.buffer += data
+
+    def _decompress_zlib(self):
+        d = self.decompressor
+        # the input that didn't fit in the output of the previous step
+        data = d.unconsumed_tail or self.fileobj.read(self.chunk_size)
+        if not data:
+            # the output still held by the decompressor, if any
+            data = d.decompress(b"", self.chunk_size)
+            self.eof = not data
+            return data
+        return d.decompress(data, self.chunk_size)
+
+    def _decompress_brotli(self):
+        d = self.decompressor
+        # older versions of brotli can't limit the output, so the input is
+        # given to them in small pieces instead
+        limited = hasattr(d, "can_accept_more_data")
+        if limited and not d.can_accept_more_data():
+            return d.process(b"", output_buffer_limit=self.chunk_size)
+        data = self.fileobj.read(self.chunk_size if limited else 1024)
+        if not data and limited:
+            # the output still held by the decompressor, if any
+            data = d.process(b"", output_buffer_limit=self.chunk_size)
+            self.eof = not data
+            return data
+        elif not data:
+            self.eof = True
+            return b""
+        if limited:
+            return d.process(data, output_buffer_limit=self.chunk_size)
+        return d.process(data)
+
+    def read(self, size=-1):
+        while not self.eof and (size is None or size < 0 or len(self.buffer) < size):
+            self._fill()
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def close(self):
+        if hasattr(self.fileobj, "close"):
+            self.fileobj.close()
@@ -0,0 +1,217 @@
+"""Execution of the functions in a pool of processes.
+
+CPU-bound functions written in pure python can't run in parallel in the
+threads of a single process because of the GIL. Such functions can be run
+in a pool of worker processes instead, while the server process takes care
+of the HTTP requests, decoding the arguments and encoding the results.
+
+The arguments and the results are sent to the worker processes by pickling
+them, except the large numpy arrays and bytes, which are passed through
+shared memory to avoid copying them through a pipe.
+
+This module requires Python 3.8 or above, for the shared memory.
+"""
+import logging
+import threading
+
+logger = logging.getLogger("firefly")
+
+# the modules of the functions, which are imported by the fork server before
+# the worker processes are forked from it
+_preload_modules = set()
+
+class ProcessExecutor(object):
+    """Calls a function in a pool of worker processes.
+
+    The pool is created on the first call, so that it is created in the
+    process that serves the requests and not in the parent of the gunicorn
+    workers. All the worker processes are started at once, so that the
+    later calls don't wait for a process to start.
+
+    The function must be defined at the top-level of a module, so that it
+    can be pickled. Generators are consumed in the worker process and the
+    items are returned as a list.
+
+    :param function: the function to call
+    :param max_workers: the number of worker processes, the number of
+        CPUs by default
+    :param shm_threshold: the min size of the arrays and bytes, in the
+        arguments and the results, that are passed through shared memory
+    :param start_method: the multiprocessing start method, forkserver by
+        default when available and spawn otherwise
+    """
+    def __init__(self, function, max_workers=None, shm_threshold=1048576, start_method=None):
+        self.function = function
+        self.max_workers = max_workers
+        self.shm_threshold = shm_threshold
+        self.start_method = start_method
+        self.pool = None
+        self.lock = threading.Lock()
+        if getattr(function, "__module__", "__main__") != "__main__":
+            _preload_modules.add(function.__module__)
+
+    def __call__(self, **kwargs):
+        return self.call(kwargs)
+
+    def call(self, kwargs):
+        """Calls the function with the kwargs in a worker process and
+        returns the result.
+        """
+        pool = self.get_pool()
+        names = []
+        try:
+            kwargs = to_shared(kwargs, self.shm_threshold, names)
+            future = pool.submit(_call_function, self.function, kwargs, self.shm_threshold)
+            return from_shared(future.result(), unlink=True)
+        finally:
+            for name in names:
+                _unlink(name)
+
+    def get_pool(self):
+        with self.lock:
+            if self.pool is None:
+                self.pool = self.create_pool()
+            return self.pool
+
+    def create_pool(self):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        start_method = self.start_method
+        if start_method is None:
+            methods = multiprocessing.get_all_start_methods()
+            start_method = "forkserver" if "forkserver" in methods else "spawn"
+        context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            context.set_forkserver_preload(sorted(_preload_modules))
+
+        pool = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+        # start all the workers now instead of on demand
+        workers = self.max_workers or multiprocessing.cpu_count()
+        for future in [pool.submit(_warmup) for i in range(workers)]:
+            future.result()
+        logger.info("started %d worker processes for %s", workers, getattr(self.function, "__name__", self.function))
+        return pool
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+                self.pool = None
+
+def _warmup():
+    pass
+
+def _call_function(function, kwargs, shm_threshold):
+    # runs in the worker process
+    names = []
+    kwargs = from_shared(kwargs, unlink=False)
+    result = function(**kwargs)
+    if hasattr(result, "__next__") and hasattr(result, "__iter__"):
+        result = list(result)
+    # the shared memory of the result is unlinked by the server process
+    return to_shared(result, shm_threshold, names, track=False)
+
+class SharedBuffer(object):
+    """Reference to a numpy array or bytes in shared memory, which is
+    pickled instead of the data.
+    """
+    def __init__(self, name, size, dtype=None, shape=None):
+        self.name = name
+        self.size = size
+        self.dtype = dtype
+        self.shape = shape
+
+    def load(self):
+        """Returns a copy of the data in the shared memory.
+        """
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(name=self.name)
+        # the memory is released by the process that created it
+        _untrack(shm)
+        try:
+            if self.dtype is None:
+                return bytes(shm.buf[:self.size])
+            import numpy
+            a = numpy.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+            return a.copy()
+        finally:
+            shm.close()
+
+def to_shared(obj, threshold, names, track=True):
+    """Replaces the large numpy arrays and bytes in obj, either obj itself
+    or the values of a dict, with SharedBuffer references.
+
+    The names of the shared memory blocks created are added to names.
+    When track is False, the blocks are not cleaned up when this process
+    exits, as another process is responsible for them.
+    """
+    if isinstance(obj, dict):
+        return {k: to_shared(v, threshold, names, track) for k, v in obj.items()}
+
+    size = _get_buffer_size(obj)
+    if size is None or size < threshold:
+        return obj
+    try:
+        from multiprocessing import shared_memory
+    except ImportError:
+        return obj
+
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    if not track:
+        _untrack(shm)
+    try:
+        if isinstance(obj, bytes):
+            shm.buf[:size] = obj
+            ref = SharedBuffer(shm.name, size)
+        else:
+            import numpy
+            a = numpy.ndarray(obj.shape, dtype=obj.dtype, buffer=shm.buf)
+            a[...] = obj
+            del a
+            ref = SharedBuffer(shm.name, size, obj.dtype.str, obj.shape)
+    finally:
+        shm.close()
+    names.append(shm.name)
+    return ref
+
+def from_shared(obj, unlink):
+    """Replaces the SharedBuffer references in obj with the data.
+
+    The shared memory is released when unlink is True.
+    """
+    if isinstance(obj, SharedBuffer):
+        try:
+            return obj.load()
+        finally:
+            if unlink:
+                _unlink(obj.name)
+    elif isinstance(obj, dict):
+        return {k: from_shared(v, unlink) for k, v in obj.items()}
+    return obj
+
+def _get_buffer_size(obj):
+    if isinstance(obj, bytes):
+        return len(obj)
+    # numpy arrays, except the object arrays that can't be shared
+    if hasattr(obj, "dtype") and hasattr(obj, "nbytes") and getattr(obj.dtype, "hasobject", True) is False:
+        return obj.nbytes
+
+def _untrack(shm):
+    # the resource tracker of this process would otherwise unlink the
+    # memory when the process exits and warn about it. The memory is
+    # registered with it even when an existing block is opened.
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+def _unlink(name):
+    from multiprocessing import shared_memory
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
@@ -0,0 +1,158 @@
+"""Admission control for the function calls.
+
+A limiter allows at most ``max_concurrency`` requests to run at a time and
+at most ``max_queue`` requests to wait for their turn. The requests beyond
+that are rejected immediately, so that the latency of the accepted requests
+stays bounded when the server is overloaded.
+"""
+import threading
+import time
+
+class ConcurrencyLimiter(object):
+    """Limits the number of concurrent requests.
+
+    :param max_concurrency: the max number of requests running at a time
+    :param max_queue: the max number of requests waiting to run
+    :param queue_timeout: the max number of seconds a request waits to run
+    :param retry_after: the number of seconds after which the rejected
+        requests can be retried, sent in the Retry-After header
+    """
+    def __init__(self, max_concurrency, max_queue=0, queue_timeout=None, retry_after=1):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.condition = threading.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def acquire(self):
+        """Waits for a slot to run a request and returns True, or returns
+        False if the request is rejected.
+        """
+        with self.condition:
+            if self.active < self.max_concurrency:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                return False
+
+            self.waiting += 1
+            try:
+                deadline = self.queue_timeout and time.time() + self.queue_timeout
+                while self.active >= self.max_concurrency:
+                    timeout = deadline and deadline - time.time()
+                    if timeout is not None and timeout <= 0:
+                        self.rejected += 1
+                        return False
+                    self.condition.wait(timeout)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def try_acquire(self):
+        """Takes a slot to run a request and returns True when one is free
+        right away, or returns False without waiting or rejecting it.
+        """
+        with self.condition:
+            if self.active < self.max_concurrency:
+                self.active += 1
+                return True
+            return False
+
+    def hold(self):
+        """Takes a slot even when none is free, for the work that goes on
+        after its request is done. The slot must be released later.
+        """
+        with self.condition:
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+    def stats(self):
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "rejected": self.rejected
+        }
+
+class ReleasingIterator(object):
+    """Iterator over the chunks of a streamed response, which releases the
+    limiter when the response is closed by the server.
+    """
+    def __init__(self, app_iter, release):
+        self.app_iter = app_iter
+        self._release = release
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, "close"):
+                self.app_iter.close()
+        finally:
+            if self._release is not None:
+                self._release()
+                self._release = None
+
+def _release_on_close(app_iter, release):
+    # makes the close method of the app_iter call release as well, and
+    # returns False when the app_iter doesn't allow that
+    close = getattr(app_iter, "close", None)
+    pending = [release]
+    def close_and_release():
+        try:
+            if close is not None:
+                close()
+        finally:
+            if pending:
+                pending.pop()()
+    try:
+        app_iter.close = close_and_release
+    except AttributeError:
+        return False
+    return True
+
+def run_limited(limiter, handler, request):
+    """Calls handler with the request when the limiter admits it and
+    returns the response, or None when the request is rejected.
+
+    The streamed responses, like the results of the generator functions,
+    hold the slot until they are sent completely.
+    """
+    if not limiter.acquire():
+        return None
+    try:
+        response = handler(request)
+    except:
+        limiter.release()
+        raise
+    return release_after(response, limiter.release, request.environ.get('wsgi.file_wrapper'))
+
+def release_after(response, release, file_wrapper=None):
+    """Calls release once the response is sent and returns the response.
+
+    The responses with the body in memory are sent without any more work,
+    so release is called right away for them. The files wrapped in the
+    ``wsgi.file_wrapper`` of the server are passed on as they are, as the
+    server recognizes them by their type to send them using sendfile.
+    """
+    app_iter = response.app_iter
+    if isinstance(app_iter, (list, tuple)):
+        release()
+    elif (isinstance(file_wrapper, type) and isinstance(app_iter, file_wrapper)
+            and _release_on_close(app_iter, release)):
+        pass
+    else:
+        # setting the app_iter resets the content length
+        content_length = response.content_length
+        response.app_iter = ReleasingIterator(response.app_iter, release)
+        response.content_length = content_length
+    return response
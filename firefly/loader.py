@@ -0,0 +1,180 @@
+"""Loading of the functions to serve, either eagerly or lazily.
+
+A lazily loaded function is registered without importing its module. Its
+signature and docstring are read from the source code of the module, and
+the module is imported on the first call to the function, or earlier when
+the functions are warmed up in the background.
+
+The signature can be read from the source only for the plain functions
+defined at the top-level of a module, without decorators and with literal
+default values. The other functions are imported immediately.
+
+This module requires Python 3 for the lazy loading.
+"""
+import ast
+import importlib
+import logging
+import sys
+import threading
+import time
+
+logger = logging.getLogger("firefly")
+
+# the time taken to import each module, in seconds
+import_times = {}
+
+def import_module(name):
+    """Imports the module and records the time taken to import it.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    start = time.time()
+    module = importlib.import_module(name)
+    import_times[name] = time.time() - start
+    return module
+
+def log_import_times():
+    """Logs the time taken to import each module, the slowest first.
+    """
+    for name, duration in sorted(import_times.items(), key=lambda item: -item[1]):
+        logger.info("imported module %s in %0.3f seconds", name, duration)
+
+def _import_function(module_name, func_name):
+    return getattr(import_module(module_name), func_name)
+
+class LazyFunction(object):
+    """A function that is imported when it is called for the first time.
+
+    The signature and the docstring are available without importing it,
+    so that the FireflyFunction can be created from it.
+    """
+    def __init__(self, module_name, func_name, signature, doc=None):
+        self.__module__ = module_name
+        self.__name__ = func_name
+        self.__qualname__ = func_name
+        self.__doc__ = doc
+        self.__signature__ = signature
+        self._function = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<LazyFunction {}.{}>".format(self.__module__, self.__name__)
+
+    @property
+    def is_loaded(self):
+        return self._function is not None
+
+    def load(self):
+        """Imports the function, unless it is already imported, and
+        returns it.
+        """
+        if self._function is None:
+            with self._lock:
+                if self._function is None:
+                    logger.info("loading function %s.%s", self.__module__, self.__name__)
+                    self._function = _import_function(self.__module__, self.__name__)
+        return self._function
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __reduce__(self):
+        # the processes of a process pool import the function themselves
+        return (_import_function, (self.__module__, self.__name__))
+
+def lazy_function(function_spec):
+    """Returns a LazyFunction for the function given as module.function,
+    or None when it can't be loaded lazily and must be imported.
+    """
+    if sys.version_info.major < 3:
+        return None
+    module_name, func_name = function_spec.rsplit(".", 1)
+    if module_name in sys.modules:
+        return None
+
+    source = _get_source(module_name)
+    try:
+        node = source and _find_function(ast.parse(source), func_name)
+    except SyntaxError:
+        node = None
+    if node is None:
+        logger.info("function %s can't be loaded lazily, importing it", function_spec)
+        return None
+    try:
+        signature = _get_signature(node)
+    except (TypeError, ValueError):
+        logger.info("function %s has non-literal defaults, importing it", function_spec)
+        return None
+    return LazyFunction(module_name, func_name, signature, ast.get_docstring(node, clean=False))
+
+def _get_source(module_name):
+    # finding the module imports the parent packages, but not the module
+    import importlib.util
+    try:
+        spec = importlib.util.find_spec(module_name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or spec.loader is None or not hasattr(spec.loader, "get_source"):
+        return None
+    try:
+        return spec.loader.get_source(module_name)
+    except ImportError:
+        return None
+
+def _find_function(tree, name):
+    """Returns the FunctionDef node of the function with the name, if the
+    last top-level definition of the name is a plain function.
+    """
+    node = None
+    for stmt in tree.body:
+        names = _get_bound_names(stmt)
+        if name in names or "*" in names:
+            node = stmt
+    if isinstance(node, ast.FunctionDef) and not node.decorator_list:
+        return node
+
+def _get_bound_names(stmt):
+    """Returns the names that a top-level statement may bind.
+
+    The statements like if and try are searched entirely, so that the
+    functions defined conditionally are never loaded lazily.
+    """
+    if isinstance(stmt, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return [stmt.name]
+    names = []
+    for node in ast.walk(stmt):
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            names.append(node.id)
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names.append(node.name)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            # a star import may bind any name
+            names.extend(alias.asname or alias.name.split(".")[0] for alias in node.names)
+    return names
+
+def _get_signature(node):
+    from inspect import Signature, Parameter
+    args = node.args
+    positional_only = getattr(args, "posonlyargs", [])
+    positional = positional_only + args.args
+    defaults = [Parameter.empty] * (len(positional) - len(args.defaults)) + list(args.defaults)
+
+    params = []
+    for arg, default in zip(positional, defaults):
+        kind = Parameter.POSITIONAL_ONLY if arg in positional_only else Parameter.POSITIONAL_OR_KEYWORD
+        params.append(Parameter(arg.arg, kind, default=_get_default(default)))
+    if args.vararg:
+        params.append(Parameter(args.vararg.arg, Parameter.VAR_POSITIONAL))
+    for arg, default in zip(args.kwonlyargs, args.kw_defaults):
+        default = Parameter.empty if default is None else default
+        params.append(Parameter(arg.arg, Parameter.KEYWORD_ONLY, default=_get_default(default)))
+    if args.kwarg:
+        params.append(Parameter(args.kwarg.arg, Parameter.VAR_KEYWORD))
+    return Signature(params)
+
+def _get_default(node):
+    from inspect import Parameter
+    if node is Parameter.empty:
+        return node
+    # raises ValueError for the expressions that are not literals
+    return ast.literal_eval(node)
@@ -1,13 +1,14 @@
 import os
 import sys
 import argparse
-import importlib
+import time
 import yaml
 import logging
 from .app import Firefly
 from .validator import ValidationError, FireflyError
 from .version import __version__
-from wsgiref.simple_server import make_server
+from .server import run_server
+from .loader import LazyFunction, import_module, lazy_function, log_import_times
 
 logger = logging.getLogger("firefly")
 
@@ -16,10 +17,13 @@ def load_from_env():
     token = None
     allow_origins = ''
 
+    lazy = os.environ.get('FIREFLY_LAZY', '').lower() in ('1', 'true', 'yes')
+    preload = [p for p in os.environ.get('FIREFLY_PRELOAD', '').split(",") if p]
+
     if 'FIREFLY_FUNCTIONS' in os.environ:
         function_names = os.environ['FIREFLY_FUNCTIONS'].split(",")
         try:
-            functions = load_functions(function_names)
+            functions = load_functions(function_names, lazy=lazy, preload=preload)
         except (ImportError, AttributeError) as err:
             sys.exit(1)
 
@@ -29,9 +33,19 @@ def load_from_env():
     if 'FIREFLY_ALLOW_ORIGINS' in os.environ:
         allow_origins = os.environ['FIREFLY_ALLOW_ORIGINS']
 
+    profile = {}
+    limits = None
+    if 'FIREFLY_PROFILE_SAMPLE_RATE' in os.environ:
+        profile['sample_rate'] = float(os.environ['FIREFLY_PROFILE_SAMPLE_RATE'])
+    if 'FIREFLY_PROFILE_SLOW_MS' in os.environ:
+        profile['slow_ms'] = float(os.environ['FIREFLY_PROFILE_SLOW_MS'])
+
     if 'FIREFLY_CONFIG' in os.environ:
         logger.info("loading config file: %s", os.environ['FIREFLY_CONFIG'])
-        functions, token = parse_config_data(parse_config_file(os.environ['FIREFLY_CONFIG']))
+        config = parse_config_file(os.environ['FIREFLY_CONFIG'])
+        functions, token = parse_config_data(config, lazy=lazy or None, preload=preload or None)
+        profile = config.get("profile") or profile
+        limits = config.get("limits")
 
     if functions:
         add_routes(app, functions)
@@ -42,6 +56,12 @@ def load_from_env():
     if allow_origins:
         app.set_allowed_origins(allow_origins)
 
+    if profile:
+        app.set_profiling(**profile)
+
+    if limits:
+        app.set_limits(**limits)
+
 def parse_args():
     p = argparse.ArgumentParser()
     p.add_argument("--version", action="store_true", help="Prints the firefly version")
@@ -49,26 +69,61 @@ def parse_args():
     p.add_argument("-b", "--bind", dest="ADDRESS", default="127.0.0.1:8000")
     p.add_argument("-c", "--config", dest="config_file", default=None)
     p.add_argument("--allow-origins", default=None, help="Origins to allow for cross-origin resource sharing")
+    p.add_argument("-w", "--workers", type=int, default=None, help="number of worker processes, uses gunicorn when specified")
+    p.add_argument("--threads", type=int, default=None, help="number of threads per worker process")
+    p.add_argument("-k", "--worker-class", default=None, help="the gunicorn worker class (sync, gthread, gevent etc.)")
+    p.add_argument("--asgi", action="store_true", default=False, help="serve the ASGI app using the uvicorn worker class, to support async functions")
+    p.add_argument("--max-requests", type=int, default=0, help="restart a worker after it has served these many requests")
+    p.add_argument("--max-requests-jitter", type=int, default=0, help="random jitter added to max-requests to avoid restarting all the workers at once")
+    p.add_argument("--timeout", type=int, default=None, help="restart the workers that are silent for these many seconds")
+    p.add_argument("--graceful-timeout", type=int, default=None, help="time given to the workers to finish the requests on restart")
+    p.add_argument("--profile-sample-rate", type=float, default=None, help="fraction of the requests to profile, the profiles are available at /_profiles")
+    p.add_argument("--profile-slow-ms", type=float, default=None, help="profile all the requests and keep the profiles of the ones slower than these many milliseconds")
+    p.add_argument("--max-concurrency", type=int, default=None, help="max number of requests processed at a time, across all the functions")
+    p.add_argument("--max-queue", type=int, default=None, help="max number of requests waiting when max-concurrency is reached, the others are rejected with 503")
+    p.add_argument("--lazy", action="store_true", default=None, help="import the functions on the first call instead of at startup")
+    p.add_argument("--warmup", action="store_true", default=None, help="import the lazily loaded functions in the background once the server is listening")
+    p.add_argument("--preload", default=None, help="comma separated functions or modules to import at startup in the lazy mode")
     p.add_argument("functions", nargs='*', help="functions to serve")
     return p.parse_args()
 
-def load_function(function_spec, path=None, name=None):
+def load_function(function_spec, path=None, name=None, lazy=False):
+    """Loads the function given as module.function and returns a tuple of
+    the path, the name and the function.
+
+    When lazy is set, the module is imported only when the function is
+    called for the first time, if possible. See :mod:`firefly.loader`.
+    """
     if "." not in function_spec:
         raise Exception("Invalid function: {}, please specify it as module.function".format(function_spec))
 
     mod_name, func_name = function_spec.rsplit(".", 1)
-    try:
-        mod = importlib.import_module(mod_name)
-        func = getattr(mod, func_name)
-    except (ImportError, AttributeError) as err:
-        print("Failed to load {}: {}".format(function_spec, str(err)))
-        raise
+    func = lazy and lazy_function(function_spec)
+    if not func:
+        try:
+            mod = import_module(mod_name)
+            func = getattr(mod, func_name)
+        except (ImportError, AttributeError) as err:
+            print("Failed to load {}: {}".format(function_spec, str(err)))
+            raise
     path = path or "/"+func_name
     name = name or func_name
     return (path, name, func)
 
-def load_functions(function_specs):
-    return [load_function(function_spec) for function_spec in function_specs]
+def is_preloaded(function_spec, name, preload):
+    """Tells if the function is in the preload list, either by its name,
+    as module.function or by its module.
+    """
+    return bool(preload) and (name in preload or function_spec in preload
+                              or function_spec.rsplit(".", 1)[0] in preload)
+
+def load_functions(function_specs, lazy=False, preload=()):
+    start = time.time()
+    functions = [load_function(function_spec,
+                               lazy=lazy and not is_preloaded(function_spec, function_spec.rsplit(".", 1)[-1], preload))
+                 for function_spec in function_specs]
+    log_startup(functions, time.time() - start)
+    return functions
 
 def parse_config_file(config_file):
     if not os.path.exists(config_file):
@@ -77,15 +132,46 @@ def parse_config_file(config_file):
         config_dict = yaml.safe_load(f)
     return config_dict
 
-def parse_config_data(config_dict):
-    functions = [(load_function(f["function"], path=f.get("path"), name=name, ))
+def parse_config_data(config_dict, lazy=None, preload=None):
+    """Loads the functions in the config and returns them along with the
+    auth token.
+
+    The functions are loaded lazily when the config has ``lazy: true``,
+    except the ones in its ``preload`` list. The lazy and preload arguments
+    take precedence over the config.
+    """
+    lazy = config_dict.get("lazy", False) if lazy is None else lazy
+    preload = (config_dict.get("preload") or []) if preload is None else preload
+    start = time.time()
+    functions = [load_function(f["function"], path=f.get("path"), name=name,
+                               lazy=lazy and not is_preloaded(f["function"], name, preload))
+                 + (get_function_options(f),)
             for name, f in config_dict["functions"].items()]
+    log_startup(functions, time.time() - start)
     token = config_dict.get("token", None)
     return functions, token
 
+def log_startup(functions, duration):
+    """Logs the time taken to load the functions and to import each module.
+    """
+    deferred = sum(1 for spec in functions if isinstance(spec[2], LazyFunction))
+    logger.info("loaded %d functions in %0.3f seconds, %d deferred until first use",
+                len(functions), duration, deferred)
+    log_import_times()
+
+def get_function_options(function_config):
+    """Returns the options of a function in the config file.
+
+    All the keys other than function and path are passed as options to
+    the FireflyFunction.
+    """
+    return {k: v for k, v in function_config.items() if k not in ("function", "path")}
+
 def add_routes(app, functions):
-    for path, name, function in functions:
-        app.add_route(path, function, name)
+    for spec in functions:
+        path, name, function = spec[:3]
+        options = spec[3] if len(spec) > 3 else {}
+        app.add_route(path, function, name, **options)
 
 def setup_logger():
     level = logging.INFO
@@ -109,24 +195,54 @@ def main():
         raise FireflyError("Invalid arguments provided. Please specify either a config file or a list of functions.")
 
     token = None
+    profile = {}
+    limits = {}
+    preload = args.preload.split(",") if args.preload else None
+    warmup = args.warmup
 
     if len(args.functions):
-        functions = load_functions(args.functions)
+        functions = load_functions(args.functions, lazy=args.lazy, preload=preload)
     elif args.config_file:
-        functions, token = parse_config_data(parse_config_file(args.config_file))
+        config = parse_config_file(args.config_file)
+        functions, token = parse_config_data(config, lazy=args.lazy, preload=preload)
+        profile = config.get("profile") or {}
+        limits = config.get("limits") or {}
+        if warmup is None:
+            warmup = config.get("warmup", False)
 
     token = token or args.token
 
     app.set_auth_token(token)
     if args.allow_origins:
         app.set_allowed_origins(args.allow_origins)
+    # the command line options take precedence over the config file
+    if args.profile_sample_rate is not None:
+        profile['sample_rate'] = args.profile_sample_rate
+    if args.profile_slow_ms is not None:
+        profile['slow_ms'] = args.profile_slow_ms
+    if profile:
+        app.set_profiling(**profile)
+    if args.max_concurrency is not None:
+        limits['max_concurrency'] = args.max_concurrency
+    if args.max_queue is not None:
+        limits['max_queue'] = args.max_queue
+    if limits:
+        app.set_limits(**limits)
     add_routes(app, functions)
 
     host, port = args.ADDRESS.split(":", 1)
     port = int(port)
     print("http://{}/".format(args.ADDRESS))
-    server = make_server(host, port, app)
-    server.serve_forever()
+    run_server(app, host, port,
+        workers=args.workers,
+        threads=args.threads,
+        worker_class=args.worker_class,
+        max_requests=args.max_requests,
+        max_requests_jitter=args.max_requests_jitter,
+        timeout=args.timeout,
+        graceful_timeout=args.graceful_timeout,
+        asgi=args.asgi,
+        warmup=bool(warmup))
 
 setup_logger()
 logger.info("Starting Firefly...")
@@ -0,0 +1,134 @@
+"""Metrics of the function calls, exposed in the Prometheus text format.
+
+The metrics are kept in a small number of shards, each with its own lock,
+and each thread always updates the same shard. The threads rarely wait for
+each other to update a metric and the shards are combined only when the
+metrics are collected.
+"""
+import bisect
+import itertools
+import threading
+import time
+
+# the clock to measure the durations with
+clock = getattr(time, "perf_counter", time.time)
+
+# the upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRICS = {
+    "firefly_requests_total": ("counter", "The number of requests by the http status code."),
+    "firefly_requests_in_flight": ("gauge", "The number of requests being processed."),
+    "firefly_request_bytes_total": ("counter", "The total size of the request bodies."),
+    "firefly_response_bytes_total": ("counter", "The total size of the response bodies, when known."),
+    "firefly_request_duration_seconds": ("histogram", "The time taken to process the requests."),
+    "firefly_phase_duration_seconds": ("histogram",
+        "The time taken in each phase of the requests: decode, validate, execute and encode."),
+}
+
+class _Shard(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+class Metrics(object):
+    """Counters and histograms of a function.
+
+    The metrics are identified by the name and the labels, which is a
+    tuple of (name, value) pairs.
+
+    :param buckets: the upper bounds of the histogram buckets
+    :param shards: the number of shards
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS, shards=8):
+        self.buckets = buckets
+        self.shards = [_Shard() for i in range(shards)]
+        self.local = threading.local()
+        self.counter = itertools.count()
+
+    def _get_shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = self.shards[next(self.counter) % len(self.shards)]
+            return shard
+
+    def inc(self, name, labels=(), value=1):
+        """Adds the value to the counter or gauge.
+        """
+        key = (name, labels)
+        shard = self._get_shard()
+        with shard.lock:
+            shard.counters[key] = shard.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        """Adds the value to the histogram.
+        """
+        key = (name, labels)
+        i = bisect.bisect_left(self.buckets, value)
+        shard = self._get_shard()
+        with shard.lock:
+            h = shard.histograms.get(key)
+            if h is None:
+                # the count of each bucket, the +Inf bucket and the sum
+                h = shard.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            h[i] += 1
+            h[-1] += value
+
+    def collect(self):
+        """Returns the counters and the histograms combined from all the
+        shards, as dicts with (name, labels) as key.
+        """
+        counters = {}
+        histograms = {}
+        for shard in self.shards:
+            with shard.lock:
+                for key, value in shard.counters.items():
+                    counters[key] = counters.get(key, 0) + value
+                for key, h in shard.histograms.items():
+                    total = histograms.get(key)
+                    histograms[key] = list(h) if total is None else [a + b for a, b in zip(total, h)]
+        return counters, histograms
+
+def format_metrics(metrics_by_label):
+    """Formats the metrics in the Prometheus text format.
+
+    :param metrics_by_label: a list of the labels to add to all the metrics
+        and the :class:`Metrics`, like ``[((("function", "square"),), metrics)]``
+    """
+    samples = {}
+    for extra_labels, metrics in metrics_by_label:
+        counters, histograms = metrics.collect()
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append((extra_labels + labels, value))
+        for (name, labels), h in histograms.items():
+            samples.setdefault(name, []).append((extra_labels + labels, (metrics.buckets, h)))
+
+    lines = []
+    for name in sorted(samples):
+        kind, help = METRICS.get(name, ("untyped", name))
+        lines.append("# HELP {} {}".format(name, help))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, value in sorted(samples[name], key=lambda sample: sample[0]):
+            if kind == "histogram":
+                lines.extend(_format_histogram(name, labels, *value))
+            else:
+                lines.append(_format_sample(name, labels, value))
+    return "\n".join(lines) + "\n"
+
+def _format_histogram(name, labels, buckets, h):
+    cumulative = 0
+    for bound, count in zip(list(buckets) + ["+Inf"], h):
+        cumulative += count
+        yield _format_sample(name + "_bucket", labels + (("le", str(bound)),), cumulative)
+    yield _format_sample(name + "_sum", labels, h[-1])
+    yield _format_sample(name + "_count", labels, cumulative)
+
+def _format_sample(name, labels, value):
+    if labels:
+        name += "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + "}"
+    return "{} {}".format(name, repr(float(value)) if isinstance(value, float) else value)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -0,0 +1,193 @@
+"""Streaming parser for multipart/form-data request bodies.
+
+The body is read in chunks and each part is written to a spooled temporary
+file as it is read, so that the memory used does not depend on the size of
+the upload. Small parts stay in memory and the larger ones are moved to a
+temporary file on disk.
+"""
+import tempfile
+
+class PayloadTooLarge(ValueError):
+    """Raised when the request body or a part of it exceeds the limits.
+    """
+    pass
+
+def parse_header(line):
+    """Parses a header value like Content-Type or Content-Disposition into
+    the main value and a dict of the parameters.
+
+        >>> parse_header('form-data; name="data"; filename="a.csv"')
+        ('form-data', {'name': 'data', 'filename': 'a.csv'})
+    """
+    parts = _split_params(line)
+    key = parts[0].strip().lower()
+    params = {}
+    for p in parts[1:]:
+        name, sep, value = p.partition("=")
+        if not sep:
+            continue
+        name = name.strip().lower()
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            value = value[1:-1].replace('\\\\', '\\').replace('\\"', '"')
+        params[name] = value
+    return key, params
+
+def _split_params(line):
+    # splits at the semicolons that are not in quoted strings
+    parts = []
+    start = 0
+    quoted = False
+    i = 0
+    while i < len(line):
+        c = line[i]
+        if c == '\\' and quoted:
+            i += 1
+        elif c == '"':
+            quoted = not quoted
+        elif c == ';' and not quoted:
+            parts.append(line[start:i])
+            start = i + 1
+        i += 1
+    parts.append(line[start:])
+    return parts
+
+class _Reader(object):
+    """Buffered reader over the request body, which enforces the limit
+    on the total size of the body.
+    """
+    MAX_LINE = 8192
+
+    def __init__(self, fileobj, chunk_size, max_size):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.buffer = bytearray()
+        self.size = 0
+
+    def fill(self, required=True):
+        chunk = self.fileobj.read(self.chunk_size)
+        if not chunk:
+            if required:
+                raise ValueError("Unexpected end of multipart data")
+            return False
+        self.size += len(chunk)
+        if self.max_size is not None and self.size > self.max_size:
+            raise PayloadTooLarge("Request body is larger than {} bytes".format(self.max_size))
+        self.buffer += chunk
+        return True
+
+    def at_end(self):
+        """Tells whether the data is at the end of the closing delimiter,
+        which may not be followed by a newline.
+        """
+        while len(self.buffer) < 2 and self.fill(required=False):
+            pass
+        return self.buffer[:2] == b"--"
+
+    def read_line(self):
+        while True:
+            i = self.buffer.find(b"\r\n")
+            if i >= 0:
+                line = bytes(self.buffer[:i])
+                del self.buffer[:i+2]
+                return line
+            if len(self.buffer) > self.MAX_LINE:
+                raise ValueError("Multipart header line is too long")
+            self.fill()
+
+    def copy_until(self, separator, out=None, limit=None):
+        """Copies the data up to the separator to out and skips the
+        separator. The data is discarded when out is None.
+        """
+        # the last len(separator)-1 bytes in the buffer are kept back,
+        # as they could be the start of a separator split across chunks
+        keep = len(separator) - 1
+        written = 0
+        while True:
+            i = self.buffer.find(separator)
+            n = i if i >= 0 else len(self.buffer) - keep
+            if n > 0:
+                written += n
+                if limit is not None and written > limit:
+                    raise PayloadTooLarge("Part is larger than {} bytes".format(limit))
+                if out is not None:
+                    out.write(self.buffer[:n])
+                del self.buffer[:n]
+            if i >= 0:
+                del self.buffer[:len(separator)]
+                return
+            self.fill()
+
+def parse_multipart(fileobj, boundary, spool_size=1048576, max_part_size=None,
+                    max_size=None, chunk_size=65536):
+    """Parses a multipart/form-data body and returns a list of the name and
+    value of each part.
+
+    The parts with a filename are returned as file objects, positioned at
+    the start, with the ``filename`` attribute set. They are kept in memory
+    up to ``spool_size`` bytes and in a temporary file beyond that. The
+    other parts are returned as strings.
+
+    Raises :class:`PayloadTooLarge` when a part is larger than
+    ``max_part_size`` or the body is larger than ``max_size`` bytes, and
+    ValueError when the body is not valid.
+
+    :param fileobj: the file to read the body from
+    :param boundary: the boundary of the parts, from the Content-Type
+    :param spool_size: the max size of a file kept in memory
+    :param max_part_size: the max size of a part
+    :param max_size: the max size of the body
+    :param chunk_size: the size of the chunks in which the body is read
+    """
+    if not isinstance(boundary, bytes):
+        boundary = boundary.encode("latin-1")
+    delimiter = b"--" + boundary
+    reader = _Reader(fileobj, chunk_size, max_size)
+    fields = []
+    try:
+        # skip the preamble
+        reader.copy_until(delimiter)
+        while True:
+            if reader.at_end():
+                # the epilogue after the last part is ignored
+                break
+            if reader.read_line().strip():
+                raise ValueError("Invalid multipart boundary")
+
+            headers = _read_headers(reader)
+            _, params = parse_header(headers.get("content-disposition", ""))
+            name = params.get("name")
+            if name is None:
+                reader.copy_until(b"\r\n" + delimiter)
+                continue
+
+            spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+            fields.append((name, spool))
+            reader.copy_until(b"\r\n" + delimiter, spool, max_part_size)
+            spool.seek(0)
+
+            if "filename" in params:
+                spool.filename = params["filename"]
+            else:
+                _, ctype_params = parse_header(headers.get("content-type", "text/plain"))
+                value = spool.read().decode(ctype_params.get("charset", "utf-8"), "replace")
+                spool.close()
+                fields[-1] = (name, value)
+    except Exception:
+        for _, value in fields:
+            if hasattr(value, "close"):
+                value.close()
+        raise
+    return fields
+
+def _read_headers(reader):
+    headers = {}
+    while True:
+        line = reader.read_line()
+        if not line:
+            return headers
+        name, sep, value = line.decode("utf-8", "replace").partition(":")
+        if not sep:
+            raise ValueError("Invalid multipart header")
+        headers[name.strip().lower()] = value.strip()
@@ -0,0 +1,189 @@
+"""Profiling of the requests using cProfile.
+
+The profiler runs for a sampled fraction of the requests, for all the
+requests when a slow threshold is given, and for the requests that ask for
+it using the ``X-Firefly-Profile`` header when authentication is enabled.
+The profiles are kept in memory and are available at ``/_profiles``.
+
+Note that profiling every request to catch the slow ones has a noticeable
+overhead.
+"""
+import collections
+import cProfile
+import io
+import itertools
+import logging
+import marshal
+import pstats
+import random
+import threading
+import time
+from .metrics import clock
+
+logger = logging.getLogger("firefly")
+
+class Profile(object):
+    """The profile of a request.
+    """
+    def __init__(self, id, function, duration, status, reason, stats):
+        self.id = id
+        self.function = function
+        self.duration = duration
+        self.status = status
+        self.reason = reason
+        self.stats = stats
+        self.time = time.time()
+
+    def dict(self):
+        return {
+            "id": self.id,
+            "function": self.function,
+            "duration_ms": round(self.duration * 1000, 3),
+            "status": self.status,
+            "reason": self.reason,
+            "time": self.time
+        }
+
+    def get_pstats(self):
+        """Returns the profile in the binary format of the pstats module,
+        which can be loaded using ``pstats.Stats(filename)``.
+        """
+        return marshal.dumps(self.stats)
+
+    def get_text(self, limit=50):
+        """Returns the pstats report of the functions sorted by the
+        cumulative time.
+        """
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        p = pstats.Stats(_StatsHolder(dict(self.stats)), stream=out)
+        p.sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+    def get_collapsed(self):
+        """Returns the profile as collapsed stacks with the time in
+        microseconds, as used by flamegraph.pl and speedscope.
+
+        cProfile records only the caller-callee pairs, not the full stacks,
+        so the time of a function is split between its callers in the
+        ratio of the time spent in them.
+        """
+        children = collections.defaultdict(list)
+        roots = []
+        for func, (cc, nc, tt, ct, callers) in self.stats.items():
+            if not callers:
+                roots.append(func)
+            for caller, edge in callers.items():
+                # edge is (cc, nc, tt, ct) for the calls from the caller
+                children[caller].append((func, edge[3]))
+
+        lines = collections.Counter()
+        def walk(func, path, total):
+            cc, nc, tt, ct, callers = self.stats[func]
+            if ct <= 0:
+                return
+            self_time = total * tt / ct
+            if self_time >= 1e-6:
+                lines[";".join(_format_func(f) for f in path)] += int(self_time * 1e6)
+            if len(path) >= 64:
+                return
+            for child, edge_ct in children[func]:
+                # recursive calls are already included in the time
+                if child not in path:
+                    walk(child, path + [child], total * edge_ct / ct)
+
+        for root in roots:
+            walk(root, [root], self.stats[root][3])
+        return "".join("{} {}\n".format(stack, n) for stack, n in sorted(lines.items()) if n > 0)
+
+class _StatsHolder(object):
+    # pstats.Stats loads the stats from any object with a create_stats method
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+def _format_func(func):
+    filename, lineno, name = func
+    if filename == "~":
+        return name
+    return "{}:{}:{}".format(filename, lineno, name)
+
+class Profiler(object):
+    """Profiles the requests to the functions and keeps the recent profiles.
+
+    :param sample_rate: the fraction of the requests to profile
+    :param slow_ms: the profiles of the requests that take longer than
+        these many milliseconds are kept. All requests are profiled when
+        this is specified.
+    :param max_profiles: the max number of profiles to keep
+    """
+    HEADER = "X-Firefly-Profile"
+    ENVIRON_KEY = "HTTP_X_FIREFLY_PROFILE"
+
+    def __init__(self, sample_rate=0.0, slow_ms=None, max_profiles=20):
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self.profiles = collections.deque(maxlen=max_profiles)
+        self.lock = threading.Lock()
+        self.counter = itertools.count(1)
+
+    def configure(self, sample_rate=None, slow_ms=None, max_profiles=None):
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if slow_ms is not None:
+            self.slow_ms = slow_ms
+        if max_profiles is not None:
+            with self.lock:
+                self.profiles = collections.deque(self.profiles, maxlen=max_profiles)
+
+    def get_reason(self, request, allow_header):
+        """Returns the reason to profile the request, or None when it
+        should not be profiled.
+        """
+        if allow_header and request.environ.get(self.ENVIRON_KEY):
+            return "requested"
+        elif self.sample_rate > 0 and random.random() < self.sample_rate:
+            return "sampled"
+        elif self.slow_ms is not None:
+            return "slow"
+
+    def call(self, func, request, reason):
+        """Calls the FireflyFunction with the request under the profiler and
+        stores the profile when required.
+
+        The request is run without the profiler if another profiler is
+        already active.
+        """
+        profile = cProfile.Profile()
+        start = clock()
+        try:
+            profile.enable()
+        except ValueError:
+            # only one profiler can be active at a time from python 3.12
+            return func(request)
+        try:
+            response = func(request)
+        finally:
+            profile.disable()
+        duration = clock() - start
+
+        if reason == "slow" and duration * 1000 < self.slow_ms:
+            return response
+
+        profile.create_stats()
+        record = Profile(next(self.counter), func.name, duration, response.status_code, reason, profile.stats)
+        with self.lock:
+            self.profiles.append(record)
+        response.headers["X-Firefly-Profile-Id"] = str(record.id)
+        logger.info("profiled function %s (%s): %0.3f seconds, profile id %s",
+                    func.name, reason, duration, record.id)
+        return response
+
+    def list(self):
+        with self.lock:
+            return [p.dict() for p in reversed(self.profiles)]
+
+    def get(self, id):
+        with self.lock:
+            return next((p for p in self.profiles if p.id == id), None)
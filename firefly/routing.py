@@ -0,0 +1,147 @@
+"""Routing of the request paths to the functions.
+
+Besides the plain paths, a route can have parameters in the path, which
+are passed to the function as arguments:
+
+    /users/{id:int}         matches /users/42 with id=42
+    /users/{name}/posts     matches /users/alice/posts with name="alice"
+    /files/{path:path}      matches /files/a/b.txt with path="a/b.txt"
+
+A parameter matches a single segment of the path, unless it is of type
+``path``, which matches the rest of the path including the slashes. Such
+routes work as prefix routes. The supported types are ``str`` (the
+default), ``int``, ``float`` and ``path``.
+
+The plain paths are looked up in a dict. The routes with parameters are
+compiled together into a single regular expression, so that a path is
+matched against all of them in one go.
+"""
+import re
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+# the regular expression and the conversion function of each type
+CONVERTERS = {
+    "str": (r"[^/]+", str),
+    "int": (r"-?[0-9]+", int),
+    "float": (r"-?[0-9]+(?:\.[0-9]+)?", float),
+    "path": (r".*", str),
+}
+
+_param_re = re.compile(r"{([a-zA-Z_][a-zA-Z0-9_]*)(?::([a-z]+))?}")
+
+def is_pattern(path):
+    """Returns True if the path has parameters.
+    """
+    return _param_re.search(path) is not None
+
+def get_path_params(path):
+    """Returns the names of the parameters in the path.
+    """
+    return [m.group(1) for m in _param_re.finditer(path)]
+
+def build_path(path, kwargs):
+    """Fills the parameters of the path with the values from kwargs.
+
+    Returns the path and the remaining kwargs. Raises KeyError when the
+    value of a parameter is missing.
+    """
+    kwargs = dict(kwargs)
+    def replace(m):
+        value = kwargs.pop(m.group(1))
+        safe = "/" if m.group(2) == "path" else ""
+        return quote(str(value), safe=safe)
+    return _param_re.sub(replace, path), kwargs
+
+class Route(object):
+    """A route with parameters in the path.
+    """
+    def __init__(self, path, value):
+        self.path = path
+        self.value = value
+        self.params = []
+        self.is_prefix = False
+
+        parts = []
+        pos = 0
+        for m in _param_re.finditer(path):
+            name, kind = m.group(1), m.group(2) or "str"
+            if kind not in CONVERTERS:
+                raise ValueError("Unknown type of path parameter {} in {}: {}".format(name, path, kind))
+            if name in [p for p, convert in self.params]:
+                raise ValueError("Duplicate path parameter {} in {}".format(name, path))
+            regex, convert = CONVERTERS[kind]
+            parts.append(re.escape(path[pos:m.start()]))
+            parts.append("(" + regex + ")")
+            self.params.append((name, convert))
+            self.is_prefix = self.is_prefix or kind == "path"
+            pos = m.end()
+        parts.append(re.escape(path[pos:]))
+        self.regex = "".join(parts)
+
+class Router(object):
+    """Maps the paths to values, usually the functions.
+
+    The plain paths take precedence over the routes with parameters. The
+    routes with parameters are tried in the order they were added, except
+    the prefix routes, which are tried last.
+    """
+    def __init__(self):
+        self.static = {}
+        self.routes = []
+        self._compiled = None
+
+    def add(self, path, value):
+        self.remove(path)
+        if is_pattern(path):
+            self.routes.append(Route(path, value))
+            self._compiled = None
+        else:
+            self.static[path] = value
+
+    def remove(self, path):
+        self.static.pop(path, None)
+        if any(route.path == path for route in self.routes):
+            self.routes = [route for route in self.routes if route.path != path]
+            self._compiled = None
+
+    def compile(self):
+        routes = sorted(self.routes, key=lambda route: route.is_prefix)
+        # each route is a group of the regular expression, which contains
+        # the groups of its parameters
+        table = {}
+        regexes = []
+        group = 1
+        for route in routes:
+            table[group] = route
+            regexes.append("(" + route.regex + ")")
+            group += len(route.params) + 1
+        regex = re.compile("^(?:" + "|".join(regexes) + r")\Z") if regexes else None
+        return regex, table
+
+    def match(self, path):
+        """Returns the value of the route matching the path and the dict
+        of the path parameters, or (None, None) when no route matches.
+        """
+        value = self.static.get(path)
+        if value is not None:
+            return value, {}
+        if not self.routes:
+            return None, None
+
+        compiled = self._compiled
+        if compiled is None:
+            compiled = self._compiled = self.compile()
+        regex, table = compiled
+        m = regex.match(path)
+        if m is None:
+            return None, None
+
+        # the group of the route closes after the groups of its parameters
+        route = table[m.lastindex]
+        values = m.groups()[m.lastindex:m.lastindex + len(route.params)]
+        params = {name: convert(v) for (name, convert), v in zip(route.params, values)}
+        return route.value, params
@@ -0,0 +1,205 @@
+"""Servers to run the firefly applications.
+
+By default, the application is served by a threaded wsgiref server, which
+doesn't need any dependencies. When any of the worker options is given,
+it is served by gunicorn with a prefork worker model instead.
+"""
+import logging
+import threading
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+
+logger = logging.getLogger("firefly")
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    """WSGI server that handles each request in a new thread.
+    """
+    daemon_threads = True
+
+class ChunkedInput(object):
+    """File-like object to read a request body sent using chunked transfer
+    encoding, which wsgiref passes on to the app as it is.
+
+    Reading returns an empty string at the end of the body, after the last
+    chunk and the trailers.
+    """
+    def __init__(self, rfile, max_line=65536):
+        self.rfile = rfile
+        self.max_line = max_line
+        # the bytes left in the current chunk
+        self.remaining = 0
+        self.eof = False
+
+    def _next_chunk(self):
+        line = self.rfile.readline(self.max_line + 1)
+        try:
+            size = int(line.split(b";")[0].strip(), 16)
+        except ValueError:
+            raise ValueError("Invalid chunk size in the request body: {!r}".format(line[:100]))
+        if size < 0:
+            raise ValueError("Invalid chunk size in the request body: {!r}".format(line[:100]))
+        if size == 0:
+            # the trailers, if any, end with an empty line
+            while line.strip():
+                line = self.rfile.readline(self.max_line + 1)
+            self.eof = True
+        self.remaining = size
+
+    def _read(self, size, line=False):
+        read = self.rfile.readline if line else self.rfile.read
+        chunks = []
+        while not self.eof and size != 0:
+            if not self.remaining:
+                self._next_chunk()
+                continue
+            data = read(self.remaining if size < 0 else min(size, self.remaining))
+            if not data:
+                raise ValueError("The request body ended in the middle of a chunk")
+            chunks.append(data)
+            self.remaining -= len(data)
+            if size > 0:
+                size -= len(data)
+            if not self.remaining:
+                # the line break after the data of the chunk
+                self.rfile.readline(self.max_line + 1)
+            if line and data.endswith(b"\n"):
+                break
+        return b"".join(chunks)
+
+    def read(self, size=-1):
+        return self._read(-1 if size is None else size)
+
+    def readline(self, size=-1):
+        return self._read(-1 if size is None else size, line=True)
+
+    def readlines(self, hint=None):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def close(self):
+        self.rfile.close()
+
+class RequestHandler(WSGIRequestHandler):
+    """Request handler of the threaded server, which de-chunks the request
+    bodies sent using chunked transfer encoding, like gunicorn does.
+    """
+    def parse_request(self):
+        if not WSGIRequestHandler.parse_request(self):
+            return False
+        encodings = self.headers.get("Transfer-Encoding", "").lower().split(",")
+        if encodings[-1].strip() == "chunked":
+            self.rfile = ChunkedInput(self.rfile)
+        return True
+
+    def get_environ(self):
+        environ = WSGIRequestHandler.get_environ(self)
+        if isinstance(self.rfile, ChunkedInput):
+            # tells the app that the body can be read to the end without
+            # the Content-Length
+            environ["wsgi.input_terminated"] = True
+        return environ
+
+def run_server(app, host, port, workers=None, threads=None, worker_class=None,
+               max_requests=0, max_requests_jitter=0, timeout=None, graceful_timeout=None,
+               asgi=False, warmup=False):
+    """Serves the app on the given host and port.
+
+    When any of workers, threads or worker_class is specified, the app is
+    served using gunicorn. The app is loaded before the workers are forked,
+    so all the functions are imported only once and the memory is shared
+    between the workers.
+
+    Sending a HUP signal to the gunicorn master process gracefully restarts
+    the workers. The workers are also restarted after serving max_requests
+    requests, when specified.
+
+    When asgi is set, the ASGI interface of the app is served using gunicorn
+    with the uvicorn worker class, unless another worker class is specified.
+
+    When warmup is set, the lazily loaded functions are imported in the
+    background once the server is listening, in each worker process.
+    """
+    if asgi:
+        app = app.asgi()
+        worker_class = worker_class or "uvicorn.workers.UvicornWorker"
+
+    if workers or threads or worker_class:
+        options = {
+            "bind": "{}:{}".format(host, port),
+            "workers": workers,
+            "threads": threads,
+            "worker_class": worker_class,
+            "max_requests": max_requests,
+            "max_requests_jitter": max_requests_jitter,
+            "timeout": timeout,
+            "graceful_timeout": graceful_timeout,
+            "warmup": warmup,
+        }
+        run_gunicorn(app, options)
+    else:
+        start_executors(app)
+        server = make_server(host, port, app, server_class=ThreadingWSGIServer,
+                             handler_class=RequestHandler)
+        if warmup:
+            start_warmup(app)
+        server.serve_forever()
+
+def start_executors(app):
+    # the ASGI app wraps the firefly app
+    app = getattr(app, "app", app)
+    if hasattr(app, "start_executors"):
+        app.start_executors()
+
+def start_warmup(app):
+    """Imports the lazily loaded functions of the app in a background
+    thread.
+    """
+    app = getattr(app, "app", app)
+    if hasattr(app, "warmup"):
+        thread = threading.Thread(target=app.warmup, name="firefly-warmup")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+def run_gunicorn(app, options):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        raise ImportError("gunicorn is required to run firefly with workers. Please install it using: pip install gunicorn")
+
+    # not a gunicorn setting
+    options = dict(options)
+    warmup = options.pop("warmup", False)
+
+    class FireflyApplication(BaseApplication):
+        def __init__(self, app, options):
+            self.application = app
+            self.options = options
+            BaseApplication.__init__(self)
+
+        def load_config(self):
+            # load the app in the master process, before forking the workers
+            self.cfg.set("preload_app", True)
+            # the process pools are started in each worker, after the fork
+            self.cfg.set("post_worker_init", self.post_worker_init)
+            for key, value in self.options.items():
+                if value is not None:
+                    self.cfg.set(key, value)
+
+        def post_worker_init(self, worker):
+            start_executors(self.application)
+            # the functions are imported after the fork, as importing them
+            # in a thread of the master process is not safe to fork
+            if warmup:
+                start_warmup(self.application)
+
+        def load(self):
+            return self.application
+
+    FireflyApplication(app, options).run()
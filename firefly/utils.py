@@ -1,5 +1,14 @@
+import os
 import sys
+import stat
+import re
 import json
+import inspect
+import logging
+
+logger = logging.getLogger("firefly")
+
+RANGE_RE = re.compile(r"^bytes=\s*(\d*)\s*-\s*(\d*)$")
 
 PY2 = (sys.version_info.major == 2)
 PY3 = (sys.version_info.major == 3)
@@ -10,17 +19,166 @@ def json_encode(data):
         result = result.decode('utf-8')
     return result
 
+def iscoroutinefunction(func):
+    # not available in python 2
+    return getattr(inspect, "iscoroutinefunction", lambda f: False)(func)
+
+def run_coroutine(coro):
+    """Runs the coroutine to completion in a new event loop and returns
+    its result.
+    """
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
 def is_file(obj):
     return hasattr(obj, "read")
 
+def is_stream(obj):
+    """Tells whether the object is a generator or an iterator, which can
+    be streamed to the client one item at a time.
+    """
+    return (hasattr(obj, "__next__") or hasattr(obj, "next")) and hasattr(obj, "__iter__")
+
 class FileIter:
-    def __init__(self, fileobj, chunk_size=4096):
+    """Iterator over the contents of a file in chunks.
+
+    When limit is specified, only that many bytes are read from the file.
+    The file is closed when the iterator is closed.
+    """
+    def __init__(self, fileobj, chunk_size=1048576, limit=None):
         self.fileobj = fileobj
         self.chunk_size = chunk_size
+        self.limit = limit
 
     def __iter__(self):
-        while True:
-            chunk = self.fileobj.read(self.chunk_size)
+        remaining = self.limit
+        while remaining is None or remaining > 0:
+            size = self.chunk_size if remaining is None else min(self.chunk_size, remaining)
+            chunk = self.fileobj.read(size)
             if not chunk:
                 break
+            if remaining is not None:
+                remaining -= len(chunk)
             yield chunk
+
+    def close(self):
+        if hasattr(self.fileobj, "close"):
+            self.fileobj.close()
+
+def get_file_size(fileobj):
+    """Returns the number of bytes from the current position to the end
+    of the file, or None when it can't be found without reading the file.
+    """
+    try:
+        position = fileobj.tell()
+        st = os.fstat(fileobj.fileno())
+        if stat.S_ISREG(st.st_mode):
+            return st.st_size - position
+    except (AttributeError, OSError, IOError, ValueError):
+        pass
+
+    try:
+        if fileobj.seekable():
+            position = fileobj.tell()
+            end = fileobj.seek(0, os.SEEK_END)
+            fileobj.seek(position)
+            return end - position
+    except (AttributeError, OSError, IOError, ValueError):
+        pass
+    return None
+
+def is_os_file(fileobj):
+    """Tells whether the file is a regular file on disk, which can be
+    sent using sendfile.
+    """
+    try:
+        return stat.S_ISREG(os.fstat(fileobj.fileno()).st_mode)
+    except (AttributeError, OSError, IOError, ValueError):
+        return False
+
+def parse_range(header, size):
+    """Parses the value of a Range header for a file of the given size.
+
+    Returns the (start, end) of the range, both inclusive, or None when the
+    header is not a single byte range, in which case the whole file is to
+    be sent. Raises ValueError when the range is not satisfiable.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+
+    first, last = match.groups()
+    if not first:
+        # suffix range, the last n bytes
+        n = int(last)
+        if n == 0 or size == 0:
+            raise ValueError("Range not satisfiable")
+        return max(size - n, 0), size - 1
+
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+def iter_lines(fileobj, chunk_size=65536):
+    """Reads the file incrementally and yields the lines in it, without
+    the line endings.
+    """
+    pending = b""
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+class NDJSONIter:
+    """Iterator over the newline-delimited JSON encoding of the items.
+
+    The first item is sent right away, to get the first byte to the client
+    as soon as possible, and the rest are combined into chunks of at least
+    chunk_size bytes.
+    """
+    def __init__(self, items, codec, chunk_size=65536):
+        self.items = items
+        self.codec = codec
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        encode = self.codec.encode
+        buffer = []
+        size = 0
+        first = True
+        try:
+            for item in self.items:
+                line = encode(item) + b"\n"
+                if first:
+                    yield line
+                    first = False
+                    continue
+                buffer.append(line)
+                size += len(line)
+                if size >= self.chunk_size:
+                    yield b"".join(buffer)
+                    buffer = []
+                    size = 0
+        except Exception:
+            # When streaming a response, the status is already sent and the
+            # error can only be reported by aborting the response.
+            logger.error("Streaming the items failed.", exc_info=True)
+            raise
+        if buffer:
+            yield b"".join(buffer)
+
+    def close(self):
+        if hasattr(self.items, "close"):
+            self.items.close()
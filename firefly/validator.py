@@ -1,9 +1,9 @@
 from .utils import PY2, PY3
 
 if PY3:
-    from inspect import signature
+    from inspect import signature, Parameter
 else:
-    from funcsigs import signature
+    from funcsigs import signature, Parameter
 
 class ValidationError(Exception):
     pass
@@ -17,3 +17,72 @@ def validate_args(function, kwargs):
         function_signature.bind(**kwargs)
     except TypeError as err:
         raise ValidationError(str(err))
+
+class CallPlan(object):
+    """Precompiled description of how a function can be called with keyword
+    arguments.
+
+    The plan is computed once from the function signature, so that validating
+    the arguments of every request is reduced to a few set operations instead
+    of introspecting the function again. The error messages are identical to
+    the ones generated by ``Signature.bind``.
+    """
+    def __init__(self, function_signature):
+        self.signature = function_signature
+
+        # (name, is_required, is_positional_only) in the order of declaration
+        self.checks = []
+        self.defaults = {}
+        self.var_keyword = False
+
+        for name, param in function_signature.parameters.items():
+            if param.kind == Parameter.VAR_KEYWORD:
+                self.var_keyword = True
+                continue
+            if param.kind == Parameter.VAR_POSITIONAL:
+                continue
+            required = param.default is Parameter.empty
+            if not required:
+                self.defaults[name] = param.default
+            self.checks.append((name, required, param.kind == Parameter.POSITIONAL_ONLY))
+
+        self.parameters = [name for name, _, _ in self.checks]
+        self.required = frozenset(name for name, required, _ in self.checks if required)
+        self.optional = frozenset(self.defaults)
+        self.keywords = frozenset(name for name, _, positional_only in self.checks if not positional_only)
+        self.positional_only = frozenset(name for name, _, positional_only in self.checks if positional_only)
+
+    @classmethod
+    def from_function(cls, function):
+        return cls(signature(function))
+
+    def validate(self, kwargs):
+        """Validates the kwargs against the plan and raises ValidationError
+        if the function can not be called with them.
+        """
+        if not isinstance(kwargs, dict):
+            raise ValidationError(
+                "argument after ** must be a mapping, not {}".format(type(kwargs).__name__))
+        keys = kwargs.keys() if PY3 else set(kwargs)
+        if (keys >= self.required
+                and (self.var_keyword or keys <= self.keywords)
+                and not (self.positional_only and self.positional_only & keys)):
+            return
+        raise ValidationError(self._get_error(kwargs))
+
+    def _get_error(self, kwargs):
+        # walk the parameters in the same order as Signature.bind
+        # to report the same error that it would have reported
+        remaining = dict(kwargs)
+        for name, required, positional_only in self.checks:
+            if name in remaining:
+                if positional_only:
+                    return '{arg!r} parameter is positional only, but was passed as a keyword'.format(arg=name)
+                del remaining[name]
+            elif required:
+                return 'missing a required argument: {arg!r}'.format(arg=name)
+
+        if remaining and not self.var_keyword:
+            # pick the first unexpected argument in the order they were passed
+            arg = next(k for k in kwargs if k in remaining)
+            return 'got an unexpected keyword argument {arg!r}'.format(arg=arg)
@@ -1,8 +1,11 @@
 import io
+import json
 import sys
+import threading
+import time
 import pytest
 from webob import Request, Response
-from firefly.app import Firefly, FireflyFunction, ctx
+from firefly.app import Firefly, FireflyFunction, DeadlineExceeded, ctx, get_remaining_time
 
 py2_only = pytest.mark.skipif(sys.version_info.major >= 3, reason="Requires Python 2")
 py3_only = pytest.mark.skipif(sys.version_info.major < 3, reason="Requires Python 3+")
@@ -60,6 +63,16 @@ class TestFirefly:
         assert response.status == '200 OK'
         assert response.text == '9'
 
+    def test_codec(self):
+        app = Firefly(codec="json")
+        app.add_route("/square", square)
+        assert app.mapping["/square"].codec.name == "json"
+
+        app.set_codec("orjson")
+        assert app.mapping["/square"].codec.name == "orjson"
+        response = app.process_request(Request.blank("/square", POST='{"a": 3}'))
+        assert response.text == '9'
+
     def test_auth_failure(self):
         app = Firefly(auth_token='abcd')
         app.add_route("/", square)
@@ -76,6 +89,85 @@ class TestFirefly:
         response = app.process_request(request)
         assert response.status == '403 Forbidden'
 
+    def test_auth_header_variants(self):
+        app = Firefly(auth_token='abcd')
+        app.add_route("/", square)
+        for auth in ["Token abcd", "token  abcd"]:
+            request = Request.blank("/", POST='{"a": 3}', headers={"Authorization": auth})
+            assert app.process_request(request).status == '200 OK'
+
+    def test_cors_headers(self):
+        app = Firefly(allowed_origins=["http://a.com", "http://b.com"])
+        app.add_route("/square", square)
+        response = app.process_request(Request.blank("/square", POST='{"a": 3}'))
+        assert response.headers['Access-Control-Allow-Origin'] == "http://a.com, http://b.com"
+
+        response = app.process_request(Request.blank("/square", method="OPTIONS"))
+        assert response.headers['Access-Control-Allow-Methods'] == "GET,POST"
+
+        app.set_allowed_origins(None)
+        response = app.process_request(Request.blank("/square", POST='{"a": 3}'))
+        assert 'Access-Control-Allow-Origin' not in response.headers
+
+    def test_wsgi_call(self):
+        app = Firefly()
+        app.add_route("/square", square)
+        app.add_route("/redirect", lambda: Response(status=302, location="/square"))
+
+        response = Request.blank("/square", POST='{"a": 3}').get_response(app)
+        assert response.status == '200 OK'
+        assert response.content_type == 'application/json'
+        assert response.json == 9
+
+        response = Request.blank("/square", POST='{"a": 3}', method="HEAD").get_response(app)
+        assert response.body == b''
+
+        response = Request.blank("/redirect", POST='{}').get_response(app)
+        assert response.location == "http://localhost/square"
+
+    def test_path_params(self):
+        def get_user(id, fields=None):
+            return {"id": id, "fields": fields}
+        def read_file(path):
+            return path
+
+        app = Firefly()
+        app.add_route("/users/{id:int}", get_user)
+        app.add_route("/files/{path:path}", read_file)
+
+        response = app.process_request(Request.blank("/users/42"))
+        assert response.json == {"id": 42, "fields": None}
+        response = app.process_request(Request.blank("/users/42", POST='{"fields": ["name"], "id": 1}'))
+        assert response.json == {"id": 42, "fields": ["name"]}
+        response = app.process_request(Request.blank("/users/42", POST='[1]'))
+        assert response.status == '400 Bad Request'
+        response = app.process_request(Request.blank("/users/alice"))
+        assert response.status == '404 Not Found'
+        response = app.process_request(Request.blank("/files/a/b.txt", POST='{}'))
+        assert response.json == "a/b.txt"
+
+        assert app.generate_function_list()["get_user"]["path"] == "/users/{id:int}"
+        with pytest.raises(ValueError):
+            app.add_route("/squares/{n}", square)
+
+    def test_index_etag(self):
+        app = Firefly()
+        app.add_route("/square", square)
+        response = app.process_request(Request.blank("/"))
+        etag = response.headers['ETag']
+        assert response.status == '200 OK'
+        assert "square" in response.json["functions"]
+
+        response = app.process_request(Request.blank("/", headers={"If-None-Match": etag}))
+        assert response.status == '304 Not Modified'
+        assert response.body == b''
+
+        app.add_route("/cube", lambda a: a**3, "cube")
+        response = app.process_request(Request.blank("/", headers={"If-None-Match": etag}))
+        assert response.status == '200 OK'
+        assert response.headers['ETag'] != etag
+        assert "cube" in response.json["functions"]
+
     def test_http_error_404(self):
         app = Firefly()
         app.add_route("/", square)
@@ -117,6 +209,138 @@ class TestFirefly:
         assert response.status == '200 OK'
         assert response.json == 1
 
+    def test_batch(self):
+        def fail(a):
+            raise ValueError("This is a test")
+
+        app = Firefly()
+        app.add_route("/square", square, "square")
+        app.add_route("/fail", fail, "fail")
+
+        calls = [
+            {"function": "square", "kwargs": {"a": 3}},
+            {"function": "/square", "kwargs": {"a": 4}},
+            {"function": "square", "kwargs": {"b": 4}},
+            {"function": "fail", "kwargs": {"a": 1}},
+            {"function": "cube", "kwargs": {"a": 1}},
+            {"function": "_batch", "kwargs": {"calls": []}},
+        ]
+        request = Request.blank("/_batch", POST=json.dumps({"calls": calls}))
+        response = app.process_request(request)
+        assert response.status == '200 OK'
+        assert response.json == [
+            {"status": 200, "result": 9},
+            {"status": 200, "result": 16},
+            {"status": 422, "error": "missing a required argument: 'a'"},
+            {"status": 500, "error": "ValueError: This is a test"},
+            {"status": 404, "error": "Not found: cube"},
+            {"status": 404, "error": "Not found: _batch"},
+        ]
+
+    def test_batch_generator(self):
+        def count(n):
+            return iter(range(n))
+        app = Firefly()
+        app.add_route("/count", count)
+        calls = [{"function": "count", "kwargs": {"n": 3}}]
+        request = Request.blank("/_batch", POST=json.dumps({"calls": calls}))
+        response = app.process_request(request)
+        assert response.json == [{"status": 200, "result": [0, 1, 2]}]
+
+    def test_batch_limits(self):
+        started = threading.Event()
+        finish = threading.Event()
+        def slow():
+            started.set()
+            finish.wait(5)
+            return "done"
+        app = Firefly()
+        app.add_route("/slow", slow, max_concurrency=1)
+        app.add_route("/square", square)
+        batch = lambda calls: Request.blank("/_batch", POST=json.dumps({"calls": calls}))
+
+        t = threading.Thread(target=app.process_request, args=(Request.blank("/slow", POST='{}'),))
+        t.start()
+        started.wait(5)
+        # the calls in a batch can't exceed the limit of the function
+        response = app.process_request(batch([{"function": "slow"}, {"function": "square", "kwargs": {"a": 2}}]))
+        assert response.json == [
+            {"status": 503, "error": "Server is overloaded, please try again later."},
+            {"status": 200, "result": 4}
+        ]
+        finish.set()
+        t.join()
+        assert app.mapping["/slow"].limiter.active == 0
+
+        # a batch request takes a slot of the global limit
+        app.set_limits(max_concurrency=1)
+        app.limiter.acquire()
+        response = app.process_request(batch([{"function": "square", "kwargs": {"a": 2}}]))
+        assert response.status == '503 Service Unavailable'
+        app.limiter.release()
+        response = app.process_request(batch([{"function": "square", "kwargs": {"a": 2}}]))
+        assert response.json == [{"status": 200, "result": 4}]
+        assert app.limiter.active == 0
+
+    def test_batch_cached(self):
+        calls = []
+        def power(x, n=2):
+            calls.append(x)
+            return x ** n
+        app = Firefly()
+        app.add_route("/power", power, cache={"max_entries": 10})
+
+        batch = [{"function": "power", "kwargs": {"x": 3}}] * 3
+        response = app.process_request(Request.blank("/_batch", POST=json.dumps({"calls": batch})))
+        assert response.json == [{"status": 200, "result": 9}] * 3
+        assert calls == [3]
+
+        # the batch calls and the separate requests share the cache
+        response = app.process_request(Request.blank("/power", POST='{"x": 3, "n": 2}'))
+        assert response.json == 9
+        assert response.headers['X-Firefly-Cache'] == 'hit'
+        assert calls == [3]
+        assert app.get_cache_stats()["power"]["hits"] == 3
+
+    def test_batch_timeout(self):
+        def slow():
+            time.sleep(1)
+            return "done"
+        app = Firefly()
+        app.add_route("/slow", slow, timeout=0.2)
+        app.add_route("/square", square)
+
+        calls = [{"function": "slow"}, {"function": "square", "kwargs": {"a": 2}}]
+        t0 = time.time()
+        response = app.process_request(Request.blank("/_batch", POST=json.dumps({"calls": calls})))
+        assert time.time() - t0 < 0.9
+        assert response.json == [
+            {"status": 504, "error": "Deadline exceeded"},
+            {"status": 200, "result": 4}
+        ]
+
+    def test_batch_metrics(self):
+        app = Firefly()
+        app.add_route("/square", square, function_name="square")
+        calls = [{"function": "square", "kwargs": {"a": 3}}, {"function": "square", "kwargs": {"b": 3}}]
+        app.process_request(Request.blank("/_batch", POST=json.dumps({"calls": calls})))
+
+        lines = app.process_request(Request.blank("/_metrics")).text.splitlines()
+        assert 'firefly_requests_total{function="square",status="200"} 1' in lines
+        assert 'firefly_requests_total{function="square",status="422"} 1' in lines
+        assert 'firefly_requests_in_flight{function="square"} 0' in lines
+        assert 'firefly_requests_total{function="run_batch",status="200"} 1' in lines
+
+    def test_batch_invalid_calls(self):
+        app = Firefly()
+        request = Request.blank("/_batch", POST='{"calls": {}}')
+        response = app.process_request(request)
+        assert response.status == '400 Bad Request'
+
+        request = Request.blank("/_batch", POST='{}')
+        response = app.process_request(request)
+        assert response.status == '422 Unprocessable Entity'
+
 class TestFireflyFunction:
     def test_call(self):
         func = FireflyFunction(square)
@@ -125,6 +349,390 @@ class TestFireflyFunction:
         assert response.status == '200 OK'
         assert response.text == '9'
 
+    def test_process_executor_requires_python38(self, monkeypatch):
+        monkeypatch.setattr(sys, "version_info", (3, 7, 0))
+        with pytest.raises(ValueError) as e:
+            FireflyFunction(square, executor="process")
+        assert "Python 3.8" in str(e.value)
+
+    def test_call_batched(self):
+        def power(x, n=2):
+            return [a ** b for a, b in zip(x, n)]
+        func = FireflyFunction(power, batch={"max_wait_ms": 0})
+        request = Request.blank("/power", POST='{"x": 3}')
+        response = func(request)
+        assert response.status == '200 OK'
+        assert response.text == '9'
+
+        request = Request.blank("/power", POST='{"y": 3}')
+        response = func(request)
+        assert response.status == '422 Unprocessable Entity'
+
+    def test_call_with_msgpack(self):
+        msgpack = pytest.importorskip("msgpack")
+        func = FireflyFunction(square)
+        headers = {"Content-Type": "application/msgpack", "Accept": "application/msgpack"}
+        request = Request.blank("/square", POST=msgpack.packb({"a": 3}), headers=headers)
+        response = func(request)
+        assert response.status == '200 OK'
+        assert response.content_type == "application/msgpack"
+        assert msgpack.unpackb(response.body) == 9
+
+    def test_call_with_msgpack_big_integers(self):
+        msgpack = pytest.importorskip("msgpack")
+        func = FireflyFunction(lambda n: n * 2)
+        headers = {"Content-Type": "application/json", "Accept": "application/msgpack"}
+        request = Request.blank("/double", POST=json.dumps({"n": 2**70}), headers=headers)
+        response = func(request)
+        # msgpack can't encode the result, which is sent as JSON
+        assert response.status == '200 OK'
+        assert response.content_type == "application/json"
+        assert json.loads(response.text) == 2**71
+
+    def test_call_with_ndarray(self):
+        np = pytest.importorskip("numpy")
+        from firefly.codecs import NDArrayCodec
+        codec = NDArrayCodec()
+        func = FireflyFunction(square)
+        headers = {"Content-Type": codec.content_type, "Accept": codec.content_type + ", application/json"}
+        request = Request.blank("/square", POST=codec.encode({"a": np.arange(4)}), headers=headers)
+        response = func(request)
+        assert response.status == '200 OK'
+        assert response.content_type == codec.content_type
+        assert list(codec.decode(response.body)) == [0, 1, 4, 9]
+
+        # results without arrays are sent as json
+        headers["Content-Type"] = "application/json"
+        request = Request.blank("/square", POST='{"a": 3}', headers=headers)
+        response = func(request)
+        assert response.content_type == "application/json"
+        assert response.text == '9'
+
+    def test_call_cached(self):
+        calls = []
+        def power(x, n=2):
+            calls.append(x)
+            return x ** n
+        app = Firefly()
+        app.add_route("/power", power, cache={"max_entries": 10})
+
+        for body in ['{"x": 3}', '{"x": 3, "n": 2}', '{"x": 3}']:
+            response = app.process_request(Request.blank("/power", POST=body))
+            assert response.status == '200 OK'
+            assert response.text == '9'
+        assert calls == [3]
+        assert response.headers['X-Firefly-Cache'] == 'hit'
+
+        # errors are not cached
+        for i in range(2):
+            response = app.process_request(Request.blank("/power", POST='{"y": 3}'))
+            assert response.status == '422 Unprocessable Entity'
+
+        response = app.process_request(Request.blank("/_cache"))
+        assert response.json == {"power": {"entries": 1, "bytes": 1, "hits": 2, "misses": 3, "evictions": 0}}
+
+    def test_call_overloaded(self):
+        started = threading.Event()
+        finish = threading.Event()
+        def slow():
+            started.set()
+            finish.wait(5)
+            return "done"
+        app = Firefly()
+        app.add_route("/slow", slow, max_concurrency=1, retry_after=2)
+
+        responses = []
+        t = threading.Thread(target=lambda: responses.append(app.process_request(Request.blank("/slow", POST='{}'))))
+        t.start()
+        started.wait(5)
+        response = app.process_request(Request.blank("/slow", POST='{}'))
+        assert response.status == '503 Service Unavailable'
+        assert response.headers['Retry-After'] == '2'
+        finish.set()
+        t.join()
+        assert responses[0].json == "done"
+        assert app.process_request(Request.blank("/_limits")).json == {
+            "slow": {"active": 0, "waiting": 0, "rejected": 1}}
+
+    def test_call_global_limit(self):
+        app = Firefly()
+        app.add_route("/square", lambda x: x ** 2)
+        app.set_limits(max_concurrency=1)
+        # the slot is taken by another request
+        app.limiter.acquire()
+        response = app.process_request(Request.blank("/square", POST='{"x": 2}'))
+        assert response.status == '503 Service Unavailable'
+        app.limiter.release()
+        response = app.process_request(Request.blank("/square", POST='{"x": 2}'))
+        assert response.json == 4
+
+    def test_call_global_limit_with_queued_function(self):
+        started = threading.Event()
+        finish = threading.Event()
+        def slow():
+            started.set()
+            finish.wait(5)
+            return "done"
+        app = Firefly()
+        app.add_route("/slow", slow, max_concurrency=1, max_queue=10)
+        app.add_route("/square", lambda x: x ** 2)
+        app.set_limits(max_concurrency=2)
+
+        threads = [threading.Thread(target=app.process_request, args=(Request.blank("/slow", POST='{}'),))
+                   for i in range(3)]
+        for t in threads:
+            t.start()
+        started.wait(5)
+        deadline = time.time() + 5
+        while app.mapping["/slow"].limiter.waiting + app.limiter.stats()["rejected"] < 2 and time.time() < deadline:
+            time.sleep(0.001)
+        # the requests waiting for /slow don't hold the global slots
+        assert app.limiter.active == 1
+        response = app.process_request(Request.blank("/square", POST='{"x": 2}'))
+        assert response.json == 4
+        finish.set()
+        for t in threads:
+            t.join()
+        assert app.limiter.active == 0
+
+    def test_call_with_deadline(self):
+        finish = threading.Event()
+        def slow():
+            finish.wait(5)
+            return get_remaining_time()
+        app = Firefly()
+        app.add_route("/slow", slow)
+
+        headers = {"X-Firefly-Timeout": "0.05"}
+        response = app.process_request(Request.blank("/slow", POST='{}', headers=headers))
+        assert response.status == '504 Gateway Timeout'
+        assert response.json == {"error": "Deadline exceeded"}
+
+        finish.set()
+        headers = {"X-Firefly-Timeout": "5"}
+        response = app.process_request(Request.blank("/slow", POST='{}', headers=headers))
+        assert 0 < response.json <= 5
+
+        # no deadline
+        response = app.process_request(Request.blank("/slow", POST='{}'))
+        assert response.json is None
+
+        headers = {"X-Firefly-Timeout": "0"}
+        response = app.process_request(Request.blank("/slow", POST='{}', headers=headers))
+        assert response.status == '504 Gateway Timeout'
+
+        for value in ["soon", "inf", "-inf", "nan", "1e400"]:
+            headers = {"X-Firefly-Timeout": value}
+            response = app.process_request(Request.blank("/slow", POST='{}', headers=headers))
+            assert response.status == '400 Bad Request'
+            assert response.json == {"error": "Invalid X-Firefly-Timeout header: " + value}
+
+        # the very large timeouts are lowered
+        headers = {"X-Firefly-Timeout": "1e300"}
+        response = app.process_request(Request.blank("/slow", POST='{}', headers=headers))
+        assert 0 < response.json <= 86400
+
+    def test_call_with_timeout_option(self):
+        def fail():
+            raise ValueError("failed")
+        app = Firefly()
+        app.add_route("/slow", lambda: time.sleep(1), timeout=0.01)
+        app.add_route("/fail", fail, timeout=1)
+        response = app.process_request(Request.blank("/slow", POST='{}'))
+        assert response.status == '504 Gateway Timeout'
+        response = app.process_request(Request.blank("/fail", POST='{}'))
+        assert response.status == '500 Internal Server Error'
+        assert response.json == {"error": "ValueError: failed"}
+
+    def test_call_with_timeout_keeps_slot(self):
+        finish = threading.Event()
+        done = threading.Event()
+        def slow():
+            finish.wait(5)
+            done.set()
+            return "done"
+        app = Firefly()
+        app.add_route("/slow", slow, timeout=0.05, max_concurrency=1)
+        app.set_limits(max_concurrency=4)
+        response = app.process_request(Request.blank("/slow", POST='{}'))
+        assert response.status == '504 Gateway Timeout'
+
+        # the function is still running in the background
+        response = app.process_request(Request.blank("/slow", POST='{}'))
+        assert response.status == '503 Service Unavailable'
+        assert app.limiter.active == 1
+
+        finish.set()
+        done.wait(5)
+        deadline = time.time() + 5
+        while app.limiter.active and time.time() < deadline:
+            time.sleep(0.001)
+        assert app.limiter.active == 0
+        assert app.mapping["/slow"].limiter.active == 0
+        response = app.process_request(Request.blank("/slow", POST='{}'))
+        assert response.json == "done"
+
+    def test_call_streamed_with_deadline(self):
+        def records(n):
+            for i in range(n):
+                time.sleep(0.02)
+                yield {"i": i}
+        app = Firefly()
+        app.add_route("/records", records, timeout=0.1)
+        response = app.process_request(Request.blank("/records", POST='{"n": 2}'))
+        assert response.status == '200 OK'
+        assert [json.loads(line) for line in b"".join(response.app_iter).splitlines()] == [{"i": 0}, {"i": 1}]
+
+        # the status is already sent, so the stream is aborted
+        response = app.process_request(Request.blank("/records", POST='{"n": 50}'))
+        assert response.status == '200 OK'
+        with pytest.raises(DeadlineExceeded):
+            b"".join(response.app_iter)
+
+    def test_metrics(self):
+        app = Firefly()
+        app.add_route("/square", lambda x: x ** 2, function_name="square")
+        app.process_request(Request.blank("/square", POST='{"x": 3}'))
+        app.process_request(Request.blank("/square", POST='{"y": 3}'))
+
+        response = app.process_request(Request.blank("/_metrics"))
+        assert response.content_type == 'text/plain'
+        lines = response.text.splitlines()
+        assert 'firefly_requests_total{function="square",status="200"} 1' in lines
+        assert 'firefly_requests_total{function="square",status="422"} 1' in lines
+        assert 'firefly_requests_in_flight{function="square"} 0' in lines
+        assert 'firefly_request_bytes_total{function="square"} 16' in lines
+        for phase, count in [("decode", 2), ("validate", 1), ("execute", 1), ("encode", 2)]:
+            assert 'firefly_phase_duration_seconds_count{{function="square",phase="{}"}} {}'.format(phase, count) in lines
+        assert "_metrics" not in app.generate_function_list()
+
+    def test_call_generator(self):
+        def count(n):
+            for i in range(n):
+                yield {"i": i}
+        func = FireflyFunction(count, chunk_size=10)
+        request = Request.blank("/count", POST='{"n": 5}')
+        response = func(request)
+        assert response.status == '200 OK'
+        assert response.content_type == 'application/x-ndjson'
+        chunks = list(response.app_iter)
+        assert chunks[0] == b'{"i":0}\n'
+        assert len(chunks) == 3
+        lines = b"".join(chunks).decode().splitlines()
+        assert [json.loads(line) for line in lines] == [{"i": i} for i in range(5)]
+
+    def test_call_with_compression(self):
+        import gzip
+        func = FireflyFunction(lambda n: "x" * n)
+        headers = {"Accept-Encoding": "gzip, deflate"}
+
+        resp = func(Request.blank('/f', POST='{"n": 2000}', headers=headers))
+        assert resp.content_encoding == 'gzip'
+        assert resp.vary == ('Accept-Encoding',)
+        assert json.loads(gzip.decompress(resp.body).decode()) == "x" * 2000
+
+        # small responses are not compressed
+        resp = func(Request.blank('/f', POST='{"n": 10}', headers=headers))
+        assert resp.content_encoding is None
+        assert resp.json == "x" * 10
+
+        func = FireflyFunction(lambda n: "x" * n, compression=False)
+        resp = func(Request.blank('/f', POST='{"n": 2000}', headers=headers))
+        assert resp.content_encoding is None
+
+    def test_call_cached_with_compression(self, monkeypatch):
+        import gzip
+        from firefly import app as app_module
+        compressed = []
+        compress = app_module.compress
+        def counting_compress(data, encoding, level=6):
+            compressed.append(encoding)
+            return compress(data, encoding, level)
+        monkeypatch.setattr(app_module, "compress", counting_compress)
+
+        func = FireflyFunction(lambda n: "x" * n, cache={"max_entries": 10})
+        for i in range(3):
+            resp = func(Request.blank('/f', POST='{"n": 2000}', headers={"Accept-Encoding": "gzip"}))
+            assert resp.content_encoding == 'gzip'
+            assert resp.vary == ('Accept-Encoding',)
+            assert json.loads(gzip.decompress(resp.body).decode()) == "x" * 2000
+        assert resp.headers['X-Firefly-Cache'] == 'hit'
+        # the compressed response is cached
+        assert compressed == ['gzip']
+
+        # the other encodings are cached separately
+        resp = func(Request.blank('/f', POST='{"n": 2000}'))
+        assert resp.content_encoding is None
+        assert resp.json == "x" * 2000
+        assert func.cache.stats()["entries"] == 2
+
+    def test_call_for_streamed_output_with_compression(self):
+        import zlib
+        func = FireflyFunction(lambda n: ({"i": i} for i in range(n)))
+        resp = func(Request.blank('/f', POST='{"n": 3}', headers={"Accept-Encoding": "deflate"}))
+        assert resp.content_encoding == 'deflate'
+        lines = zlib.decompress(b"".join(resp.app_iter)).splitlines()
+        assert [json.loads(line.decode()) for line in lines] == [{"i": 0}, {"i": 1}, {"i": 2}]
+
+    def test_call_with_compressed_input(self):
+        import gzip
+        func = FireflyFunction(lambda n: n)
+        headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+        resp = func(Request.blank('/f', POST=gzip.compress(b'{"n": 4}'), headers=headers))
+        assert resp.json == 4
+
+        resp = func(Request.blank('/f', POST=b'{"n": 4}', headers=headers))
+        assert resp.status == '400 Bad Request'
+
+    def test_call_with_compressed_body_too_large(self):
+        import gzip
+        func = FireflyFunction(lambda s: len(s), compression={"max_decompressed_size": 100000})
+        headers = {"Content-Type": "application/json", "Content-Encoding": "gzip"}
+        body = gzip.compress(b'{"s": "' + b"0" * 1000000 + b'"}')
+        resp = func(Request.blank('/f', POST=body, headers=headers))
+        assert resp.status == '413 Request Entity Too Large'
+
+        func = FireflyFunction(lambda s: len(s))
+        resp = func(Request.blank('/f', POST=body, headers=headers))
+        assert resp.json == 1000000
+
+    def test_call_with_streamed_input(self):
+        def total(records, key):
+            return sum(r[key] for r in records)
+        func = FireflyFunction(total, input_stream="records", chunk_size=4)
+        body = b"".join(json.dumps({"x": i}).encode() + b"\n" for i in range(100))
+        headers = {"Content-Type": "application/x-ndjson"}
+        request = Request.blank("/total?key=x", POST=body, headers=headers)
+        response = func(request)
+        assert response.status == '200 OK'
+        assert response.json == sum(range(100))
+
+        func = FireflyFunction(total)
+        request = Request.blank("/total?key=x", POST=body, headers=headers)
+        response = func(request)
+        assert response.status == '400 Bad Request'
+
+    def test_call_with_chunked_streamed_input(self):
+        def total(records, key):
+            return sum(r[key] for r in records)
+        func = FireflyFunction(total, input_stream="records")
+        body = b"".join(json.dumps({"x": i}).encode() + b"\n" for i in range(100))
+        headers = {"Content-Type": "application/x-ndjson", "Transfer-Encoding": "chunked"}
+
+        # the server de-chunked the body and marked the end of it
+        request = Request.blank("/total?key=x", method="POST", headers=headers)
+        request.environ['wsgi.input'] = io.BytesIO(body)
+        request.environ['wsgi.input_terminated'] = True
+        response = func(request)
+        assert response.status == '200 OK'
+        assert response.json == sum(range(100))
+
+        # the server can't tell where the body ends
+        request = Request.blank("/total?key=x", method="POST", headers=headers)
+        request.environ['wsgi.input'] = io.BytesIO(body)
+        response = func(request)
+        assert response.status == '411 Length Required'
+
     def test_call_for_bad_request(self):
         def sum(a):
             return sum(a)
@@ -152,6 +760,74 @@ class TestFireflyFunction:
         assert resp.status == '200 OK'
         assert resp.body == b'18'
 
+    def test_call_for_file_output(self):
+        def download():
+            return io.BytesIO(b"0123456789")
+        func = FireflyFunction(download, chunk_size=4)
+        resp = func(Request.blank('/download', POST='{}'))
+        assert resp.status == '200 OK'
+        assert resp.content_length == 10
+        assert resp.headers['Accept-Ranges'] == 'bytes'
+        assert list(resp.app_iter) == [b"0123", b"4567", b"89"]
+
+    def test_call_for_file_output_with_range(self):
+        def download():
+            return io.BytesIO(b"0123456789")
+        func = FireflyFunction(download)
+
+        resp = func(Request.blank('/download', POST='{}', headers={"Range": "bytes=2-5"}))
+        assert resp.status == '206 Partial Content'
+        assert resp.headers['Content-Range'] == 'bytes 2-5/10'
+        assert resp.body == b"2345"
+
+        resp = func(Request.blank('/download', POST='{}', headers={"Range": "bytes=-3"}))
+        assert resp.status == '206 Partial Content'
+        assert resp.body == b"789"
+
+        resp = func(Request.blank('/download', POST='{}', headers={"Range": "bytes=20-"}))
+        assert resp.status == '416 Requested Range Not Satisfiable'
+        assert resp.headers['Content-Range'] == 'bytes */10'
+
+    def test_call_for_os_file_output(self, tmpdir):
+        path = tmpdir.join("data.bin")
+        path.write_binary(b"0123456789")
+        wrapped = []
+        def file_wrapper(f, chunk_size):
+            wrapped.append(f)
+            return iter(lambda: f.read(chunk_size), b"")
+
+        func = FireflyFunction(lambda: open(str(path), "rb"))
+        req = Request.blank('/download', POST='{}')
+        req.environ['wsgi.file_wrapper'] = file_wrapper
+        resp = func(req)
+        assert resp.content_length == 10
+        assert resp.body == b"0123456789"
+        assert len(wrapped) == 1
+
+        # partial ranges are not sent using the file wrapper
+        req = Request.blank('/download', POST='{}', headers={"Range": "bytes=2-5"})
+        req.environ['wsgi.file_wrapper'] = file_wrapper
+        resp = func(req)
+        assert resp.body == b"2345"
+        assert len(wrapped) == 1
+
+    def test_call_for_os_file_output_with_limits(self, tmpdir):
+        from wsgiref.util import FileWrapper
+        path = tmpdir.join("data.bin")
+        path.write_binary(b"0123456789")
+        app = Firefly()
+        app.add_route("/download", lambda: open(str(path), "rb"), max_concurrency=1)
+        app.set_limits(max_concurrency=1)
+        req = Request.blank('/download', POST='{}')
+        req.environ['wsgi.file_wrapper'] = FileWrapper
+        resp = app.process_request(req)
+        assert type(resp.app_iter) is FileWrapper
+        assert app.limiter.active == 1
+        assert b"".join(resp.app_iter) == b"0123456789"
+        resp.app_iter.close()
+        assert app.limiter.active == 0
+        assert app.mapping["/download"].limiter.active == 0
+
     def test_get_multipart_formdata_inputs_with_files(self):
         f = io.StringIO(u"test file contents")
         g = io.StringIO(u"test file contents")
@@ -170,6 +846,19 @@ class TestFireflyFunction:
         assert d['abc'] == 'hi'
         assert d['xyz'] == '1'
 
+    def test_call_for_upload_too_large(self):
+        def filesize(data):
+            return len(data.read())
+        f = io.StringIO(u"test file contents")
+        func = FireflyFunction(filesize, upload={"max_part_size": 4})
+        resp = func(Request.blank('/filesize', POST={'data': ('test', f)}))
+        assert resp.status == '413 Request Entity Too Large'
+
+        f = io.StringIO(u"test file contents")
+        func = FireflyFunction(filesize, upload={"max_part_size": 100})
+        resp = func(Request.blank('/filesize', POST={'data': ('test', f)}))
+        assert resp.json == 18
+
     def test_get_multipart_formdata_inputs_with_no_files(self):
         def dummy():
             pass
@@ -0,0 +1,136 @@
+import asyncio
+import json
+import pytest
+from firefly.app import Firefly
+
+def square(a):
+    return a**2
+
+async def async_square(a):
+    await asyncio.sleep(0)
+    return a**2
+
+def run(coro):
+    # asyncio.run requires python 3.7
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+def call(app, path, body=b"", method="POST", headers=None):
+    return run(request(app.asgi(), path, body, method, headers))
+
+async def request(asgi_app, path, body=b"", method="POST", headers=None):
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": b"",
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+    }
+    await asgi_app(scope, receive, send)
+    status = messages[0]["status"]
+    headers = {k.decode().lower(): v.decode() for k, v in messages[0]["headers"]}
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return status, headers, body
+
+class TestASGIApp:
+    def test_sync_function(self):
+        app = Firefly()
+        app.add_route("/square", square)
+        status, headers, body = call(app, "/square", b'{"a": 3}')
+        assert status == 200
+        assert body == b'9'
+
+    def test_async_function(self):
+        app = Firefly()
+        app.add_route("/square", async_square)
+        status, headers, body = call(app, "/square", b'{"a": 3}')
+        assert status == 200
+        assert body == b'9'
+
+        status, headers, body = call(app, "/square", b'{"b": 3}')
+        assert status == 422
+        assert json.loads(body.decode()) == {"error": "missing a required argument: 'a'"}
+
+    def test_async_function_auth_and_cors(self):
+        app = Firefly(auth_token="abcd", allowed_origins="*")
+        app.add_route("/square", async_square)
+        status, headers, body = call(app, "/square", b'{"a": 3}')
+        assert status == 403
+
+        status, headers, body = call(app, "/square", b'{"a": 3}', headers={"Authorization": "Token abcd"})
+        assert status == 200
+        assert headers["access-control-allow-origin"] == "*"
+
+    def test_async_function_cache(self):
+        calls = []
+        async def cached_square(a):
+            calls.append(a)
+            return a**2
+
+        app = Firefly()
+        app.add_route("/square", cached_square, cache=True)
+        results = [call(app, "/square", b'{"a": 3}') for i in range(4)]
+        assert [body for status, headers, body in results] == [b'9'] * 4
+        assert [headers["x-firefly-cache"] for status, headers, body in results] == ["miss", "hit", "hit", "hit"]
+        assert calls == [3]
+
+    def test_async_function_limits(self):
+        running = []
+        peak = []
+        async def slow():
+            running.append(1)
+            peak.append(len(running))
+            await asyncio.sleep(0.05)
+            running.pop()
+            return "done"
+
+        async def main(app, n):
+            asgi_app = app.asgi()
+            responses = await asyncio.gather(*[request(asgi_app, "/slow", b'{}') for i in range(n)])
+            return sorted(status for status, headers, body in responses)
+
+        app = Firefly()
+        app.add_route("/slow", slow, max_concurrency=1)
+        assert run(main(app, 4)) == [200, 503, 503, 503]
+        assert max(peak) == 1
+
+        # the queued requests wait without blocking the event loop
+        app = Firefly()
+        app.add_route("/slow", slow, max_concurrency=1, max_queue=3)
+        assert run(main(app, 4)) == [200] * 4
+        assert max(peak) == 1
+        assert app.mapping["/slow"].limiter.active == 0
+
+        app = Firefly()
+        app.add_route("/slow", slow)
+        app.set_limits(max_concurrency=2)
+        assert run(main(app, 4)) == [200, 200, 503, 503]
+        assert app.limiter.active == 0
+
+    def test_async_function_batched(self):
+        app = Firefly()
+        with pytest.raises(ValueError):
+            app.add_route("/square", async_square, batch=True)
+
+    def test_not_found(self):
+        app = Firefly()
+        status, headers, body = call(app, "/square", b'{"a": 3}')
+        assert status == 404
+
+    def test_async_function_with_wsgi(self):
+        from webob import Request
+        app = Firefly()
+        app.add_route("/square", async_square)
+        response = app.process_request(Request.blank("/square", POST='{"a": 3}'))
+        assert response.text == '9'
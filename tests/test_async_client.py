@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import pytest
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+from firefly.app import Firefly
+from firefly.server import ThreadingWSGIServer
+from firefly.client import FireflyError
+from firefly.validator import ValidationError
+
+aiohttp = pytest.importorskip("aiohttp")
+from firefly.async_client import AsyncClient
+
+def square(a):
+    '''Computes square'''
+    return a**2
+
+def count(n):
+    for i in range(n):
+        yield {"i": i}
+
+def fail():
+    raise ValueError("Dummy Error")
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture(scope="module")
+def server_url():
+    app = Firefly()
+    app.add_route("/square", square)
+    app.add_route("/count", count)
+    app.add_route("/fail", fail)
+    server = make_server("127.0.0.1", 0, app, server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield "http://127.0.0.1:{}/".format(server.server_port)
+    server.shutdown()
+
+def run(coro):
+    # asyncio.run requires python 3.7
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+def test_call(server_url):
+    async def main():
+        async with AsyncClient(server_url, pool_size=4) as client:
+            results = await asyncio.gather(*[client.square(a=i) for i in range(50)])
+            assert client.square.__doc__ == "Computes square"
+            return results
+    assert run(main()) == [i**2 for i in range(50)]
+
+def test_map(server_url):
+    async def main():
+        async with AsyncClient(server_url) as client:
+            return await client.square.map([{"a": i} for i in range(25)], workers=2, chunk_size=10)
+    assert run(main()) == [i**2 for i in range(25)]
+
+def test_streamed_response(server_url):
+    async def main():
+        async with AsyncClient(server_url) as client:
+            return [item async for item in await client.count(n=3)]
+    assert run(main()) == [{"i": 0}, {"i": 1}, {"i": 2}]
+
+def test_errors(server_url):
+    async def main(func, **kwargs):
+        async with AsyncClient(server_url) as client:
+            return await getattr(client, func)(**kwargs)
+    with pytest.raises(ValidationError):
+        run(main("square"))
+    with pytest.raises(FireflyError) as e:
+        run(main("fail"))
+    assert str(e.value) == "ValueError: Dummy Error"
+    with pytest.raises(FireflyError):
+        run(main("missing"))
+
+def test_connection_error():
+    async def main():
+        async with AsyncClient("http://127.0.0.1:1/") as client:
+            return await client.square(a=2)
+    with pytest.raises(FireflyError):
+        run(main())
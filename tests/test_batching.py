@@ -0,0 +1,45 @@
+import threading
+import pytest
+from firefly.batching import MicroBatcher
+
+def run_concurrently(batcher, kwargs_list):
+    results = [None] * len(kwargs_list)
+    def run(i, kwargs):
+        try:
+            results[i] = batcher.submit(kwargs)
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=run, args=(i, kw)) for i, kw in enumerate(kwargs_list)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def test_submit_single():
+    batcher = MicroBatcher(lambda x: [v * v for v in x], max_wait_ms=0)
+    assert batcher.submit({"x": 3}) == 9
+
+def test_submit_concurrent():
+    calls = []
+    def square(x):
+        calls.append(list(x))
+        return [v * v for v in x]
+
+    batcher = MicroBatcher(square, max_size=4, max_wait_ms=1000)
+    results = run_concurrently(batcher, [{"x": i} for i in range(8)])
+    assert results == [i * i for i in range(8)]
+    # the batches are flushed as soon as they are full
+    assert sorted(len(c) for c in calls) == [4, 4]
+
+def test_submit_error():
+    def fail(x):
+        raise ValueError("bad input")
+    batcher = MicroBatcher(fail, max_size=2, max_wait_ms=1000)
+    results = run_concurrently(batcher, [{"x": 1}, {"x": 2}])
+    assert all(isinstance(r, ValueError) for r in results)
+
+def test_submit_wrong_number_of_results():
+    batcher = MicroBatcher(lambda x: [1], max_size=2, max_wait_ms=1000)
+    results = run_concurrently(batcher, [{"x": 1}, {"x": 2}])
+    assert all(isinstance(r, ValueError) for r in results)
@@ -0,0 +1,48 @@
+import io
+from firefly.cache import ResultCache, make_key
+
+def test_get_set():
+    cache = ResultCache()
+    assert cache.get("a") is None
+    cache.set("a", b"1", size=1)
+    assert cache.get("a") == b"1"
+    assert cache.stats() == {"entries": 1, "bytes": 1, "hits": 1, "misses": 1, "evictions": 0}
+
+def test_lru_eviction():
+    cache = ResultCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+def test_max_bytes():
+    cache = ResultCache(max_bytes=10)
+    cache.set("a", b"12345", size=5)
+    cache.set("b", b"12345", size=5)
+    cache.set("c", b"123", size=3)
+    assert cache.get("a") is None
+    assert cache.stats()["bytes"] == 8
+
+    # too big to be cached
+    cache.set("d", b"12345678901", size=11)
+    assert cache.get("d") is None
+
+def test_ttl():
+    cache = ResultCache(ttl=60)
+    cache.set("a", 1)
+    assert cache.get("a") == 1
+    key = "a"
+    value, expires_at, size = cache.entries[key]
+    cache.entries[key] = (value, expires_at - 61, size)
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+def test_make_key():
+    assert make_key({"a": 1, "b": [1, 2]}) == make_key({"b": [1, 2], "a": 1})
+    assert make_key({"a": 1}) != make_key({"a": 2})
+    assert make_key({"a": b"xyz"}) == make_key({"a": b"xyz"})
+    assert make_key({"f": io.BytesIO(b"")}) is None
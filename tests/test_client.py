@@ -1,4 +1,5 @@
 import io
+import json
 import pytest
 import requests
 from firefly.client import Client, RemoteFunction, FireflyError
@@ -14,43 +15,61 @@ class MockResponse:
     def json(self):
         return self.data
 
+    @property
+    def content(self):
+        return json.dumps(self.data).encode("utf-8")
+
 def make_monkey_patch(status, return_data, mode='json'):
-    def mock_post_response(url, json=None, data=None, files=None, headers=None, **kwargs):
+    def mock_post_response(session, url, json=None, data=None, files=None, headers=None, **kwargs):
         r = MockResponse(status_code=status, data=return_data, headers=headers)
         return r
     return mock_post_response
 
 class TestClass:
     def test_call_for_success_event(self, monkeypatch):
-        monkeypatch.setattr(requests, "post", make_monkey_patch(200, 16))
-        monkeypatch.setattr(requests, "get", make_monkey_patch(200, {}))
+        monkeypatch.setattr(requests.Session, "post", make_monkey_patch(200, 16))
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
         c = Client("http://127.0.0.1:8000")
         assert c.square(a=4) == 16
 
+    def test_call_with_big_integers(self, monkeypatch):
+        pytest.importorskip("msgpack")
+        requests_sent = []
+        def mock_post(session, url, data=None, headers=None, **kwargs):
+            requests_sent.append((headers["Content-Type"], data))
+            return MockResponse(200, 2**71)
+        monkeypatch.setattr(requests.Session, "post", mock_post)
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
+        c = Client("http://127.0.0.1:8000")
+        assert c.double(n=2**70) == 2**71
+        # msgpack can't encode the argument, which is sent as JSON
+        assert requests_sent[0][0] == "application/json"
+        assert json.loads(requests_sent[0][1].decode("utf-8")) == {"n": 2**70}
+
     def test_call_for_validation_error(self, monkeypatch):
-        monkeypatch.setattr(requests, "post", make_monkey_patch(404, {"status": "not found"}))
-        monkeypatch.setattr(requests, "get", make_monkey_patch(200, {}))
+        monkeypatch.setattr(requests.Session, "post", make_monkey_patch(404, {"status": "not found"}))
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
         c = Client("http://127.0.0.1:8000")
         with pytest.raises(FireflyError, message="Expected FireflyError"):
             c.sq(a=4)
 
     def test_call_for_validation_error(self, monkeypatch):
-        monkeypatch.setattr(requests, "post", make_monkey_patch(422, {"error": "missing a required argument: 'a'"}))
-        monkeypatch.setattr(requests, "get", make_monkey_patch(200, {}))
+        monkeypatch.setattr(requests.Session, "post", make_monkey_patch(422, {"error": "missing a required argument: 'a'"}))
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
         c = Client("http://127.0.0.1:8000")
         with pytest.raises(ValidationError, message="Expected ValidationError"):
             c.square(b=4)
 
     def test_call_for_server_error(self, monkeypatch):
-        monkeypatch.setattr(requests, "post", make_monkey_patch(500, {"error": "ValueError: Dummy Error"}))
-        monkeypatch.setattr(requests, "get", make_monkey_patch(200, {}))
+        monkeypatch.setattr(requests.Session, "post", make_monkey_patch(500, {"error": "ValueError: Dummy Error"}))
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
         c = Client("http://127.0.0.1:8000")
         with pytest.raises(FireflyError, message="Expected FireflyError"):
             c.square(a=4)
 
     def test_call_for_uncaught_exception(self, monkeypatch):
-        monkeypatch.setattr(requests, "post", make_monkey_patch(502, ""))
-        monkeypatch.setattr(requests, "get", make_monkey_patch(200, {}))
+        monkeypatch.setattr(requests.Session, "post", make_monkey_patch(502, ""))
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
         c = Client("http://127.0.0.1:8000")
         with pytest.raises(FireflyError, message="Expected FireflyError"):
             c.square(a=4)
@@ -59,8 +78,8 @@ class TestClass:
         def filesize(data):
             return len(data.read())
         f = io.StringIO(u"test file contents")
-        monkeypatch.setattr(requests, "post", make_monkey_patch(200, "18"))
-        monkeypatch.setattr(requests, "get", make_monkey_patch(200, {}))
+        monkeypatch.setattr(requests.Session, "post", make_monkey_patch(200, "18"))
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
         c = Client("http://127.0.0.1:8000")
         assert c.filesize(data=f) == "18"
 
@@ -98,3 +117,272 @@ class TestClass:
         c = Client("http://127.0.0.1:8000")
         is_a_file = c.is_file(1)
         assert is_a_file == False
+
+    def test_session_pool(self):
+        c = Client("http://127.0.0.1:8000", pool_size=4, retries=3)
+        adapter = c.session.get_adapter("http://127.0.0.1:8000/square")
+        assert adapter._pool_maxsize == 4
+        assert adapter.max_retries.connect == 3
+
+    def test_context_manager(self, monkeypatch):
+        closed = []
+        monkeypatch.setattr(requests.Session, "close", lambda session: closed.append(session))
+        with Client("http://127.0.0.1:8000") as c:
+            assert closed == []
+        assert closed == [c.session]
+
+    def test_private_attributes(self):
+        c = Client("http://127.0.0.1:8000")
+        with pytest.raises(AttributeError):
+            c._missing
+
+    def test_remote_functions_are_cached(self, monkeypatch):
+        calls = []
+        def mock_request(method, status, data):
+            def request(session, url, **kwargs):
+                calls.append((method, url))
+                return MockResponse(status, data)
+            return request
+
+        metadata = {"functions": {"square": {"path": "/sq", "doc": "Computes square"}}}
+        monkeypatch.setattr(requests.Session, "post", mock_request("POST", 200, 16))
+        monkeypatch.setattr(requests.Session, "get", mock_request("GET", 200, metadata))
+        c = Client("http://127.0.0.1:8000")
+        assert c.square is c.square
+        assert c.square.__doc__ == "Computes square"
+        for i in range(3):
+            c.square(a=4)
+        assert calls == [("GET", "http://127.0.0.1:8000/")] + [("POST", "http://127.0.0.1:8000/sq")] * 3
+
+        del calls[:]
+        c.refresh()
+        c.square(a=4)
+        assert calls == [("GET", "http://127.0.0.1:8000/"), ("POST", "http://127.0.0.1:8000/sq")]
+
+    def test_metadata_ttl(self, monkeypatch):
+        calls = []
+        def mock_get(session, url, **kwargs):
+            calls.append(url)
+            return MockResponse(200, {})
+        monkeypatch.setattr(requests.Session, "get", mock_get)
+        c = Client("http://127.0.0.1:8000", metadata_ttl=60)
+        c._get_metadata()
+        c._get_metadata()
+        assert len(calls) == 1
+        c._metadata_time -= 61
+        c._get_metadata()
+        assert len(calls) == 2
+
+    def test_metadata_cache(self, monkeypatch, tmpdir):
+        metadata = {"functions": {"square": {"path": "/sq"}}}
+        calls = []
+        def mock_get(session, url, headers=None, **kwargs):
+            calls.append(headers.get("If-None-Match"))
+            if headers.get("If-None-Match") == '"v1"':
+                return MockResponse(304, None, headers={"ETag": '"v1"'})
+            return MockResponse(200, metadata, headers={"ETag": '"v1"'})
+        monkeypatch.setattr(requests.Session, "get", mock_get)
+
+        c = Client("http://127.0.0.1:8000", metadata_cache=str(tmpdir))
+        assert c._get_path("square") == "/sq"
+        assert calls == [None]
+
+        # the metadata on disk is used while it is fresh
+        c = Client("http://127.0.0.1:8000", metadata_cache=str(tmpdir), metadata_ttl=60)
+        assert c._get_path("square") == "/sq"
+        assert calls == [None]
+
+        # and revalidated otherwise
+        c = Client("http://127.0.0.1:8000", metadata_cache=str(tmpdir))
+        assert c._get_path("square") == "/sq"
+        assert calls == [None, '"v1"']
+
+        c = Client("http://127.0.0.1:9000", metadata_cache=str(tmpdir), metadata_ttl=60)
+        c._get_metadata()
+        assert calls == [None, '"v1"', None]
+
+    def test_batch(self, monkeypatch):
+        requests_sent = []
+        def mock_post(session, url, data=None, **kwargs):
+            requests_sent.append((url, json.loads(data.decode("utf-8"))))
+            return MockResponse(200, [
+                {"status": 200, "result": 4},
+                {"status": 422, "error": "missing a required argument: 'a'"},
+            ])
+        monkeypatch.setattr(requests.Session, "post", mock_post)
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
+        c = Client("http://127.0.0.1:8000")
+
+        results = c.square.map([{"a": 2}, {"b": 3}], return_exceptions=True)
+        assert requests_sent == [("http://127.0.0.1:8000/_batch", {"calls": [
+            {"function": "square", "kwargs": {"a": 2}},
+            {"function": "square", "kwargs": {"b": 3}},
+        ]})]
+        assert results[0] == 4
+        assert isinstance(results[1], ValidationError)
+
+        with pytest.raises(ValidationError):
+            c.batch([("square", {"a": 2}), ("square", {"b": 3})])
+
+    def test_map_in_chunks(self, monkeypatch):
+        requests_sent = []
+        def mock_post(session, url, data=None, **kwargs):
+            calls = json.loads(data.decode("utf-8"))["calls"]
+            requests_sent.append(len(calls))
+            return MockResponse(200, [
+                {"status": 200, "result": call["kwargs"]["a"] ** 2} if "a" in call["kwargs"]
+                else {"status": 422, "error": "missing a required argument: 'a'"}
+                for call in calls
+            ])
+        monkeypatch.setattr(requests.Session, "post", mock_post)
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
+        c = Client("http://127.0.0.1:8000")
+
+        results = c.square.map(({"a": i} for i in range(25)), workers=4, chunk_size=10)
+        assert results == [i ** 2 for i in range(25)]
+        assert sorted(requests_sent) == [5, 10, 10]
+        assert c.square.map([]) == []
+
+        kwargs_list = [{"a": 1}, {"b": 2}, {"a": 3}]
+        results = c.square.map(kwargs_list, workers=2, chunk_size=1, return_exceptions=True)
+        assert results[0] == 1 and results[2] == 9
+        assert isinstance(results[1], ValidationError)
+        with pytest.raises(ValidationError):
+            c.square.map(kwargs_list, workers=2, chunk_size=1)
+
+    def test_map_without_batch_endpoint(self, monkeypatch):
+        urls = []
+        def mock_post(session, url, data=None, **kwargs):
+            urls.append(url)
+            if url.endswith("/_batch"):
+                return MockResponse(404, {"error": "Not found"})
+            return MockResponse(200, json.loads(data.decode("utf-8"))["a"] ** 2)
+        monkeypatch.setattr(requests.Session, "post", mock_post)
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
+        c = Client("http://127.0.0.1:8000")
+
+        assert c.square.map([{"a": i} for i in range(4)], chunk_size=2, workers=1) == [0, 1, 4, 9]
+        # the batch endpoint is tried only once
+        assert urls == ["http://127.0.0.1:8000/_batch"] + ["http://127.0.0.1:8000/square"] * 4
+
+    def test_call_with_compression(self, monkeypatch):
+        import gzip
+        sent = []
+        def mock_post(session, url, data=None, headers=None, **kwargs):
+            sent.append((data, headers))
+            return MockResponse(200, 3)
+        monkeypatch.setattr(requests.Session, "post", mock_post)
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {"content_encodings": ["gzip"]}))
+        c = Client("http://127.0.0.1:8000", binary=False)
+        assert "gzip" in c.session.headers["Accept-Encoding"]
+
+        c.count(items=list(range(1000)))
+        data, headers = sent[-1]
+        assert headers["Content-Encoding"] == "gzip"
+        assert json.loads(gzip.decompress(data).decode()) == {"items": list(range(1000))}
+
+        c.count(items=[1])
+        data, headers = sent[-1]
+        assert "Content-Encoding" not in headers
+
+    def test_retry_overloaded(self, monkeypatch):
+        responses = [
+            MockResponse(503, {"error": "overloaded"}, headers={"Retry-After": "0.01"}),
+            MockResponse(503, {"error": "overloaded"}),
+            MockResponse(200, 4)
+        ]
+        for r in responses:
+            r.close = lambda: None
+        delays = []
+        monkeypatch.setattr(requests.Session, "post", lambda session, url, **kwargs: responses.pop(0))
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
+        monkeypatch.setattr("time.sleep", delays.append)
+        c = Client("http://127.0.0.1:8000", retries=2, backoff_factor=0.5)
+        assert c.square(a=2) == 4
+        assert 0.01 <= delays[0] <= 0.015
+        assert 1.0 <= delays[1] <= 1.5
+
+    def test_retry_overloaded_gives_up(self, monkeypatch):
+        monkeypatch.setattr(requests.Session, "post", make_monkey_patch(503, {"error": "overloaded"}))
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
+        c = Client("http://127.0.0.1:8000")
+        with pytest.raises(FireflyError) as e:
+            c.square(a=2)
+        assert str(e.value) == "overloaded"
+
+    def test_call_with_path_params(self, monkeypatch):
+        urls = []
+        def mock_post(session, url, data=None, **kwargs):
+            urls.append((url, json.loads(data)))
+            return MockResponse(200, 4)
+        functions = {"functions": {"get_user": {"path": "/users/{id:int}"}}}
+        monkeypatch.setattr(requests.Session, "post", mock_post)
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, functions))
+        c = Client("http://127.0.0.1:8000")
+        c.get_user(id=42, fields=["name"])
+        assert urls[-1] == ("http://127.0.0.1:8000/users/42", {"fields": ["name"]})
+        with pytest.raises(ValidationError):
+            c.get_user(fields=["name"])
+
+    def test_call_with_timeout(self, monkeypatch):
+        sent = []
+        def mock_post(session, url, headers=None, timeout=None, **kwargs):
+            sent.append((headers.get("X-Firefly-Timeout"), timeout))
+            return MockResponse(200, 4)
+        monkeypatch.setattr(requests.Session, "post", mock_post)
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
+
+        c = Client("http://127.0.0.1:8000")
+        c.square(a=2)
+        assert sent[-1] == (None, None)
+
+        c = Client("http://127.0.0.1:8000", timeout=10)
+        c.square(a=2)
+        header, timeout = sent[-1]
+        assert 9 < float(header) <= 10
+        assert 9.5 < timeout <= 10.5
+
+        c.square(a=2, _timeout=2)
+        header, timeout = sent[-1]
+        assert 1 < float(header) <= 2
+
+    def test_call_timed_out(self, monkeypatch):
+        def mock_post(session, url, **kwargs):
+            raise requests.ReadTimeout()
+        monkeypatch.setattr(requests.Session, "post", mock_post)
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
+        c = Client("http://127.0.0.1:8000", timeout=1)
+        with pytest.raises(FireflyError) as e:
+            c.square(a=2)
+        assert str(e.value) == "Deadline exceeded"
+
+    def test_call_streamed(self, monkeypatch):
+        class MockStreamedResponse(MockResponse):
+            def iter_lines(self, chunk_size, delimiter):
+                return iter([b'{"i": 0}', b'{"i": 1}', b''])
+            def close(self):
+                pass
+
+        def mock_post(session, url, **kwargs):
+            return MockStreamedResponse(200, None, headers={"Content-Type": "application/x-ndjson"})
+        monkeypatch.setattr(requests.Session, "post", mock_post)
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
+        c = Client("http://127.0.0.1:8000")
+        result = c.count(n=2)
+        assert not isinstance(result, list)
+        assert list(result) == [{"i": 0}, {"i": 1}]
+
+    def test_call_with_streamed_input(self, monkeypatch):
+        sent = []
+        def mock_post(session, url, params=None, data=None, headers=None, **kwargs):
+            sent.append((params, b"".join(data), headers["Content-Type"]))
+            return MockResponse(200, 3)
+        monkeypatch.setattr(requests.Session, "post", mock_post)
+        monkeypatch.setattr(requests.Session, "get", make_monkey_patch(200, {}))
+        c = Client("http://127.0.0.1:8000")
+        records = ({"x": i} for i in range(3))
+        assert c.total(records=records, key="x") == 3
+        params, body, content_type = sent[0]
+        assert params == {"key": b'"x"'}
+        assert [json.loads(line) for line in body.splitlines()] == [{"x": 0}, {"x": 1}, {"x": 2}]
+        assert content_type == "application/x-ndjson"
@@ -0,0 +1,105 @@
+import datetime
+import pytest
+from firefly.codecs import JSONCodec, get_json_codec, JSON_CODECS
+
+class Vector:
+    # behaves like a numpy array
+    def __init__(self, values):
+        self.values = values
+
+    def tolist(self):
+        return list(self.values)
+
+def available_codecs():
+    codecs = []
+    for name in JSON_CODECS:
+        try:
+            codecs.append(get_json_codec(name))
+        except ImportError:
+            pass
+    return codecs
+
+@pytest.mark.parametrize("codec", available_codecs(), ids=lambda c: c.name)
+class TestJSONCodec:
+    def test_roundtrip(self, codec):
+        data = {"a": [1, 2.5, "x", None, True], "b": {"c": u"é"}}
+        assert codec.decode(codec.encode(data)) == data
+
+    def test_encode_returns_bytes(self, codec):
+        assert codec.encode([1, 2]).replace(b" ", b"") == b"[1,2]"
+
+    def test_encode_special_types(self, codec):
+        data = {
+            "vector": Vector([1, 2]),
+            "date": datetime.date(2018, 1, 4),
+            "time": datetime.datetime(2018, 1, 4, 10, 30, 0)
+        }
+        assert codec.decode(codec.encode(data)) == {
+            "vector": [1, 2],
+            "date": "2018-01-04",
+            "time": "2018-01-04T10:30:00"
+        }
+
+    def test_encode_big_integers(self, codec):
+        assert codec.decode(codec.encode(2**70)) == 2**70
+
+    def test_decode_big_integers(self, codec):
+        data = b'{"n": 123456789012345678901234567890, "m": -9999999999999999999, "s": "12345678901234567890"}'
+        assert codec.decode(data) == {"n": 123456789012345678901234567890, "m": -9999999999999999999,
+                                      "s": "12345678901234567890"}
+        assert codec.decode(data.decode("utf-8"))["n"] == 123456789012345678901234567890
+        assert codec.decode(codec.encode(2**70 + 1)) == 2**70 + 1
+
+    def test_decode_invalid(self, codec):
+        with pytest.raises(ValueError):
+            codec.decode(b"[1, 2")
+
+def test_get_json_codec():
+    assert isinstance(get_json_codec("json"), JSONCodec)
+    assert isinstance(get_json_codec(), JSONCodec)
+    with pytest.raises(ValueError):
+        get_json_codec("bad-codec")
+
+def test_msgpack_codec():
+    pytest.importorskip("msgpack")
+    from firefly.codecs import MsgpackCodec
+    codec = MsgpackCodec()
+    data = {"a": [1, 2.5, "x", None], "b": Vector([1, 2])}
+    assert codec.decode(codec.encode(data)) == {"a": [1, 2.5, "x", None], "b": [1, 2]}
+    with pytest.raises(ValueError):
+        codec.decode(b"\xc1")
+    with pytest.raises(OverflowError):
+        codec.encode({"n": 2**70})
+
+def test_ndarray_codec():
+    np = pytest.importorskip("numpy")
+    from firefly.codecs import NDArrayCodec
+    codec = NDArrayCodec()
+    x = np.arange(12, dtype="float32").reshape(3, 4)
+    y = np.array([1, 2, 3], dtype="int64")
+    data = {"x": x, "nested": {"y": y, "name": "test"}, "z": [1, 2]}
+    assert codec.accepts(data)
+    assert not codec.accepts({"z": [1, 2]})
+
+    encoded = codec.encode(data)
+    decoded = codec.decode(encoded)
+    assert decoded["x"].dtype == x.dtype
+    assert (decoded["x"] == x).all()
+    assert (decoded["nested"]["y"] == y).all()
+    assert decoded["nested"]["name"] == "test"
+    assert decoded["z"] == [1, 2]
+
+    # the arrays are views on the encoded data
+    assert decoded["x"].base is not None
+    assert not decoded["x"].flags.writeable
+
+    decoded = codec.decode(codec.encode(x.T))
+    assert (decoded == x.T).all()
+
+    with pytest.raises(ValueError):
+        codec.decode(b"\x00\x00")
+
+def test_parse_accept():
+    from firefly.codecs import parse_accept
+    assert parse_accept("application/json") == ["application/json"]
+    assert parse_accept("a/b;q=0.5, c/d, e/f;q=0, g/h") == ["c/d", "g/h", "a/b"]
@@ -0,0 +1,59 @@
+import io
+import zlib
+import gzip
+import pytest
+from firefly.compression import choose_encoding, compress, compress_iter, DecompressedFile, MAX_DECOMPRESSED_SIZE
+from firefly.multipart import PayloadTooLarge
+
+def test_choose_encoding():
+    assert choose_encoding(None) is None
+    assert choose_encoding("identity") is None
+    assert choose_encoding("deflate") == "deflate"
+    assert choose_encoding("deflate, gzip") == "gzip"
+    assert choose_encoding("gzip;q=0, deflate") == "deflate"
+
+def test_compress():
+    data = b'{"x": 1}' * 100
+    assert gzip.decompress(compress(data, "gzip")) == data
+    assert zlib.decompress(compress(data, "deflate", level=1)) == data
+
+def test_compress_iter():
+    chunks = [b'{"x": 1}\n', b'{"x": 2}\n']
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    compressed = compress_iter(iter(chunks), "gzip")
+    # each chunk can be decoded as soon as it is received
+    assert d.decompress(next(compressed)) == chunks[0]
+    assert d.decompress(b"".join(compressed)) == chunks[1]
+
+def test_decompressed_file():
+    data = b'{"x": 1}' * 10000
+    f = DecompressedFile(io.BytesIO(compress(data, "gzip")), "gzip", chunk_size=100)
+    assert f.read(10) == data[:10]
+    assert f.read() == data[10:]
+    assert f.read() == b""
+
+def test_decompressed_file_errors():
+    with pytest.raises(ValueError):
+        DecompressedFile(io.BytesIO(b""), "compress")
+    with pytest.raises(ValueError):
+        DecompressedFile(io.BytesIO(b"not gzip"), "gzip").read()
+    with pytest.raises(PayloadTooLarge):
+        DecompressedFile(io.BytesIO(compress(b"0" * 10000, "gzip")), "gzip", max_size=1000).read()
+
+def test_decompressed_file_bounded_steps():
+    # a small body that expands a lot is decompressed a chunk at a time
+    f = DecompressedFile(io.BytesIO(compress(b"0" * 10000000, "gzip")), "gzip", chunk_size=1000)
+    assert f.read(10) == b"0" * 10
+    assert len(f.buffer) <= 1000
+    assert f.max_size == MAX_DECOMPRESSED_SIZE
+    with pytest.raises(PayloadTooLarge):
+        DecompressedFile(io.BytesIO(compress(b"0" * 10000000, "gzip")), "gzip", max_size=100000).read()
+
+def test_decompressed_file_brotli():
+    brotli = pytest.importorskip("brotli")
+    data = b'{"x": 1}' * 10000
+    f = DecompressedFile(io.BytesIO(brotli.compress(data)), "br", chunk_size=100)
+    assert f.read(10) == data[:10]
+    assert f.read() == data[10:]
+    with pytest.raises(PayloadTooLarge):
+        DecompressedFile(io.BytesIO(brotli.compress(data)), "br", max_size=1000).read()
@@ -0,0 +1,64 @@
+import os
+import sys
+import pytest
+from firefly.executors import ProcessExecutor, to_shared, from_shared
+
+pytestmark = pytest.mark.skipif(sys.version_info < (3, 8), reason="requires shared memory")
+
+def getpid(x=None):
+    return os.getpid()
+
+def reverse(data):
+    return data[::-1]
+
+def count(n):
+    for i in range(n):
+        yield i
+
+@pytest.fixture
+def executor():
+    executors = []
+    def make(function, **kwargs):
+        e = ProcessExecutor(function, max_workers=2, **kwargs)
+        executors.append(e)
+        return e
+    yield make
+    for e in executors:
+        e.shutdown()
+
+def test_call(executor):
+    e = executor(getpid)
+    assert e.call({}) != os.getpid()
+    assert e(x=1) != os.getpid()
+    assert executor(count).call({"n": 3}) == [0, 1, 2]
+
+def test_call_with_shared_memory(executor):
+    e = executor(reverse, shm_threshold=100)
+    data = os.urandom(1000)
+    assert e.call({"data": data}) == data[::-1]
+    assert e.call({"data": b"abc"}) == b"cba"
+
+def test_shared_ndarray():
+    numpy = pytest.importorskip("numpy")
+    a = numpy.arange(1000, dtype="float64").reshape(10, 100)
+    names = []
+    shared = to_shared({"a": a, "b": 1}, 100, names)
+    assert len(names) == 1 and shared["b"] == 1
+    result = from_shared(shared, unlink=True)
+    assert (result["a"] == a).all()
+    assert result["a"].dtype == a.dtype
+
+def test_function_with_process_executor():
+    from webob import Request
+    from firefly.app import Firefly, FireflyFunction
+    app = Firefly()
+    app.add_route("/getpid", getpid, executor="process", max_workers=1)
+    try:
+        response = app.process_request(Request.blank("/getpid", POST='{"x": 1}'))
+        assert response.status == '200 OK'
+        assert response.json != os.getpid()
+    finally:
+        app.mapping["/getpid"].executor.shutdown()
+
+    with pytest.raises(ValueError):
+        FireflyFunction(getpid, executor="fiber")
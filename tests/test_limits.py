@@ -0,0 +1,74 @@
+import io
+import threading
+from webob import Request, Response
+from firefly.limits import ConcurrencyLimiter, run_limited
+
+def test_limiter():
+    limiter = ConcurrencyLimiter(max_concurrency=2)
+    assert limiter.acquire()
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    limiter.release()
+    assert limiter.acquire()
+    assert limiter.stats() == {"active": 2, "waiting": 0, "rejected": 1}
+
+def test_limiter_try_acquire():
+    limiter = ConcurrencyLimiter(max_concurrency=1, max_queue=1)
+    assert limiter.try_acquire()
+    assert not limiter.try_acquire()
+    # the requests that don't get a slot right away are not rejected
+    assert limiter.stats() == {"active": 1, "waiting": 0, "rejected": 0}
+    limiter.release()
+    assert limiter.try_acquire()
+
+def test_limiter_queue():
+    limiter = ConcurrencyLimiter(max_concurrency=1, max_queue=1)
+    assert limiter.acquire()
+    results = []
+    t = threading.Thread(target=lambda: results.append(limiter.acquire()))
+    t.start()
+    while limiter.waiting == 0:
+        pass
+    # the queue is full
+    assert not limiter.acquire()
+    limiter.release()
+    t.join()
+    assert results == [True]
+
+def test_limiter_queue_timeout():
+    limiter = ConcurrencyLimiter(max_concurrency=1, max_queue=1, queue_timeout=0.01)
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    assert limiter.stats() == {"active": 1, "waiting": 0, "rejected": 1}
+
+def test_run_limited_streamed_response():
+    limiter = ConcurrencyLimiter(max_concurrency=1)
+    def handler(request):
+        return Response(app_iter=iter([b"a", b"b"]))
+
+    response = run_limited(limiter, handler, Request.blank("/"))
+    # the slot is held until the response is sent
+    assert limiter.active == 1
+    assert run_limited(limiter, handler, Request.blank("/")) is None
+    assert b"".join(response.app_iter) == b"ab"
+    response.app_iter.close()
+    assert limiter.active == 0
+
+def test_run_limited_file_wrapper():
+    from wsgiref.util import FileWrapper
+    limiter = ConcurrencyLimiter(max_concurrency=1)
+    f = io.BytesIO(b"data")
+    def handler(request):
+        return Response(app_iter=FileWrapper(f, 1024))
+
+    request = Request.blank("/")
+    request.environ['wsgi.file_wrapper'] = FileWrapper
+    response = run_limited(limiter, handler, request)
+    # the server gets its own file wrapper, which it sends using sendfile
+    assert type(response.app_iter) is FileWrapper
+    assert limiter.active == 1
+    response.app_iter.close()
+    assert f.closed
+    assert limiter.active == 0
+    response.app_iter.close()
+    assert limiter.active == 0
@@ -0,0 +1,75 @@
+import pickle
+import sys
+import textwrap
+import pytest
+from firefly.app import Firefly
+from firefly.loader import LazyFunction, lazy_function, import_times
+
+py3_only = pytest.mark.skipif(sys.version_info.major < 3, reason="Requires Python 3+")
+
+SOURCE = '''
+import os
+
+def square(a, *, scale=1, **options):
+    """Computes square"""
+    return a * a * scale
+
+@staticmethod
+def decorated(a):
+    return a
+
+def nonliteral(a, sep=os.sep):
+    return a
+
+try:
+    from fastmath import conditional
+except ImportError:
+    def conditional(a):
+        return a
+
+async def coroutine(a):
+    return a
+'''
+
+@pytest.fixture
+def module(tmpdir, monkeypatch):
+    name = "lazymod_" + tmpdir.basename
+    tmpdir.join(name + ".py").write(textwrap.dedent(SOURCE))
+    monkeypatch.syspath_prepend(str(tmpdir))
+    yield name
+    sys.modules.pop(name, None)
+
+@py3_only
+def test_lazy_function(module):
+    func = lazy_function(module + ".square")
+    assert isinstance(func, LazyFunction)
+    assert module not in sys.modules
+    assert func.__name__ == "square"
+    assert func.__doc__ == "Computes square"
+    assert str(func.__signature__) == "(a, *, scale=1, **options)"
+
+    assert func(a=3, scale=2) == 18
+    assert func.is_loaded
+    assert module in sys.modules
+    assert module in import_times
+
+@py3_only
+def test_lazy_function_fallback(module):
+    for name in ["decorated", "nonliteral", "conditional", "coroutine", "missing"]:
+        assert lazy_function(module + "." + name) is None
+    assert module not in sys.modules
+
+@py3_only
+def test_lazy_function_pickle(module):
+    func = lazy_function(module + ".square")
+    assert pickle.loads(pickle.dumps(func))(a=2) == 4
+
+@py3_only
+def test_warmup(module):
+    app = Firefly()
+    app.add_route("/square", lazy_function(module + ".square"))
+    assert app.generate_function_list()["square"]["parameters"][1] == {
+        "name": "scale", "kind": "KEYWORD_ONLY", "default": 1}
+    assert module not in sys.modules
+    app.warmup()
+    assert app.mapping["/square"].function.is_loaded
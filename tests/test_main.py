@@ -1,5 +1,7 @@
 import os
-from firefly.main import load_function
+import sys
+from firefly.main import load_function, parse_config_data
+from firefly.loader import LazyFunction
 
 def test_load_functions():
     os.path.exists2 = os.path.exists
@@ -7,3 +9,39 @@ def test_load_functions():
     assert path == "/exists2"
     assert name == "exists2"
     assert func == os.path.exists
+
+def test_parse_config_data():
+    os.path.exists2 = os.path.exists
+    config = {
+        "functions": {
+            "exists": {
+                "function": "os.path.exists2",
+                "path": "/path-exists",
+                "batch": {"max_size": 8}
+            }
+        }
+    }
+    functions, token = parse_config_data(config)
+    assert functions == [("/path-exists", "exists", os.path.exists, {"batch": {"max_size": 8}})]
+    assert token is None
+
+def test_parse_config_data_lazy(tmpdir, monkeypatch):
+    tmpdir.join("lazyfuncs.py").write("def square(a):\n    return a * a\n")
+    tmpdir.join("eagerfuncs.py").write("def cube(a):\n    return a * a * a\n")
+    monkeypatch.syspath_prepend(str(tmpdir))
+    config = {
+        "lazy": True,
+        "preload": ["eagerfuncs"],
+        "functions": {
+            "square": {"function": "lazyfuncs.square"},
+            "cube": {"function": "eagerfuncs.cube"}
+        }
+    }
+    try:
+        functions, token = parse_config_data(config)
+        assert isinstance(functions[0][2], LazyFunction)
+        assert "lazyfuncs" not in sys.modules
+        assert functions[1][2] is sys.modules["eagerfuncs"].cube
+    finally:
+        sys.modules.pop("lazyfuncs", None)
+        sys.modules.pop("eagerfuncs", None)
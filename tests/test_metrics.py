@@ -0,0 +1,41 @@
+import threading
+from firefly.metrics import Metrics, format_metrics
+
+def test_counters_and_histograms():
+    m = Metrics(buckets=(0.1, 1))
+    m.inc("firefly_requests_total", (("status", "200"),))
+    m.inc("firefly_requests_total", (("status", "200"),))
+    m.observe("firefly_request_duration_seconds", (), 0.05)
+    m.observe("firefly_request_duration_seconds", (), 0.5)
+    m.observe("firefly_request_duration_seconds", (), 5)
+    counters, histograms = m.collect()
+    assert counters == {("firefly_requests_total", (("status", "200"),)): 2}
+    assert histograms == {("firefly_request_duration_seconds", ()): [1, 1, 1, 5.55]}
+
+def test_concurrent_updates():
+    m = Metrics(shards=4)
+    def work():
+        for i in range(1000):
+            m.inc("c")
+    threads = [threading.Thread(target=work) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    counters, _ = m.collect()
+    assert counters[("c", ())] == 8000
+
+def test_format_metrics():
+    m = Metrics(buckets=(0.1, 1))
+    m.inc("firefly_requests_total", (("status", "200"),), 3)
+    m.observe("firefly_request_duration_seconds", (("status", "200"),), 0.5)
+    text = format_metrics([((("function", "square"),), m)])
+    lines = text.splitlines()
+    assert "# TYPE firefly_requests_total counter" in lines
+    assert 'firefly_requests_total{function="square",status="200"} 3' in lines
+    assert '# TYPE firefly_request_duration_seconds histogram' in lines
+    assert 'firefly_request_duration_seconds_bucket{function="square",status="200",le="0.1"} 0' in lines
+    assert 'firefly_request_duration_seconds_bucket{function="square",status="200",le="1"} 1' in lines
+    assert 'firefly_request_duration_seconds_bucket{function="square",status="200",le="+Inf"} 1' in lines
+    assert 'firefly_request_duration_seconds_sum{function="square",status="200"} 0.5' in lines
+    assert 'firefly_request_duration_seconds_count{function="square",status="200"} 1' in lines
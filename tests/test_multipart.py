@@ -0,0 +1,47 @@
+import io
+import pytest
+from firefly.multipart import parse_multipart, parse_header, PayloadTooLarge
+
+BODY = (b'preamble\r\n'
+        b'--XYZ\r\n'
+        b'Content-Disposition: form-data; name="abc"\r\n'
+        b'\r\n'
+        b'hi\r\n'
+        b'--XYZ\r\n'
+        b'Content-Disposition: form-data; name="data"; filename="a.csv"\r\n'
+        b'Content-Type: text/csv\r\n'
+        b'\r\n'
+        b'x,y\r\n1,2\r\n'
+        b'--XYZ--\r\n')
+
+def test_parse_header():
+    assert parse_header('multipart/form-data; boundary=XYZ') == ('multipart/form-data', {'boundary': 'XYZ'})
+    assert parse_header('form-data; name="a;b"; filename="x\\"y.csv"') == \
+        ('form-data', {'name': 'a;b', 'filename': 'x"y.csv'})
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 65536])
+def test_parse_multipart(chunk_size):
+    fields = dict(parse_multipart(io.BytesIO(BODY), "XYZ", chunk_size=chunk_size))
+    assert fields['abc'] == 'hi'
+    assert fields['data'].filename == 'a.csv'
+    assert fields['data'].read() == b'x,y\r\n1,2'
+
+def test_parse_multipart_without_trailing_newline():
+    fields = dict(parse_multipart(io.BytesIO(BODY.rstrip()), "XYZ"))
+    assert fields['abc'] == 'hi'
+
+def test_parse_multipart_spools_to_disk():
+    fields = dict(parse_multipart(io.BytesIO(BODY), "XYZ", spool_size=4))
+    assert fields['data']._rolled
+    assert fields['data'].read() == b'x,y\r\n1,2'
+
+def test_parse_multipart_limits():
+    with pytest.raises(PayloadTooLarge):
+        parse_multipart(io.BytesIO(BODY), "XYZ", max_part_size=4)
+    with pytest.raises(PayloadTooLarge):
+        parse_multipart(io.BytesIO(BODY), "XYZ", max_size=50)
+    assert len(parse_multipart(io.BytesIO(BODY), "XYZ", max_part_size=8, max_size=len(BODY))) == 2
+
+def test_parse_multipart_truncated():
+    with pytest.raises(ValueError):
+        parse_multipart(io.BytesIO(BODY[:80]), "XYZ")
@@ -0,0 +1,58 @@
+import io
+import marshal
+import pstats
+from webob import Request
+from firefly.app import Firefly
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+def make_app(**kwargs):
+    app = Firefly(**kwargs)
+    app.add_route("/fib", fib, function_name="fib")
+    return app
+
+def test_sampled_profiles():
+    app = make_app()
+    response = app.process_request(Request.blank("/fib", POST='{"n": 10}'))
+    assert "X-Firefly-Profile-Id" not in response.headers
+
+    app.set_profiling(sample_rate=1.0)
+    response = app.process_request(Request.blank("/fib", POST='{"n": 10}'))
+    assert response.json == 55
+    profile_id = response.headers["X-Firefly-Profile-Id"]
+
+    profiles = app.process_request(Request.blank("/_profiles")).json
+    assert [(p["id"], p["function"], p["reason"]) for p in profiles] == [(int(profile_id), "fib", "sampled")]
+
+    text = app.process_request(Request.blank("/_profiles?id=" + profile_id)).text
+    assert "fib" in text
+
+    collapsed = app.process_request(Request.blank("/_profiles?format=collapsed&id=" + profile_id)).text
+    assert any(line.split(" ")[0].endswith(":fib") for line in collapsed.splitlines())
+
+    body = app.process_request(Request.blank("/_profiles?format=pstats&id=" + profile_id)).body
+    assert any(func[2] == "fib" for func in marshal.loads(body))
+
+    assert app.process_request(Request.blank("/_profiles?id=1000")).status == '404 Not Found'
+
+def test_slow_profiles():
+    app = make_app()
+    app.set_profiling(slow_ms=60000)
+    response = app.process_request(Request.blank("/fib", POST='{"n": 5}'))
+    assert "X-Firefly-Profile-Id" not in response.headers
+
+    app.set_profiling(slow_ms=0)
+    response = app.process_request(Request.blank("/fib", POST='{"n": 5}'))
+    assert "X-Firefly-Profile-Id" in response.headers
+
+def test_profile_header_requires_auth():
+    headers = {"X-Firefly-Profile": "1"}
+    app = make_app()
+    response = app.process_request(Request.blank("/fib", POST='{"n": 5}', headers=headers))
+    assert "X-Firefly-Profile-Id" not in response.headers
+
+    app = make_app(auth_token="abcd")
+    headers["Authorization"] = "Token abcd"
+    response = app.process_request(Request.blank("/fib", POST='{"n": 5}', headers=headers))
+    assert "X-Firefly-Profile-Id" in response.headers
@@ -0,0 +1,50 @@
+import pytest
+from firefly.routing import Router, build_path, get_path_params
+
+def test_static_routes():
+    router = Router()
+    router.add("/square", "square")
+    assert router.match("/square") == ("square", {})
+    assert router.match("/cube") == (None, None)
+
+def test_path_params():
+    router = Router()
+    router.add("/users/{id:int}", "user")
+    router.add("/users/{name}/posts", "posts")
+    router.add("/prices/{value:float}", "price")
+    assert router.match("/users/42") == ("user", {"id": 42})
+    assert router.match("/users/alice/posts") == ("posts", {"name": "alice"})
+    assert router.match("/prices/1.5") == ("price", {"value": 1.5})
+    assert router.match("/users/alice") == (None, None)
+    assert router.match("/users/42/") == (None, None)
+
+def test_prefix_routes_are_tried_last():
+    router = Router()
+    router.add("/files/{path:path}", "files")
+    router.add("/files/{name}/info", "info")
+    router.add("/files/index", "index")
+    assert router.match("/files/a/b.txt") == ("files", {"path": "a/b.txt"})
+    assert router.match("/files/a/info") == ("info", {"name": "a"})
+    assert router.match("/files/index") == ("index", {})
+
+def test_replace_route():
+    router = Router()
+    router.add("/users/{id}", "old")
+    router.add("/users/{id}", "new")
+    assert router.match("/users/1") == ("new", {"id": "1"})
+    assert len(router.routes) == 1
+
+def test_invalid_routes():
+    router = Router()
+    with pytest.raises(ValueError):
+        router.add("/users/{id:uuid}", "user")
+    with pytest.raises(ValueError):
+        router.add("/users/{id}/{id}", "user")
+
+def test_build_path():
+    assert get_path_params("/users/{id:int}/files/{path:path}") == ["id", "path"]
+    path, kwargs = build_path("/users/{id:int}/files/{path:path}", {"id": 3, "path": "a b/c", "x": 1})
+    assert path == "/users/3/files/a%20b/c"
+    assert kwargs == {"x": 1}
+    with pytest.raises(KeyError):
+        build_path("/users/{id}", {})
@@ -0,0 +1,91 @@
+import io
+import threading
+import pytest
+import requests
+from wsgiref.simple_server import make_server
+from firefly import server
+from firefly.app import Firefly
+from firefly.client import Client
+
+def test_run_server_with_workers(monkeypatch):
+    calls = []
+    monkeypatch.setattr(server, "run_gunicorn", lambda app, options: calls.append((app, options)))
+    app = Firefly()
+    server.run_server(app, "127.0.0.1", 8000, workers=4, max_requests=1000)
+    assert len(calls) == 1
+    assert calls[0][0] is app
+    assert calls[0][1]["bind"] == "127.0.0.1:8000"
+    assert calls[0][1]["workers"] == 4
+    assert calls[0][1]["max_requests"] == 1000
+
+def test_run_server_threaded(monkeypatch):
+    servers = []
+    class MockServer:
+        def serve_forever(self):
+            pass
+    def make_server(host, port, app, server_class, handler_class):
+        servers.append((server_class, handler_class))
+        return MockServer()
+    monkeypatch.setattr(server, "make_server", make_server)
+    server.run_server(Firefly(), "127.0.0.1", 8000)
+    assert servers == [(server.ThreadingWSGIServer, server.RequestHandler)]
+
+class QuietHandler(server.RequestHandler):
+    def log_message(self, *args):
+        pass
+
+def total(records, scale):
+    return scale * sum(r["x"] for r in records)
+
+def test_threaded_server_streamed_input():
+    app = Firefly()
+    app.add_route("/total", total, input_stream="records")
+    httpd = make_server("127.0.0.1", 0, app, server_class=server.ThreadingWSGIServer, handler_class=QuietHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        client = Client("http://127.0.0.1:{}/".format(httpd.server_port))
+        # the records are sent using chunked transfer encoding
+        assert client.total(records=({"x": i} for i in range(1000)), scale=2) == 999000
+        assert client.total(records=iter([]), scale=2) == 0
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+def test_chunked_input():
+    body = b"4\r\nab\nc\r\n3;ext=1\r\nd\nx\r\n0\r\nTrailer: 1\r\n\r\nnext request"
+    rfile = io.BytesIO(body)
+    f = server.ChunkedInput(rfile)
+    assert f.readline() == b"ab\n"
+    assert f.read(2) == b"cd"
+    assert list(f) == [b"\n", b"x"]
+    assert f.read() == b""
+    assert rfile.read() == b"next request"
+
+    with pytest.raises(ValueError):
+        server.ChunkedInput(io.BytesIO(b"zz\r\nab")).read()
+    with pytest.raises(ValueError):
+        server.ChunkedInput(io.BytesIO(b"4\r\nab")).read()
+
+def test_threaded_server_map():
+    app = Firefly()
+    app.add_route("/square", lambda a: a ** 2, function_name="square", cache={"max_entries": 10})
+    httpd = make_server("127.0.0.1", 0, app, server_class=server.ThreadingWSGIServer, handler_class=QuietHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        url = "http://127.0.0.1:{}/".format(httpd.server_port)
+        client = Client(url)
+        assert client.square.map([{"a": i % 3} for i in range(6)], chunk_size=3, workers=1) == [0, 1, 4, 0, 1, 4]
+
+        # the calls are recorded and cached as calls to the function
+        lines = requests.get(url + "_metrics").text.splitlines()
+        assert 'firefly_requests_total{function="square",status="200"} 6' in lines
+        stats = requests.get(url + "_cache").json()
+        assert stats["square"]["hits"] == 3
+        assert stats["square"]["entries"] == 3
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
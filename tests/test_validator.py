@@ -17,3 +17,37 @@ def test_less_args():
 def test_more_args():
     with pytest.raises(ValidationError, message="Expected a ValidationError"):
         validate_args(add, {"a":1, "b":2, "c":3})
+
+def sample(a, b=1, **kwargs):
+    pass
+
+def assert_same_error(function, kwargs):
+    with pytest.raises(ValidationError) as expected:
+        validate_args(function, kwargs)
+    with pytest.raises(ValidationError) as actual:
+        CallPlan.from_function(function).validate(kwargs)
+    assert str(actual.value) == str(expected.value)
+
+def test_call_plan():
+    plan = CallPlan.from_function(sample)
+    assert plan.parameters == ["a", "b"]
+    assert plan.required == {"a"}
+    assert plan.optional == {"b"}
+    assert plan.defaults == {"b": 1}
+    assert plan.var_keyword is True
+
+def test_call_plan_valid_args():
+    CallPlan.from_function(add).validate({"a": 1, "b": 2})
+    CallPlan.from_function(sample).validate({"a": 1, "c": 2})
+
+def test_call_plan_errors():
+    assert_same_error(add, {"a": 1})
+    assert_same_error(add, {"b": 1})
+    assert_same_error(add, {})
+    assert_same_error(add, {"a": 1, "b": 2, "c": 3})
+    assert_same_error(add, {"c": 3, "a": 1, "b": 2, "d": 4})
+    assert_same_error(sample, {"b": 2, "c": 3})
+
+def test_call_plan_non_dict():
+    with pytest.raises(ValidationError):
+        CallPlan.from_function(add).validate([1, 2])